@@ -0,0 +1,247 @@
+#Python 3 script to benchmark the database and datafile functions of FISH system 2.
+#Run from the ROBOFISH folder: python FISH2_benchmarks.py
+#Or run a single benchmark: python FISH2_benchmarks.py <name>
+#No hardware is needed, all benchmarks work on temporary files.
+
+## CONTENT ##
+    # Helpers
+    # Database concurrency (WAL)
+    # YAML datafile loading and dumping
+    # Database helper throughput
+
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+import statistics
+
+import yaml
+import ruamel.yaml
+import FISH2_peripherals as perif
+
+#=============================================================================
+# Helpers
+#=============================================================================
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of a list of values.
+    Input:
+    `values`(list): Values.
+    `p`(int/float): Percentile between 0 and 100.
+
+    """
+    values = sorted(values)
+    if values == []:
+        return float('nan')
+    i = min(len(values) - 1, int(round((p / 100) * (len(values) - 1))))
+    return values[i]
+
+def timeFunction(function, repeats):
+    """
+    Return the median run time of a function in milliseconds.
+    Input:
+    `function`(function): Function without arguments.
+    `repeats`(int): Number of runs.
+
+    """
+    times = []
+    for i in range(repeats):
+        tic = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - tic) * 1000)
+    return statistics.median(times)
+
+def makeBenchmarkDB(folder, wal=False):
+    """
+    Make a new FISH database in a temporary folder.
+    Input:
+    `folder`(str): Folder to make the database in.
+    `wal`(bool): Use WAL journaling.
+    Returns:
+    `db_path`(str): Full path to database.
+
+    """
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        db_path = perif.newFISHdb('FISH_benchmark_db', wal=wal)
+    finally:
+        os.chdir(cwd)
+    return db_path
+
+#=============================================================================
+# Database concurrency (WAL)
+#=============================================================================
+
+def _concurrentWriter(db_path, duration, ready):
+    """
+    Writer process, mimics the user program: long transactions that write the
+    Parameters table column by column, like a full datafile update.
+
+    """
+    columns = list(perif.returnDictDB(db_path, 'Parameters')[0].keys())
+    ready.set()
+    stop = time.time() + duration
+    while time.time() < stop:
+        with perif.transactionDB(db_path):
+            for i, c in enumerate(columns):
+                perif.updateValueDB(db_path, 'Parameters', c, new_value=i)
+            perif.setFlagDB(db_path, 'Parameters_flag')
+        time.sleep(0.01)
+
+def benchmarkConcurrency(duration=5, busy_timeout=5):
+    """
+    Measure the latency of the Flags reads of the FISH2 program while the
+    user program writes to the database. With and without WAL journaling.
+    Input:
+    `duration`(int): Seconds to run each mode.
+    `busy_timeout`(int/float): Seconds to wait for a lock.
+
+    """
+    perif.configureDB(busy_timeout=busy_timeout)
+    results = []
+    for wal in [False, True]:
+        with tempfile.TemporaryDirectory() as folder:
+            db_path = makeBenchmarkDB(folder, wal=wal)
+            ready = multiprocessing.Event()
+            writer = multiprocessing.Process(target=_concurrentWriter, args=(db_path, duration, ready))
+            writer.start()
+            ready.wait()
+
+            latency = []
+            locked = 0
+            stop = time.time() + duration
+            while time.time() < stop:
+                tic = time.perf_counter()
+                try:
+                    perif.returnDictDB(db_path, 'Flags')
+                    latency.append((time.perf_counter() - tic) * 1000)
+                except perif.sqlite3.OperationalError:
+                    locked += 1
+            writer.join()
+            perif.closeDB(db_path)
+
+        mode = 'WAL' if wal else 'rollback'
+        results.append((mode, len(latency), percentile(latency, 50), percentile(latency, 99), 
+                        max(latency), locked))
+
+    print('\nConcurrent reader/writer latency of returnDictDB("Flags"), {}s per mode'.format(duration))
+    print('{:10}| {:>8} | {:>9} | {:>9} | {:>9} | {:>7}'.format('Mode', 'Reads', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'Locked'))
+    for r in results:
+        print('{:10}| {:8} | {:9.3f} | {:9.3f} | {:9.3f} | {:7}'.format(*r))
+
+#=============================================================================
+# YAML datafile loading and dumping
+#=============================================================================
+
+def benchmarkYaml(filepath='FISH_System_datafile_template.yaml', repeats=20):
+    """
+    Compare the old pure-Python loaders/dumpers with the libyaml fast path 
+    of yamlLoader() and yamlMake(), and with the ruamel round trip that is 
+    still used where comments need to be preserved.
+    Input:
+    `filepath`(str): .yaml datafile to test with.
+    `repeats`(int): Number of runs of each method.
+
+    """
+    def load(Loader):
+        with open(filepath, 'r') as file_descriptor:
+            return yaml.load(file_descriptor, Loader=Loader)
+
+    data = load(yaml.SafeLoader)
+    params = data['FISHSystem']['Parameters']
+
+    results = []
+    results.append(('Load', 'yaml.FullLoader (old)', timeFunction(lambda: load(yaml.FullLoader), repeats)))
+    results.append(('Load', perif.YamlLoader.__name__, timeFunction(lambda: perif.yamlLoader(filepath), repeats)))
+    perif.yamlLoaderCached(filepath)
+    results.append(('Load', 'yamlLoaderCached', timeFunction(lambda: perif.yamlLoaderCached(filepath), repeats)))
+    results.append(('Load', 'ruamel round trip', timeFunction(lambda: perif.yamlRoundTripLoad(filepath), repeats)))
+
+    with tempfile.TemporaryDirectory() as folder:
+        out = os.path.join(folder, 'out.yaml')
+        def dumpOld():
+            with open(out, 'w') as f:
+                ruamel.yaml.dump(params, f, default_flow_style=False)
+        config, ind, bsi = perif.yamlRoundTripLoad(filepath)
+        results.append(('Dump', 'ruamel.yaml.dump (old)', timeFunction(dumpOld, repeats)))
+        results.append(('Dump', perif.YamlDumper.__name__, timeFunction(lambda: perif.yamlMake(out, params), repeats)))
+        results.append(('Dump', 'ruamel round trip', timeFunction(lambda: perif.yamlRoundTripDump(out, config, ind, bsi), repeats)))
+
+    print('\nYAML loading and dumping of {}, median of {} runs'.format(filepath, repeats))
+    print('Dump uses the Parameters table, round trip dump the full file.')
+    print('{:6}| {:24}| {:>10}'.format('', 'Method', 'Time (ms)'))
+    for r in results:
+        print('{:6}| {:24}| {:10.3f}'.format(*r))
+
+#=============================================================================
+# Database helper throughput
+#=============================================================================
+
+def benchmarkHelpers(repeats=2000):
+    """
+    Throughput of the most used database helpers, updateValueDB(), 
+    appendVolumeLedgerDB() and returnValueDB(). Once with a commit per call, like the FISH2 program 
+    uses them, and once with all calls in one transaction, which shows the
+    cost of the statements without the commit.
+    Input:
+    `repeats`(int): Number of calls per test.
+
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        db_path = makeBenchmarkDB(folder)
+        perif.updateValueDB(db_path, 'Volumes', 'P1', new_value=10**9)
+        codes = ['C1H{:02d}'.format(h) for h in range(1, 31)]
+        for c in codes:
+            perif.newRowDB(db_path, 'Targets', [c, 1, 'Hybridization' + c[-2:]] + [None] * 10)
+
+        tests = [
+            ('updateValueDB new_value', lambda i: perif.updateValueDB(db_path, 'Volumes', 'P1', new_value=i)),
+            ('updateValueDB operation', lambda i: perif.updateValueDB(db_path, 'Volumes', 'P1', operation='-', value=1)),
+            ('appendVolumeLedgerDB', lambda i: perif.appendVolumeLedgerDB(db_path, 'P1', '-', 1)),
+            ('updateValueDB criteria', lambda i: perif.updateValueDB(db_path, 'Targets', 'Cy3', new_value=i,
+                                                                     criteria_column='Code', criteria='C1H01')),
+            ('returnValueDB', lambda i: perif.returnValueDB(db_path, 'Targets', 'Cy3', 'Code', 'C1H01')),
+            ('returnValueDB all codes', lambda i: perif.returnValueDB(db_path, 'Targets', 'Cy3', 'Code', codes[i % 30])),
+            ]
+
+        results = []
+        for name, function in tests:
+            single = []
+            batched = []
+            #Best of 3, the commits make single runs noisy
+            for r in range(3):
+                tic = time.perf_counter()
+                for i in range(repeats):
+                    function(i)
+                single.append(repeats / (time.perf_counter() - tic))
+
+                tic = time.perf_counter()
+                with perif.transactionDB(db_path):
+                    for i in range(repeats):
+                        function(i)
+                batched.append(repeats / (time.perf_counter() - tic))
+            results.append((name, max(single), max(batched)))
+        perif.closeDB(db_path)
+
+    print('\nDatabase helper throughput, {} calls per test, best of 3'.format(repeats))
+    print('{:25}| {:>17} | {:>17}'.format('Function', 'Commit (calls/s)', 'Batched (calls/s)'))
+    for r in results:
+        print('{:25}| {:17.0f} | {:17.0f}'.format(*r))
+
+#=============================================================================
+# Run
+#=============================================================================
+
+benchmarks = {
+    'concurrency': benchmarkConcurrency,
+    'yaml': benchmarkYaml,
+    'helpers': benchmarkHelpers,
+    }
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks.keys())
+    for name in selected:
+        benchmarks[name]()
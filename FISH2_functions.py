@@ -25,17 +25,26 @@
 # DEPENDENCIES
 import serial
 from serial.tools import list_ports
+import os
+import re
+import sys
+import queue
 from collections import deque
 import time
 from datetime import datetime, timedelta
 import numpy as np
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from tkinter import *
 import pickle
 import shutil
+import tempfile
 
 # FISH peripherals
 import FISH2_peripherals as perif
+import FISH2_simulation as sim
 import sqlite3
 
 # HARDWARE
@@ -81,6 +90,12 @@ try:
 except ModuleNotFoundError:
     print('Module Py_TC720 not found. Ignore if machine is not in use.')
 
+    ## Hot-plug monitoring of USB devices, Linux only
+try:
+    import pyudev
+except ModuleNotFoundError:
+    pyudev = None
+
 #=============================================================================
 # Hardware address      
 #=============================================================================    
@@ -145,6 +160,130 @@ def find_address(identifier = None):
     
     return port[0]
 
+def serialNumber(address):
+    """
+    Find the serial number of the USB to serial converter at an address.
+    Input:
+    `address`(str): Address of the device, like: 'COM3' or '/dev/ttyUSB0'.
+    Returns:
+    `serial_number`(str): Serial number, None if not found.
+    
+    """
+    if sys.platform.startswith('linux'):
+        #Only read the sysfs entries of this device
+        from serial.tools import list_ports_linux
+        try:
+            return list_ports_linux.SysFS(address).serial_number
+        except Exception:
+            return None
+    for port in list_ports.comports():
+        if port.device == address:
+            return port.serial_number
+    return None
+
+def checkAddress(address, serial_number=None):
+    """
+    Cheap check if a device is still present at a (cached) address. On Linux
+    the serial number of the address is compared, without opening the port.
+    On other systems the port is opened and closed, Windows gives a FTDI 
+    chip the same COM port every time it is plugged in.
+    Input:
+    `address`(str): Address of the device, like: 'COM3' or '/dev/ttyUSB0'.
+    `serial_number`(str): Expected serial number. If None, only checks if 
+        the address is present. Default = None
+    Returns:
+    True if the device is present.
+    
+    """
+    if address in [None, 'None']:
+        return False
+    if sys.platform.startswith('linux'):
+        if not os.path.exists(address):
+            return False
+        return serial_number in [None, 'None'] or serialNumber(address) == serial_number
+    try:
+        serial.Serial(address).close()
+        return True
+    except serial.SerialException:
+        return False
+
+def startDeviceMonitor(callback):
+    """
+    Monitor serial devices that are plugged in or removed. Linux only and
+    needs the pyudev package.
+    Input:
+    `callback`(function): Called with: action ('add' or 'remove'), address
+        and serial number of the device, from the monitor thread.
+    Returns:
+    `observer`(pyudev.MonitorObserver): Running monitor, stop with 
+        observer.stop(). None if hot-plug monitoring is not available.
+    
+    """
+    if pyudev == None or not sys.platform.startswith('linux'):
+        return None
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by(subsystem='tty')
+
+    def event(device):
+        if device.action in ['add', 'remove'] and device.device_node != None:
+            callback(device.action, device.device_node, device.properties.get('ID_SERIAL_SHORT'))
+
+    observer = pyudev.MonitorObserver(monitor, callback=event, name='deviceMonitor')
+    observer.daemon = True
+    observer.start()
+    return observer
+
+def valveSteps(port_from, port_to, n=10):
+    """
+    Number of positions a rotary valve passes to go from one port to 
+    another. The MX valves turn the shortest way round.
+    Input:
+    `port_from`(int): Start port.
+    `port_to`(int): End port.
+    `n`(int): Number of ports of the valve. Default = 10
+    Returns:
+    `steps`(int): Rotation steps.
+    
+    """
+    d = abs(port_to - port_from) % n
+    return min(d, n - d)
+
+def sweepOrder(start, items, n=10):
+    """
+    Order the ports to visit on a rotary valve for the least rotation. The 
+    valve sweeps one way and then turns back for the remaining ports, or the
+    other way round, whichever is shorter.
+    Input:
+    `start`(int): Current port of the valve. None if unknown.
+    `items`(list): List of (port, item) tuples.
+    `n`(int): Number of ports of the valve. Default = 10
+    Returns:
+    `ordered`(list): The items in the order to visit them.
+    
+    """
+    if items == []:
+        return []
+    if start == None:
+        #Start after the largest gap between the ports and sweep one way
+        ports = sorted(set(p for p, i in items))
+        gaps = [((ports[j] - ports[j - 1]) % n, ports[j]) for j in range(len(ports))]
+        start = max(gaps)[1]
+    #Sort on the distance from the start, going up
+    items = sorted(items, key=lambda x: (x[0] - start) % n)
+    offsets = [(p - start) % n for p, i in items]
+    at_start = offsets.count(0)
+    best = None
+    #Split in the ports to visit going up, and the rest going down
+    for k in range(at_start, len(items) + 1):
+        up = offsets[k - 1] if k > 0 else 0
+        down = n - offsets[k] if k < len(items) else 0
+        options = [(up + (up + down if down > 0 else 0), items[:k] + items[k:][::-1]),
+                   (down + (down + up if up > 0 else 0), items[k:][::-1] + items[:k])]
+        for cost, order in options:
+            if best == None or cost < best[0]:
+                best = (cost, order)
+    return [i for p, i in best[1]]
+
 #=============================================================================
 # Initiation  
 #=============================================================================    
@@ -155,24 +294,50 @@ class FISH2():
     
     """
     
-    def __init__(self, db_path, imaging_output_folder, start_imaging_file_path, system_name='ROBOFISH'):
+    def __init__(self, db_path, imaging_output_folder, start_imaging_file_path, system_name='ROBOFISH',
+                 simulate=False, simulation_imaging_time=3600, parallel_init=False, hotplug=False):
         """
         Initiate system 
         Input:
         `db_path`(str): Path to the database. Or new name if it does not exist. 
             Suggested name: "FISH_System2_db.sqlite".
         `imaging_output_folder`(str): Path to where the images are saved.
+        `simulate`(bool): If True, uses simulated hardware and a virtual clock
+            to test a protocol without hardware. Waiting takes no time and all
+            operations are recorded in self.clock.timeline. Push messages are
+            not sent. The run uses a copy of the database and its own start
+            imaging file and imaging output folder, in a temporary folder, see
+            self.simulation_folder. The datafile is not changed.
+            Default = False
+        `simulation_imaging_time`(int/float): Seconds per simulated imaging
+            round. Default = 3600
+        `parallel_init`(bool): If True, initiates the hardware devices at the
+            same time, see initHardware(). Default = False
+        `hotplug`(bool): If True, re-attaches a device when its USB cable is
+            plugged in again during the run. Linux only, needs pyudev. See
+            deviceEvent(). Default = False
         
         """
         
         self.system_name = system_name
         self.L = perif.FISH_logger(system_name = self.system_name)
+        #Waiting is done with self.clock, the time module or a virtual clock
+        self.simulate = simulate
+        self.clock = sim.VirtualClock() if simulate == True else time
 
         #Some check if it does not exist yet???
         self.db_path = db_path
-        print(self.db_path)
         self.imaging_output_folder = imaging_output_folder
         self.start_imaging_file_path = start_imaging_file_path
+        #A simulation works on copies, so that it does not change the volumes
+        #and experiments of the real run or starts the imaging.
+        self.simulation_folder = None
+        if simulate == True:
+            self.simulation_folder = tempfile.mkdtemp(prefix='FISH2_simulation_')
+            self.db_path = perif.copyDB(db_path, os.path.join(self.simulation_folder, os.path.basename(db_path)))
+            self.imaging_output_folder = self.simulation_folder
+            self.start_imaging_file_path = os.path.join(self.simulation_folder, os.path.basename(start_imaging_file_path))
+        print(self.db_path)
         self.Parameters = {}
         self.Volumes = {}
         self.Targets = {}
@@ -186,13 +351,44 @@ class FISH2():
         self.Operator_address = {}
         self.Padding = {}
         self.Alert_volume = {}
+        self.Flags = {}
+        self.db_version = None
         self.target_temperature= [None, None]
         self.found_error = False
+        #Last known port of the valves, None if unknown. See changeValve()
+        self.valve_position = {'MXValve1': None, 'MXValve2': None}
+        self.valve_stats = {v: {'moves': 0, 'skipped': 0, 'move_time': 0.0} for v in self.valve_position}
+        #Valves, ports and cached routes, None if not built. See getTopology()
+        self.topology = None
+        self.valve_size = 10
+        #Number of open chainPump() blocks
+        self.pump_chain_depth = 0
+        #Last known state of the pump, None if unknown. See setPumpSpeed()
+        self.pump_state = {'speed': None, 'backlash': None, 'plunger': None, 'port': None}
+        self.pump_stats = {'queries': 0, 'skipped_queries': 0, 'skipped_commands': 0}
+        #Port the reservoir is connected to and the last buffer drawn into the
+        #reservoir, None if unknown. See flushReservoir()
+        self.connected_port = None
+        self.reservoir_content = None
+        #Buffers that may follow a buffer in the reservoir without a flush,
+        #like: {'WB': ['SB']}. A buffer can always follow itself.
+        self.flush_rules = {}
+        self.flush_stats = {'flushes': 0, 'skipped': 0, 'flush_time': 0.0, 'volume_saved': 0}
+        #Protocols that take turns on the pump, None if not running. See runCooperative()
+        self.coop = None
+        self.coop_stats = {'switches': 0, 'late_time': 0.0, 'max_late': 0.0}
+        #Background threads, see close()
+        self.volume_ledger_compaction = None
+        self.device_monitor = None
+        #Devices plugged in or removed, handled by applyDeviceEvents()
+        self.device_events = queue.Queue()
 
         self.L.logger.info(f'System name: {system_name}')
         self.L.logger.info(f'Path to database: {self.db_path}')
-        self.L.logger.info(f'Path to imaging_output_folder: {imaging_output_folder}')
-        self.L.logger.info(f'Path to start_imaging_file_path: {start_imaging_file_path}')
+        self.L.logger.info(f'Path to imaging_output_folder: {self.imaging_output_folder}')
+        self.L.logger.info(f'Path to start_imaging_file_path: {self.start_imaging_file_path}')
+        if simulate == True:
+            self.L.logger.info(f'Simulation on a copy of: {db_path}, in: {self.simulation_folder}')
         
         #Make sure imaging start file is set to 0
         with open(self.start_imaging_file_path, 'w') as start_imaging_file:
@@ -200,7 +396,8 @@ class FISH2():
         self.L.logger.info('Set "start_imaging_file" to zero.')
               
         # Ask user if hardware can be initialized and primed.
-        input('''\nPress Enter if:
+        if simulate == False:
+            input('''\nPress Enter if:
             * Flowcell(s) is placed in stage and connected.
             * Heating/cooling cables are connected.
             * All buffers are in the correct position and connected.
@@ -212,171 +409,19 @@ class FISH2():
         self.L.logger.info('User confirmed system is ready for operation.')
         
 
+        #Fold the buffer volume changes into the database in the background
+        self.volume_ledger_compaction = perif.startVolumeLedgerCompaction(self.db_path)
+
         # Get all data from database
         self.L.logger.info('Retrieving data from database.')
         self.updateExperimentalParameters(self.db_path, ignore_flags=True)
         self.L.logger.info('Successful retrieved data from database.')
         
         #Connecting to hardware
-        self.L.logger.info('Connecting and initiating hardware.')
-            
-        #Find addresses
-        self.L.logger.info('    Finding device addresses.')
-        device_COM_port = self.deviceAddress()
-
-        #Initiate all connected devices, connected is determined by the user
-        # initialize MXValve1
-        if self.Machines['MXValve1'] == 1:
-            if device_COM_port['MXValve1'] == None:
-                self.L.logger.warning('    MXValve1 not connected (no address available).')
-            else:
-                self.MXValve1 = MXII_valve.MX_valve(address = device_COM_port['MXValve1'], ports=10, name = 'MXValve1', verbose = False)
-                self.L.logger.info('    MXValve1 Initialized.')
-                self.devices.append('MXValve1')
-        else:
-            self.L.logger.info('        MXValve1 not connected according to user. Ignore if not needed.')
-        
-        # initialize MXValve2
-        if self.Machines['MXValve2'] == 1:
-            if device_COM_port['MXValve2'] == None:
-                self.L.logger.warning('    MXValve2 not connected (no address available).')
-            else:
-                self.MXValve2 = MXII_valve.MX_valve(address = device_COM_port['MXValve2'], ports=10, name = 'MXValve2', verbose = False)
-                self.L.logger.info('    MXValve2 Initialized.')
-                self.devices.append('MXValve2')
-        else:
-            self.L.logger.info('        MXValve2 not connected according to user. Ignore if not needed.')
-        
-        # initialize Temperature Controller 1 (TC_1)
-        if self.Machines['ThermoCube1'] == 1:
-            if device_COM_port['ThermoCube1'] == None:
-                self.L.logger.warning('    ThermoCube_1 not connected (no address available).')
-            else:
-                self.TC_1 = ThermoCube.ThermoCube(address = device_COM_port['ThermoCube1'], 
-                                                  name = 'ThermoCube_1')
-                if self.TC_1.connected == True:
-                    self.L.logger.info('    Temperature controller TC_1 Initialized.')
-                    self.setTemp(20, 'Chamber1')
-                    self.devices.append('ThermoCube1')
-                else:
-                    self.L.logger.warning('    Could not make a connection with ThermoCube_1.')
-        else:
-            self.L.logger.info('        ThermoCube1 not connected according to user. Ignore if not needed.')
-
-        # initialize Temperature Controller 2 (TC_2) Replace this with your temperature controller if needed.
-        if self.Machines['ThermoCube2'] ==1:
-            if device_COM_port['ThermoCube2'] == None:
-                self.L.logger.warning('    ThermoCube_2 not connected (no address available).')
-            else:
-                self.TC_2 = ThermoCube.ThermoCube(address = device_COM_port['ThermoCube2'], 
-                                                  name = 'ThermoCube_2')
-                if self.TC_2.connected == True:
-                    self.L.logger.info('    Temperature controller TC_2 Initialized.')
-                    self.setTemp(20, 'Chamber2')
-                    self.devices.append('ThermoCube2')
-                else:
-                    self.L.logger.warning('    Could not make a connection with ThermoCube_2.')
+        if simulate == True:
+            self.initSimulation(imaging_time=simulation_imaging_time)
         else:
-            self.L.logger.info('        ThermoCube2 not connected according to user. Ignore if not needed.')
-
-        # initialize Temperature Controller 1 (TC_1)
-        if self.Machines['Oasis1'] == 1:
-            if device_COM_port['Oasis1'] == None:
-                self.L.logger.warning('    Oasis_1 not connected (no address available).')
-            else:
-                self.TC_1 = Oasis.Oasis(address = device_COM_port['Oasis1'], 
-                                                  name = 'Oasis_1')
-                if self.TC_1.connected == True:
-                    self.L.logger.info('    Temperature controller TC_1 Initialized.')
-                    self.setTemp(20, 'Chamber1')
-                    self.devices.append('Oasis1')
-                else:
-                    self.L.logger.warning('    Could not make a connection with Oasis_1.')
-        else:
-            self.L.logger.info('        Oasis1 not connected according to user. Ignore if not needed.')
-
-        # initialize Temperature Controller 2 (TC_2) Replace this with your temperature controller if needed.
-        if self.Machines['Oasis2'] ==1:
-            if device_COM_port['Oasis2'] == None:
-                self.L.logger.warning('    Oasis_2 not connected (no address available).')
-            else:
-                self.TC_2 = Oasis.Oasis(address = device_COM_port['Oasis2'], 
-                                                  name = 'Oasis_2')
-                if self.TC_2.connected == True:
-                    self.L.logger.info('    Temperature controller TC_2 Initialized.')
-                    self.setTemp(20, 'Chamber2')
-                    self.devices.append('Oasis2')
-                else:
-                    self.L.logger.warning('    Could not make a connection with Oasis_2.')
-        else:
-            self.L.logger.info('        Oasis2 not connected according to user. Ignore if not needed.')
-
-        # Initiate TC720
-        if self.Machines['TC720'] == 1:
-            if device_COM_port['TC720'] == None:
-                self.L.logger.warning('    TC720 not connected (no address available).')
-            else:
-                print(device_COM_port['TC720'])
-                self.TC720 = Py_TC720.TC720(address = device_COM_port['TC720'],
-                                    name = 'TC720',
-                                    mode = 0, 
-                                    control_type = 0,
-                                    default_temp = 20, 
-                                    verbose = False)
-                self.L.logger.info('    TC720 Initialized.')
-                self.devices.append('TC720')
-        else:
-            self.L.logger.info('        TC720 not connected according to user. Ignore if not needed.')
-
-        # initialize Yocto_Thermistor
-        if self.Machines['YoctoThermistor'] == 1:
-            try:
-                self.temp = YoctoThermistor_FISH.FISH_temperature_deamon(serial_number = self.Machine_identification['YoctoThermistor'], log_interval=10)
-                self.L.logger.info('    YoctoThermistor Initialized.')
-                self.temp.deamon_start()
-                self.devices.append('YoctoThermistor')
-            except SystemExit as e:
-                self.L.logger.info('    YoctoThermistor not connected, temperature functions will not work!')
-                self.L.logger.info('    Error code: {}'.format(e))
-        else:
-            self.L.logger.info('        YcotoThermistor not connected according to user. Ignore if not needed.')
-
-        # Initialize syringe pump CavroXE1000
-        if self.Machines['CavroXE1000'] == 1:
-            self.L.logger.info('    Connecting with CavroXE1000.')
-            pump_address = transport.TecanAPISerial.findSerialPumps()
-            self.pump = models.XE1000(com_link =transport.TecanAPISerial(0, pump_address[0][0] , 9600 ))
-            self.L.logger.info('    Established connection with CavroXE1000.')
-            self.L.logger.info('    Initiating CavroXE1000.')
-            self.connectPort('Waste') #Change to waste port
-            self.pump.init(in_port='right', init_speed = 20)
-            self.pump.setSpeed(speed=400, execute = True)
-            self.pump.setBacklashSteps(5, execute = True)
-            self.L.logger.info('    CavroXE1000 Initialized.')
-            self.devices.append('CavroXE1000')
-        else:
-            self.L.logger.info('        CavroXE1000 not connected according to user. Ignore if not needed.')
-
-        # Initiate Syringe pump CavroXCalibur
-        if self.Machines['CavroXCalibur'] == 1:
-            self.L.logger.info('    Connecting with CavroXCalibur')
-            pump_address = transport.TecanAPISerial.findSerialPumps()
-            self.connectPort('Waste') #Change to waste port
-            self.pump = models.XCalibur(com_link= transport.TecanAPISerial(0, pump_address[0][0] , 9600 ),
-                    syringe_ul=2500, 
-                    direction='Z',
-                    microstep=False, 
-                    slope=14, 
-                    speed=22,
-                    debug=False, 
-                    debug_log_path='.')
-            self.L.logger.info('    Established connection with CavroXCalibur.')
-            self.L.logger.info('    Initiating CavroXCalibur.')
-            self.pump.init(speed=16, 
-                    direction='Z') #Z = Input left, output right. Y = Input right, output left
-            self.pump.setSpeed(22)
-            self.L.logger.info('    CavroXCalibur initiated.')
-            self.devices.append('CavroXCalibur')
+            self.initHardware(parallel=parallel_init, hotplug=hotplug)
 
         #Update active machines
         self.L.logger.info('    Connected devices: {}\n'.format(self.devices))
@@ -389,8 +434,9 @@ class FISH2():
             else:
                 self.Machines[m] = 0
                 perif.updateValueDB(self.db_path, 'Machines', column = m, new_value = 0)
-        #   Write them to the yaml info file.
-        perif.DBToYaml(self.db_path)
+        #   Write them to the yaml info file. Not for the copy of a simulation.
+        if simulate == False:
+            perif.DBToYaml(self.db_path)
 
         # Log all the parameters
         self.L.logger.info( 'Start parameters:\n'+''.join(['{}: {}\n'.format(i, self.Parameters[i]) for i in self.Parameters]))
@@ -403,6 +449,19 @@ class FISH2():
         self.L.logger.info('System ready for operation.')
         self.L.logger.info('____')
 
+    def close(self):
+        """
+        Stop the background threads of the program. The volume ledger is 
+        compacted one last time, so that the Volumes table is up to date.
+        Call when the program is done, or before making a new FISH2 instance.
+        """
+        if self.device_monitor != None:
+            self.device_monitor.stop()
+            self.device_monitor = None
+        if self.volume_ledger_compaction != None:
+            perif.stopVolumeLedgerCompaction(self.db_path)
+            self.volume_ledger_compaction = None
+
 #=============================================================================
 # Experimental parameters management        
 #=============================================================================        
@@ -419,23 +478,26 @@ class FISH2():
                               Pause flag is not ignored.
         """
         #Check if experiment is paused
-        count = 0
+        pause_start = time.time()
+        next_message = 1200
         while True:
-            flags = perif.returnDictDB(db_path, 'Flags')[0]
+            flags = self.getFlags()
             if flags['Pause_flag'] == 0:
                 if verbose == True:
                     print('No Pause flag, retrieving data from database.\n')
                 break
             else:
-                count += 1
-                if count % 120 == 0:
-                    print('Database blocked. Waiting for user to finish updating datafile. {} minutes'.format((count*(1/6))))
-                time.sleep(10)
+                paused = time.time() - pause_start
+                if paused >= next_message:
+                    print('Database blocked. Waiting for user to finish updating datafile. {} minutes'.format(round(paused/60)))
+                    next_message += 1200
+                #Wake up as soon as the user program changes the database
+                perif.waitChangeDB(self.db_path, self.db_version, timeout=(next_message - paused))
         
         #Ignore the flags that indicate change and update everything.
         if ignore_flags == True:
             self.Parameters = perif.returnDictDB(db_path, 'Parameters')[0]
-            self.Volumes = perif.returnDictDB(db_path, 'Volumes')[0]
+            self.Volumes = perif.returnVolumesDB(db_path)
             self.Targets = perif.returnDictDB(db_path, 'Targets')
             self.Ports = perif.returnDictDB(db_path, 'Ports')[0]
             self.Ports_reverse = {v:k for k,v in self.Ports.items()}
@@ -446,15 +508,17 @@ class FISH2():
             self.Operator_address = perif.returnDictDB(db_path, 'Operator_address')[0]
             self.Padding = perif.returnDictDB(db_path, 'Padding')[0]
             self.Alert_volume = perif.returnDictDB(db_path, 'Alert_volume')[0]
+            #Ports and Padding are loaded, build the topology again when needed
+            self.topology = None
         
         #Update all parameters from the database, if there has been an update. 
         else:  
-            flags = perif.returnDictDB(db_path, 'Flags')[0]
+            flags = self.getFlags()
             if flags['Parameters_flag'] == 1:
                 self.Parameters = perif.returnDictDB(db_path, 'Parameters')[0]
                 perif.removeFlagDB(db_path, 'Parameters_flag')
             if flags['Volumes_flag'] == 1:
-                self.Volumes = perif.returnDictDB(db_path, 'Volumes')[0]
+                self.Volumes = perif.returnVolumesDB(db_path)
                 perif.removeFlagDB(db_path, 'Volumes_flag')
             if flags['Targets_flag'] == 1:
                 self.Targets = perif.returnDictDB(db_path, 'Targets')
@@ -462,6 +526,7 @@ class FISH2():
             if flags['Ports_flag'] == 1:
                 self.Ports = perif.returnDictDB(db_path, 'Ports')[0]
                 self.Ports_reverse = {v:k for k,v in self.Ports.items()}
+                self.topology = None
                 perif.removeFlagDB(db_path, 'Ports_flag')
             if flags['Hybmix_flag'] == 1:
                 self.Hybmix = perif.returnDictDB(db_path, 'Hybmix')[0]
@@ -480,11 +545,26 @@ class FISH2():
                 perif.removeFlagDB(db_path, 'Operator_address_flag')
             if flags['Padding_flag'] == 1:
                 self.Padding = perif.returnDictDB(db_path, 'Padding')[0]
+                self.topology = None
                 perif.removeFlagDB(db_path, 'Padding_flag')
             if flags['Alert_volume_flag'] == 1:
                 self.Alert_volume = perif.returnDictDB(db_path, 'Alert_volume')[0]
                 perif.removeFlagDB(db_path, 'Alert_volume_flag')
     
+    def getFlags(self):
+        """
+        Return the Flags table. The table is only read from the database if 
+        the database changed since the last time it was read. Otherwise the
+        previous Flags are returned.
+        Returns:
+        `Flags`(dict): Dictionary with the flags.
+        
+        """
+        version = perif.dataVersionDB(self.db_path)
+        if version != self.db_version or self.Flags == {}:
+            self.Flags = perif.returnDictDB(self.db_path, 'Flags')[0]
+            self.db_version = version
+        return self.Flags
                 
     def getHybmixCode(self, target, cycle, indirect):
         """Get the code for the Hybridization mix.
@@ -558,12 +638,287 @@ class FISH2():
 # Hardware management        
 #=============================================================================
 
+    def initHardware(self, parallel=False, hotplug=False):
+        """
+        Connect and initiate the hardware that is active in the Machines 
+        table. Used by __init__(). The time each device takes is logged.
+        Input:
+        `parallel`(bool): If True, initiates the devices at the same time on
+            a thread pool. The pump is initiated after the valves, because it
+            is connected to the Waste port first. Default = False
+        `hotplug`(bool): If True, starts monitoring the USB devices, see 
+            deviceEvent(). Default = False
+        """
+        self.L.logger.info('Connecting and initiating hardware.')
+            
+        #Find addresses
+        self.L.logger.info('    Finding device addresses.')
+        device_COM_port = self.deviceAddress()
+
+        #Initiate all connected devices, connected is determined by the user
+        def initMXValve1():
+            # initialize MXValve1
+            if self.Machines['MXValve1'] == 1:
+                if device_COM_port['MXValve1'] == None:
+                    self.L.logger.warning('    MXValve1 not connected (no address available).')
+                else:
+                    self.MXValve1 = MXII_valve.MX_valve(address = device_COM_port['MXValve1'], ports=10, name = 'MXValve1', verbose = False)
+                    self.L.logger.info('    MXValve1 Initialized.')
+                    self.devices.append('MXValve1')
+            else:
+                self.L.logger.info('        MXValve1 not connected according to user. Ignore if not needed.')
+
+        def initMXValve2():
+            # initialize MXValve2
+            if self.Machines['MXValve2'] == 1:
+                if device_COM_port['MXValve2'] == None:
+                    self.L.logger.warning('    MXValve2 not connected (no address available).')
+                else:
+                    self.MXValve2 = MXII_valve.MX_valve(address = device_COM_port['MXValve2'], ports=10, name = 'MXValve2', verbose = False)
+                    self.L.logger.info('    MXValve2 Initialized.')
+                    self.devices.append('MXValve2')
+            else:
+                self.L.logger.info('        MXValve2 not connected according to user. Ignore if not needed.')
+
+        def initThermoCube1():
+            # initialize Temperature Controller 1 (TC_1)
+            if self.Machines['ThermoCube1'] == 1:
+                if device_COM_port['ThermoCube1'] == None:
+                    self.L.logger.warning('    ThermoCube_1 not connected (no address available).')
+                else:
+                    self.TC_1 = ThermoCube.ThermoCube(address = device_COM_port['ThermoCube1'], 
+                                                      name = 'ThermoCube_1')
+                    if self.TC_1.connected == True:
+                        self.L.logger.info('    Temperature controller TC_1 Initialized.')
+                        self.setTemp(20, 'Chamber1')
+                        self.devices.append('ThermoCube1')
+                    else:
+                        self.L.logger.warning('    Could not make a connection with ThermoCube_1.')
+            else:
+                self.L.logger.info('        ThermoCube1 not connected according to user. Ignore if not needed.')
+
+        def initThermoCube2():
+            # initialize Temperature Controller 2 (TC_2) Replace this with your temperature controller if needed.
+            if self.Machines['ThermoCube2'] ==1:
+                if device_COM_port['ThermoCube2'] == None:
+                    self.L.logger.warning('    ThermoCube_2 not connected (no address available).')
+                else:
+                    self.TC_2 = ThermoCube.ThermoCube(address = device_COM_port['ThermoCube2'], 
+                                                      name = 'ThermoCube_2')
+                    if self.TC_2.connected == True:
+                        self.L.logger.info('    Temperature controller TC_2 Initialized.')
+                        self.setTemp(20, 'Chamber2')
+                        self.devices.append('ThermoCube2')
+                    else:
+                        self.L.logger.warning('    Could not make a connection with ThermoCube_2.')
+            else:
+                self.L.logger.info('        ThermoCube2 not connected according to user. Ignore if not needed.')
+
+        def initOasis1():
+            # initialize Temperature Controller 1 (TC_1)
+            if self.Machines['Oasis1'] == 1:
+                if device_COM_port['Oasis1'] == None:
+                    self.L.logger.warning('    Oasis_1 not connected (no address available).')
+                else:
+                    self.TC_1 = Oasis.Oasis(address = device_COM_port['Oasis1'], 
+                                                      name = 'Oasis_1')
+                    if self.TC_1.connected == True:
+                        self.L.logger.info('    Temperature controller TC_1 Initialized.')
+                        self.setTemp(20, 'Chamber1')
+                        self.devices.append('Oasis1')
+                    else:
+                        self.L.logger.warning('    Could not make a connection with Oasis_1.')
+            else:
+                self.L.logger.info('        Oasis1 not connected according to user. Ignore if not needed.')
+
+        def initOasis2():
+            # initialize Temperature Controller 2 (TC_2) Replace this with your temperature controller if needed.
+            if self.Machines['Oasis2'] ==1:
+                if device_COM_port['Oasis2'] == None:
+                    self.L.logger.warning('    Oasis_2 not connected (no address available).')
+                else:
+                    self.TC_2 = Oasis.Oasis(address = device_COM_port['Oasis2'], 
+                                                      name = 'Oasis_2')
+                    if self.TC_2.connected == True:
+                        self.L.logger.info('    Temperature controller TC_2 Initialized.')
+                        self.setTemp(20, 'Chamber2')
+                        self.devices.append('Oasis2')
+                    else:
+                        self.L.logger.warning('    Could not make a connection with Oasis_2.')
+            else:
+                self.L.logger.info('        Oasis2 not connected according to user. Ignore if not needed.')
+
+        def initTC720():
+            # Initiate TC720
+            if self.Machines['TC720'] == 1:
+                if device_COM_port['TC720'] == None:
+                    self.L.logger.warning('    TC720 not connected (no address available).')
+                else:
+                    print(device_COM_port['TC720'])
+                    self.TC720 = Py_TC720.TC720(address = device_COM_port['TC720'],
+                                        name = 'TC720',
+                                        mode = 0, 
+                                        control_type = 0,
+                                        default_temp = 20, 
+                                        verbose = False)
+                    self.L.logger.info('    TC720 Initialized.')
+                    self.devices.append('TC720')
+            else:
+                self.L.logger.info('        TC720 not connected according to user. Ignore if not needed.')
+
+        def initYoctoThermistor():
+            # initialize Yocto_Thermistor
+            if self.Machines['YoctoThermistor'] == 1:
+                try:
+                    self.temp = YoctoThermistor_FISH.FISH_temperature_deamon(serial_number = self.Machine_identification['YoctoThermistor'], log_interval=10)
+                    self.L.logger.info('    YoctoThermistor Initialized.')
+                    self.temp.deamon_start()
+                    self.devices.append('YoctoThermistor')
+                except SystemExit as e:
+                    self.L.logger.info('    YoctoThermistor not connected, temperature functions will not work!')
+                    self.L.logger.info('    Error code: {}'.format(e))
+            else:
+                self.L.logger.info('        YcotoThermistor not connected according to user. Ignore if not needed.')
+
+        def initCavroXE1000():
+            # Initialize syringe pump CavroXE1000
+            if self.Machines['CavroXE1000'] == 1:
+                self.L.logger.info('    Connecting with CavroXE1000.')
+                pump_address = self.pumpAddress('CavroXE1000')
+                self.pump = models.XE1000(com_link =transport.TecanAPISerial(0, pump_address , 9600 ))
+                self.L.logger.info('    Established connection with CavroXE1000.')
+                self.L.logger.info('    Initiating CavroXE1000.')
+                self.connectPort('Waste') #Change to waste port
+                self.pump.init(in_port='right', init_speed = 20)
+                self.pump_state['plunger'] = 0
+                self.setPumpSpeed(400)
+                self.setPumpBacklash(5)
+                self.L.logger.info('    CavroXE1000 Initialized.')
+                self.devices.append('CavroXE1000')
+            else:
+                self.L.logger.info('        CavroXE1000 not connected according to user. Ignore if not needed.')
+
+        def initCavroXCalibur():
+            # Initiate Syringe pump CavroXCalibur
+            if self.Machines['CavroXCalibur'] == 1:
+                self.L.logger.info('    Connecting with CavroXCalibur')
+                pump_address = self.pumpAddress('CavroXCalibur')
+                self.connectPort('Waste') #Change to waste port
+                self.pump = models.XCalibur(com_link= transport.TecanAPISerial(0, pump_address , 9600 ),
+                        syringe_ul=2500, 
+                        direction='Z',
+                        microstep=False, 
+                        slope=14, 
+                        speed=22,
+                        debug=False, 
+                        debug_log_path='.')
+                self.L.logger.info('    Established connection with CavroXCalibur.')
+                self.L.logger.info('    Initiating CavroXCalibur.')
+                self.pump.init(speed=16, 
+                        direction='Z') #Z = Input left, output right. Y = Input right, output left
+                self.pump_state['plunger'] = 0
+                self.setPumpSpeed(22)
+                self.L.logger.info('    CavroXCalibur initiated.')
+                self.devices.append('CavroXCalibur')
+
+        #In order of initiation, the pumps need the valves
+        independent = [('MXValve1', initMXValve1), ('MXValve2', initMXValve2), 
+                       ('ThermoCube1', initThermoCube1), ('ThermoCube2', initThermoCube2), 
+                       ('Oasis1', initOasis1), ('Oasis2', initOasis2), ('TC720', initTC720), 
+                       ('YoctoThermistor', initYoctoThermistor)]
+        pumps = [('CavroXE1000', initCavroXE1000), ('CavroXCalibur', initCavroXCalibur)]
+
+        if parallel == False:
+            for name, function in independent + pumps:
+                self.timeInit(name, function)
+        else:
+            self.L.logger.info('    Initiating devices in parallel.')
+            with ThreadPoolExecutor(max_workers=len(independent)) as pool:
+                futures = {name: pool.submit(self.timeInit, name, function) for name, function in independent}
+                #The pump initiates while connected to the Waste port
+                futures['MXValve1'].result()
+                futures['MXValve2'].result()
+                for name, function in pumps:
+                    futures[name] = pool.submit(self.timeInit, name, function)
+            #Raise errors of the other devices
+            for future in futures.values():
+                future.result()
+
+        if hotplug == True:
+            self.device_monitor = startDeviceMonitor(self.deviceEvent)
+            if self.device_monitor == None:
+                self.L.logger.warning('    Hot-plug monitoring not available, needs Linux and pyudev.')
+            else:
+                self.L.logger.info('    Monitoring USB devices for re-attachment.')
+
+    def timeInit(self, name, function):
+        """
+        Run the initiation function of a device and log the time it took.
+        Input:
+        `name`(str): Name of the device as in the Machines table.
+        `function`(function): Function without arguments.
+        """
+        tic = time.time()
+        function()
+        if self.Machines[name] == 1:
+            self.L.logger.info('    {} initiation took {} seconds.'.format(name, round(time.time() - tic, 2)))
+
+    def initSimulation(self, imaging_time=3600):
+        """
+        Make simulated devices for the machines that are active in the 
+        Machines table, see FISH2_simulation.py. Used by __init__().
+        Input:
+        `imaging_time`(int/float): Seconds per simulated imaging round.
+        """
+        self.L.logger.info('Simulating hardware on a virtual clock.')
+        for m in ['MXValve1', 'MXValve2']:
+            if self.Machines[m] == 1:
+                setattr(self, m, sim.SimulatedValve(self.clock, m))
+                self.devices.append(m)
+
+        #Temperature controllers
+        for chamber, attribute in [('1', 'TC_1'), ('2', 'TC_2')]:
+            for m in ['ThermoCube' + chamber, 'Oasis' + chamber]:
+                if self.Machines[m] == 1:
+                    setattr(self, attribute, sim.SimulatedTemperatureController(self.clock, '{}_{}'.format(m[:-1], chamber)))
+                    self.devices.append(m)
+                    self.setTemp(20, 'Chamber' + chamber)
+        if self.Machines['TC720'] == 1:
+            self.TC720 = sim.SimulatedTemperatureController(self.clock, 'TC720')
+            self.devices.append('TC720')
+        if self.Machines['YoctoThermistor'] == 1:
+            self.temp = sim.SimulatedThermistor(self.clock, [getattr(self, 'TC_1', None), getattr(self, 'TC_2', None)])
+            self.devices.append('YoctoThermistor')
+
+        #Syringe pump
+        if self.Machines['CavroXE1000'] == 1:
+            self.pump = sim.SimulatedPump(self.clock, model='XE1000', syringe_ul=1000)
+            self.connectPort('Waste')
+            self.pump.init()
+            self.pump_state['plunger'] = 0
+            self.setPumpSpeed(400)
+            self.setPumpBacklash(5)
+            self.devices.append('CavroXE1000')
+        if self.Machines['CavroXCalibur'] == 1:
+            self.pump = sim.SimulatedPump(self.clock, model='XCalibur', syringe_ul=2500)
+            self.connectPort('Waste')
+            self.pump.init()
+            self.pump_state['plunger'] = 0
+            self.setPumpSpeed(22)
+            self.devices.append('CavroXCalibur')
+
+        #Imaging software that resets the start imaging file
+        self.imaging = sim.SimulatedImaging(self.clock, self.start_imaging_file_path, imaging_time=imaging_time)
+
     def deviceAddress(self):
         """
         Functions that finds the Windows 'COM' ports of all used devices
         automatically. Devices are identified by their FTDI chip identifier.
         To find the FTDI chip identifier use the find_address() function 
         and add the identifier to the user FISH_System_datafil.yaml
+        The addresses are cached in the Device_cache table of the database. 
+        A cached address is used if checkAddress() confirms it, the serial
+        ports are only listed if an active device is not found that way.
         Returns:
         `device_COM_port` (dict): Dictionary with name of device and COM port. 
         Devices need to be added to the database using the FISH2_user_program and
@@ -581,18 +936,30 @@ class FISH2():
             'YoctoThermistor': None,
             'TC720': None}
 
-        #Find all serial ports
-        ports_info = serial.tools.list_ports.comports()
-        #Invert the Machine_identification to get the name of the machines using the identifier
-        identifier = {v: k for k, v in self.Machine_identification.items()}
-
-        #Try if machine can be found using the given identifiers.
-        for port in ports_info:
-            try:
-                corresponding_machine = identifier[port.serial_number]
-                device_COM_port[corresponding_machine] = port.device
-            except Exception as e:
-                pass
+        #Try the cached addresses of the active machines with an identifier.
+        #The YoctoThermistor is not a serial device.
+        cache = perif.returnDeviceCacheDB(self.db_path)
+        identifier = {}
+        for machine, serial_number in self.Machine_identification.items():
+            if machine not in device_COM_port or machine == 'YoctoThermistor' or serial_number in [None, 'None']:
+                continue
+            if self.Machines.get(machine) != 1:
+                continue
+            cached = cache.get(machine)
+            if cached != None and cached['Serial_number'] == serial_number and checkAddress(cached['Address'], serial_number):
+                device_COM_port[machine] = cached['Address']
+            else:
+                #Invert the Machine_identification to get the name of the machines using the identifier
+                identifier[serial_number] = machine
+
+        #Try if the other machines can be found using the given identifiers.
+        if identifier != {}:
+            self.L.logger.info('    Searching serial ports for: {}'.format(list(identifier.values())))
+            for port in list_ports.comports():
+                if port.serial_number in identifier:
+                    corresponding_machine = identifier[port.serial_number]
+                    device_COM_port[corresponding_machine] = port.device
+                    perif.updateDeviceCacheDB(self.db_path, corresponding_machine, port.device, serial_number=port.serial_number)
         
         #For machines without an identification method, add the static address.
         for machine in device_COM_port.keys():
@@ -607,6 +974,105 @@ class FISH2():
                         print(f'Warning! No USB port information or serial identification code present for: {machine} add either to the Fixed_USB_port or Machine_identification table using the user program. Ignore if machine has its own identification method.')
  
         return device_COM_port
+
+    def pumpAddress(self, machine):
+        """
+        Find the address of the syringe pump. The cached address is checked
+        by asking the firmware version of the pump. Only if that fails all
+        serial ports are probed with findSerialPumps().
+        Input:
+        `machine`(str): 'CavroXE1000' or 'CavroXCalibur'.
+        Returns:
+        `address`(str): Address of the pump.
+        """
+        cached = perif.returnDeviceCacheDB(self.db_path).get(machine)
+        if cached != None and checkAddress(cached['Address'], cached['Serial_number']):
+            try:
+                transport.TecanAPISerial(0, cached['Address'], 9600, 0.2, 2).sendRcv('&')
+                return cached['Address']
+            except Exception:
+                self.L.logger.info('    No response of {} at: {}, probing all serial ports.'.format(machine, cached['Address']))
+        pump_address = transport.TecanAPISerial.findSerialPumps()
+        address = pump_address[0][0]
+        perif.updateDeviceCacheDB(self.db_path, machine, address, serial_number=serialNumber(address))
+        return address
+
+    def deviceEvent(self, action, address, serial_number):
+        """
+        Record a serial device that is plugged in or removed during the run,
+        called by the device monitor from its own thread, see 
+        startDeviceMonitor(). The event is handled later by 
+        applyDeviceEvents(), so that a serial connection is never re-opened 
+        while the program is using it.
+        Input:
+        `action`(str): 'add' or 'remove'.
+        `address`(str): Address of the device.
+        `serial_number`(str): Serial number of the USB to serial converter.
+        """
+        if serial_number == None:
+            return
+        self.device_events.put((action, address, serial_number))
+
+    def applyDeviceEvents(self):
+        """
+        Handle the devices that are plugged in or removed since the last call,
+        see deviceEvent(). Devices are recognised by the serial number in the
+        Device_cache table. A device that is plugged in again is re-attached 
+        to its (new) address. Called between commands by functionWrap() and
+        secure_sleep(), not while a pump chain is open.
+        """
+        if self.pump_chain_depth > 0:
+            return
+        while True:
+            try:
+                action, address, serial_number = self.device_events.get_nowait()
+            except queue.Empty:
+                return
+            cache = perif.returnDeviceCacheDB(self.db_path)
+            for machine, cached in cache.items():
+                if cached['Serial_number'] != serial_number:
+                    continue
+                if action == 'remove':
+                    self.L.logger.warning('{} disconnected from: {}'.format(machine, address))
+                elif action == 'add':
+                    self.L.logger.info('{} plugged in at: {}'.format(machine, address))
+                    perif.updateDeviceCacheDB(self.db_path, machine, address, serial_number=serial_number)
+                    if machine in self.devices:
+                        try:
+                            self.reattachDevice(machine, address, old_address=cached['Address'])
+                        except Exception as e:
+                            self.L.logger.error('Could not re-attach {}: {}'.format(machine, e))
+
+    def reattachDevice(self, machine, address, old_address=None):
+        """
+        Open the serial connection of an initiated device again, after its USB
+        cable is re-seated. The device is not initiated again, so the pump 
+        and the temperature controllers keep their state.
+        Input:
+        `machine`(str): Name of the machine as in the Machines table.
+        `address`(str): New address of the device.
+        `old_address`(str): Address before the device was removed. 
+            Default = None
+        """
+        if machine in ['CavroXE1000', 'CavroXCalibur']:
+            #TecanAPISerial shares one serial connection per address
+            mapping = getattr(transport.TecanAPISerial, 'ser_mapping', {})
+            for a in set([address, old_address]):
+                mapping.pop(a, None)
+            self.pump.com_link = transport.TecanAPISerial(0, address, 9600)
+        else:
+            attribute = {'MXValve1': 'MXValve1', 'MXValve2': 'MXValve2', 'ThermoCube1': 'TC_1', 
+                         'Oasis1': 'TC_1', 'ThermoCube2': 'TC_2', 'Oasis2': 'TC_2', 'TC720': 'TC720'}[machine]
+            connections = [v for v in vars(getattr(self, attribute)).values() if isinstance(v, serial.Serial)]
+            if connections == []:
+                raise Exception('No serial connection found, restart the program to use {}.'.format(machine))
+            for connection in connections:
+                connection.close()
+                connection.port = address
+                connection.open()
+            if machine in self.valve_position:
+                self.resetValvePosition(machine)
+        self.L.logger.info('{} re-attached at: {}'.format(machine, address))
   
     def getSerialPump_XCalibur(self):
         ''' 
@@ -658,10 +1124,10 @@ class FISH2():
         """
         input('This function will push a tiny air bubble to the hybridization chamber, if it just reaches it you have found the padding volume. Press Enter to continue...')
         self.connectPort(air_port)
-        self.pump.extract(volume_ul = 20 , from_port = 'output', execute=True)
+        self.pumpExtract(20, 'output')
         self.connectPort(target)
-        self.pump.extract(volume_ul = volume, from_port = 'input', execute=True)
-        self.pump.dispense(volume_ul = (volume+20), to_port = 'output', execute=True)
+        self.pumpExtract(volume, 'input')
+        self.pumpDispense((volume+20), 'output')
         print('If the padding volume of {}ul is correct, add it to the "FISH_System_datafile.yaml" for the target: {}. Press Enter to continue...'.format(volume, target))
         
 
@@ -678,16 +1144,16 @@ class FISH2():
         """
         input('Place some liquid (use same viscosity as real experiment) in the system. This function will aspirate the volume and you need to see if the liquid reaches the reservoir tube. The best is if it just reaches the reservoir. Press Enter to continue...')
         self.connectPort(hybmix)
-        self.pump.extract(volume_ul = volume , from_port ='output', execute=True)
+        self.pumpExtract(volume, 'output')
         self.resetReservoir(0)
         self.connectPort(hybmix)
-        self.pump.extract(volume_ul = 150, from_port = 'output', execute=True)
+        self.pumpExtract(150, 'output')
         print('Look at reservoir, if you see an air bubble you need to aspirate more.')
         input('Press enter to continue, this will empty the tubes...')
         
         self.resetReservoir(0)
         self.connectPort(hybmix)
-        self.pump.extract(volume_ul = 1000 , from_port = 'output', execute=True)
+        self.pumpExtract(1000, 'output')
         self.resetReservoir(200)
         print('If the padding volume of {}ul is correct, add it to the "FISH_System_datafile.yaml" for the port: {}. Press Enter to continue...'.format(volume, hybmix))
         
@@ -709,7 +1175,7 @@ class FISH2():
         self.resetReservoir(0)
         self.extractBuffer(air_port, (volume + 200))
         self.connectPort(port)
-        self.pump.dispense(volume_ul=(volume+200), to_port='output', execute=True)
+        self.pumpDispense((volume+200), 'output')
         print('If the padding volume of {}ul is correct, add it to the "FISH_System_datafile.yaml" for the port: {}. Press Enter to continue...'.format(volume, port))
 
 #=============================================================================    
@@ -719,11 +1185,15 @@ class FISH2():
     def push(self, short_message='', long_message=''):
         """
         Wrapper around the send_push() function from peripherals.
+        In a simulation the message is added to the timeline instead.
         Input:
         `short_message`(str): Subject of message.
         `long_message`(str): Body of message.
         """
         sm = '{}: {}'.format(self.system_name, short_message)
+        if self.simulate == True:
+            self.clock.log('Push', '{} {}'.format(sm, long_message).strip())
+            return
         perif.send_push(self.Operator_address, operator = self.Parameters['Operator'],
                        short_message=sm, long_message=long_message)
     
@@ -786,11 +1256,11 @@ class FISH2():
         #Update waste by summing
         if port == self.Ports_reverse['Waste']:
             self.Volumes[port] = self.Volumes[port] + volume
-            perif.updateValueDB(self.db_path, 'Volumes', column = port, operation = '+', value = volume)
+            perif.appendVolumeLedgerDB(self.db_path, port, operation = '+', value = volume)
         #Update buffer by substacting
         else:
             self.Volumes[port] = self.Volumes[port] - volume
-            perif.updateValueDB(self.db_path, 'Volumes', column = port, operation = '-', value = volume)
+            perif.appendVolumeLedgerDB(self.db_path, port, operation = '-', value = volume)
 
         #Check if buffers need replacement
         if check == True:
@@ -826,29 +1296,466 @@ class FISH2():
             return int(port[1:])
 
 
+    def changeValve(self, valve, port):
+        """
+        Move a valve to a port. The move is skipped if the valve is already at
+        that port. If the move fails the position becomes unknown, so that
+        the next move is always sent to the valve.
+        Input:
+        `valve`(str): 'MXValve1' or 'MXValve2'.
+        `port`(int): Port number on the valve, 1-10.
+        """
+        if self.valve_position[valve] == port:
+            self.valve_stats[valve]['skipped'] += 1
+            return
+
+        #Queued pump commands need to finish before the valve moves
+        self.executePumpChain()
+        self.valve_position[valve] = None
+        tic = self.clock.time()
+        getattr(self, valve).change_port(port)
+        self.valve_stats[valve]['move_time'] += self.clock.time() - tic
+        self.valve_stats[valve]['moves'] += 1
+        self.valve_position[valve] = port
+
+    def resetValvePosition(self, valve=None):
+        """
+        Forget the position of the valve(s). Use after the valves are moved 
+        by hand or by another program. The next move is sent to the valve.
+        Input:
+        `valve`(str): 'MXValve1' or 'MXValve2'. If None, resets both valves.
+            Default = None
+        """
+        for v in self.valve_position:
+            if valve == None or v == valve:
+                self.valve_position[v] = None
+        self.connected_port = None
+
+    def valveReport(self, log=True):
+        """
+        Report the number of valve moves and the moves that are skipped 
+        because the valve was already at the right port. The time saved is
+        estimated with the average time of a move.
+        Input:
+        `log`(bool): If True, writes the report to the log. Default = True
+        Returns:
+        `report`(dict): Per valve: moves, skipped, move_time and time_saved in
+            seconds.
+        """
+        report = {}
+        for v, stats in self.valve_stats.items():
+            report[v] = dict(stats)
+            if stats['moves'] > 0:
+                report[v]['time_saved'] = stats['skipped'] * (stats['move_time'] / stats['moves'])
+            else:
+                report[v]['time_saved'] = 0.0
+            if log == True:
+                self.L.logger.info('{}: {} moves, {} skipped moves, saved {}s.'.format(v, report[v]['moves'], 
+                                   report[v]['skipped'], round(report[v]['time_saved'], 1)))
+        return report
+
+    def getTopology(self):
+        """
+        Return the fluidic topology of the system: the valves, the ports and 
+        the routes from the reservoir to the ports. It is made from the Ports
+        and Padding tables and made again when these tables change.
+        MXValve1 is connected to the reservoir. The ports of valve N are 
+        numbered from (N-1)*10+1 to N*10, like P11-P20 for MXValve2. A valve 
+        is connected to the port that has the name "ValveN" in the Ports 
+        table, on any other valve. More valves can be cascaded this way. 
+        Returns:
+        `topology`(dict): Dictionary with:
+            'valves': Per valve: 'link', the port it is connected to, None for
+                MXValve1, and 'ports', a dictionary of valve port: port code.
+            'ports': Per port code: 'valve', 'position' on the valve, 'name' 
+                of the buffer and 'padding' volume of the tube to the target.
+            'routes': Per port code the route, see valveRoute().
+        """
+        if self.topology != None:
+            return self.topology
+
+        valves = {'MXValve1': {'link': None, 'ports': {}}}
+        ports = {}
+        for p, name in self.Ports.items():
+            match = re.match(r'^P(\d+)$', p)
+            if match == None:
+                continue #RunningBuffer is connected to the pump
+            number = int(match.group(1))
+            valve = 'MXValve{}'.format((number - 1) // self.valve_size + 1)
+            position = (number - 1) % self.valve_size + 1
+            valves.setdefault(valve, {'link': None, 'ports': {}})['ports'][position] = p
+            ports[p] = {'valve': valve, 'position': position, 'name': name, 'padding': self.Padding.get(p)}
+        #Links between the valves
+        for p, info in ports.items():
+            match = re.match(r'^Valve(\d+)$', '{}'.format(info['name']))
+            if match != None:
+                valves.setdefault('MXValve{}'.format(match.group(1)), {'link': None, 'ports': {}})['link'] = p
+
+        #Routes from the reservoir to every port that can be reached
+        routes = {}
+        for p in ports:
+            route = []
+            current = p
+            while current != None and len(route) <= len(valves):
+                info = ports[current]
+                route.insert(0, (info['valve'], info['position']))
+                if info['valve'] == 'MXValve1':
+                    routes[p] = route
+                    break
+                current = valves[info['valve']]['link']
+
+        #Keep track of the position of all valves
+        for v in valves:
+            if v not in self.valve_position:
+                self.valve_position[v] = None
+                self.valve_stats[v] = {'moves': 0, 'skipped': 0, 'move_time': 0.0}
+        self.topology = {'valves': valves, 'ports': ports, 'routes': routes}
+        return self.topology
+
+    def valveRoute(self, target):
+        """
+        Return the valve positions that connect the reservoir to a target.
+        The routes are cached, see getTopology().
+        Input:
+        `target`(str): Either the port number (P1-P20) or
+            the buffer name as in the 'Ports' dictionary.
+        Returns:
+        `route`(list): List of (valve, port) tuples in the order the valves
+            are moved.
+        """
+        port = self.getPort(target)
+        topology = self.getTopology()
+        if port not in topology['routes']:
+            if port not in topology['ports']:
+                raise(ValueError('Target {} is not connected to a valve.'.format(target)))
+            valve = topology['ports'][port]['valve']
+            if topology['valves'][valve]['link'] == None:
+                name = 'Valve{}'.format(valve[len('MXValve'):])
+                raise(ValueError('Connection to "{0}" is not defined. Add "{0}" to the Ports table.'.format(name)))
+            raise(ValueError('Target {} can not be reached from MXValve1, check the "Valve" ports in the Ports table.'.format(target)))
+        return list(topology['routes'][port])
+
+    def valveTravel(self, targets, home='Waste'):
+        """
+        Count the rotation steps of the valves to visit the targets in the 
+        given order, starting from the current valve positions. Nothing is 
+        moved. Moves from an unknown position are not counted.
+        Input:
+        `targets`(list): Ports or buffer names as in the 'Ports' dictionary.
+        `home`(str): Target that is visited after every target, like the 
+            Waste by resetReservoir(). None if there is no such target.
+            Default = 'Waste'
+        Returns:
+        `steps`(dict): Rotation steps per valve.
+        """
+        self.getTopology()
+        position = dict(self.valve_position)
+        steps = {v: 0 for v in position}
+        visits = []
+        for t in targets:
+            visits.append(t)
+            if home != None:
+                visits.append(home)
+        for t in visits:
+            if self.getPort(t) == 'RunningBuffer':
+                continue
+            for valve, valve_port in self.valveRoute(t):
+                if position[valve] != None:
+                    steps[valve] += valveSteps(position[valve], valve_port)
+                position[valve] = valve_port
+        return steps
+
+    def orderPorts(self, targets, home='Waste', log=True):
+        """
+        Order the targets of a multi-port operation, like priming or 
+        cleaning, for the least valve rotation. The ports behind a cascaded
+        valve are visited as a group. RunningBuffer has no valve port and 
+        goes first.
+        Nothing is moved, so it can be used as a dry run. The given order is
+        kept if it is not improved.
+        Input:
+        `targets`(list): Ports or buffer names as in the 'Ports' dictionary.
+        `home`(str): Target that is visited after every target, like the 
+            Waste by resetReservoir(). None if there is no such target.
+            Default = 'Waste'
+        `log`(bool): If True, writes the estimated rotation steps to the log.
+            Default = True
+        Returns:
+        `ordered`(list): The targets in the order to visit them.
+        """
+        def order(items, depth, home_port=None):
+            #Group the targets per port of the valve at this depth. The 
+            #targets behind a cascaded valve are one stop for this valve.
+            stops = {}
+            for route, t in items:
+                stops.setdefault(route[depth][1], []).append((route, t))
+            stops = list(stops.items())
+            start = self.valve_position.get(items[0][0][depth][0])
+            if home_port != None:
+                #The valve returns home after every stop, only the first stop
+                #depends on where the valve is now
+                sequence = sweepOrder(home_port, stops)
+                if start != None:
+                    first = min(stops, key=lambda x: valveSteps(start, x[0]) - valveSteps(x[0], home_port))
+                    sequence.remove(first[1])
+                    sequence.insert(0, first[1])
+            else:
+                sequence = sweepOrder(start, stops)
+            result = []
+            for group in sequence:
+                result += [t for route, t in group if len(route) == depth + 1]
+                deeper = [(route, t) for route, t in group if len(route) > depth + 1]
+                if deeper != []:
+                    result += order(deeper, depth + 1)
+            return result
+
+        ordered = [t for t in targets if self.getPort(t) == 'RunningBuffer']
+        routed = [(self.valveRoute(t), t) for t in targets if self.getPort(t) != 'RunningBuffer']
+        #Nothing to order without valve ports, like when no port or only the
+        #RunningBuffer is selected
+        if routed == []:
+            return ordered
+        home_port = None
+        if home != None and self.getPort(home) != 'RunningBuffer':
+            home_route = self.valveRoute(home)
+            if len(home_route) == 1:
+                home_port = home_route[0][1]
+        ordered += order(routed, 0, home_port)
+
+        before = sum(self.valveTravel(targets, home=home).values())
+        after = sum(self.valveTravel(ordered, home=home).values())
+        if after > before:
+            ordered = list(targets)
+            after = before
+        if log == True:
+            self.L.logger.info('    Valve rotation for {} ports: {} steps in the given order, {} steps optimised, {} steps saved.'.format(
+                               len(targets), before, after, before - after))
+        return ordered
+
+    @contextmanager
+    def chainPump(self):
+        """
+        Collect the pump commands of the fluid handling functions and send 
+        them to the pump as one command string, instead of one serial round 
+        trip per command. Works for the CavroXE1000 and CavroXCalibur with the
+        command chain of the tecancavro package.
+        The chain is executed when the block ends, before a valve moves and 
+        by any pump command with execute=True. Blocks can be nested. If an 
+        error occurs the queued commands are not executed.
+        If the pump does not support chaining, commands are executed one by one.
+        Example:
+        with self.chainPump():
+            self.extractBuffer('RunningBuffer', 200)
+            self.dispenseBuffer('Waste', 200)
+        """
+        if not hasattr(self.pump, 'executeChain'):
+            yield
+            return
+
+        self.pump_chain_depth += 1
+        try:
+            yield
+        except BaseException:
+            self.pump_chain_depth -= 1
+            if self.pump_chain_depth == 0:
+                self.discardPumpChain()
+            raise
+        else:
+            self.pump_chain_depth -= 1
+            if self.pump_chain_depth == 0:
+                self.sendPumpChain()
+
+    def sendPumpChain(self):
+        """
+        Send the pump commands queued by chainPump() to the pump. If the pump
+        fails, the chain is discarded, see discardPumpChain().
+        """
+        try:
+            self.pump.executeChain()
+        except BaseException:
+            self.discardPumpChain()
+            raise
+
+    def discardPumpChain(self):
+        """
+        Discard the queued pump commands. The mirrored pump state and the 
+        reservoir content are reset, because they already include the queued
+        commands that the pump did not (all) execute.
+        """
+        self.pump.resetChain()
+        self.resetPumpState()
+        self.reservoir_content = None
+
+    def pumpExecute(self):
+        """
+        Returns the `execute` argument for pump commands. False inside a 
+        chainPump() block, so that the command is added to the chain.
+        """
+        return self.pump_chain_depth == 0
+
+    def executePumpChain(self):
+        """
+        Execute the pump commands queued by chainPump(). Use before actions 
+        that need the pump to be finished, like moving a valve or reading a 
+        setting of the pump.
+        """
+        if self.pump_chain_depth > 0 and getattr(self.pump, 'cmd_chain', True):
+            self.sendPumpChain()
+
+    def getPumpSpeed(self):
+        """
+        Returns the speed of the pump. The pump is only queried if the speed
+        is not known, see pump_state.
+        """
+        if self.pump_state['speed'] == None:
+            self.executePumpChain()
+            self.pump_state['speed'] = self.pump.getSpeed()
+            self.pump_stats['queries'] += 1
+        else:
+            self.pump_stats['skipped_queries'] += 1
+        return self.pump_state['speed']
+
+    def setPumpSpeed(self, speed):
+        """
+        Set the speed of the pump. Skipped if the pump already has that speed.
+        Input:
+        `speed`(int): Speed code of the pump, refer to the pump manual.
+        """
+        if self.pump_state['speed'] == speed:
+            self.pump_stats['skipped_commands'] += 1
+            return
+        self.pump_state['speed'] = None
+        self.pump.setSpeed(speed, execute=self.pumpExecute())
+        self.pump_state['speed'] = speed
+
+    def getPumpBacklash(self):
+        """
+        Returns the backlash steps of the pump. The pump is only queried if 
+        the backlash is not known, see pump_state.
+        """
+        if self.pump_state['backlash'] == None:
+            self.executePumpChain()
+            self.pump_state['backlash'] = self.pump.getBacklashSteps()
+            self.pump_stats['queries'] += 1
+        else:
+            self.pump_stats['skipped_queries'] += 1
+        return self.pump_state['backlash']
+
+    def setPumpBacklash(self, steps):
+        """
+        Set the backlash steps of the pump. Skipped if the pump already has 
+        that backlash.
+        Input:
+        `steps`(int): Number of backlash steps.
+        """
+        if self.pump_state['backlash'] == steps:
+            self.pump_stats['skipped_commands'] += 1
+            return
+        self.pump_state['backlash'] = None
+        self.pump.setBacklashSteps(steps, execute=self.pumpExecute())
+        self.pump_state['backlash'] = steps
+
+    def pumpExtract(self, volume, from_port):
+        """
+        Aspirate with the pump and update the plunger position and port.
+        Input:
+        `volume`(int): Volume in ul.
+        `from_port`(str): Port of the pump, 'input' or 'output'.
+        """
+        self.pump.extract(volume_ul = volume, from_port = from_port, execute=self.pumpExecute())
+        if self.pump_state['plunger'] != None:
+            self.pump_state['plunger'] += volume
+        self.pump_state['port'] = from_port
+        #The output of the pump draws through the reservoir
+        if from_port == 'output' and volume > 0:
+            self.reservoir_content = self.Ports.get(self.connected_port)
+
+    def pumpDispense(self, volume, to_port):
+        """
+        Dispense with the pump and update the plunger position and port.
+        Input:
+        `volume`(int): Volume in ul.
+        `to_port`(str): Port of the pump, 'input' or 'output'.
+        """
+        self.pump.dispense(volume_ul = volume, to_port = to_port, execute=self.pumpExecute())
+        if self.pump_state['plunger'] != None:
+            self.pump_state['plunger'] = max(0, self.pump_state['plunger'] - volume)
+        self.pump_state['port'] = to_port
+
+    def pumpChangePort(self, to_port):
+        """
+        Switch the port of the pump.
+        Input:
+        `to_port`(str): Port of the pump, 'input' or 'output'.
+        """
+        self.pump.changePort(to_port, execute=self.pumpExecute())
+        self.pump_state['port'] = to_port
+
+    def pumpMovePlungerAbs(self, position):
+        """
+        Move the plunger to an absolute position.
+        Input:
+        `position`(int): Position in steps, 0 is an empty syringe.
+        """
+        self.pump.movePlungerAbs(position, execute=self.pumpExecute())
+        self.pump_state['plunger'] = 0 if position == 0 else None
+
+    def resetPumpState(self):
+        """
+        Forget the state of the pump. The next read of a setting is sent to
+        the pump. Used when queued pump commands are discarded.
+        """
+        for k in self.pump_state:
+            self.pump_state[k] = None
+
+    def resyncPump(self):
+        """
+        Read the state of the pump again. Use after an error, or after the 
+        pump is operated by hand or by another program. The plunger position
+        is only read if the pump supports it, the port becomes unknown.
+        Returns:
+        `pump_state`(dict): Speed, backlash, plunger (ul) and port.
+        """
+        self.executePumpChain()
+        self.resetPumpState()
+        self.getPumpSpeed()
+        self.getPumpBacklash()
+        try:
+            full_stroke = self.pump._ulToSteps(self.pump.syringe_ul)
+            self.pump_state['plunger'] = self.pump.getPlungerPos() * self.pump.syringe_ul / full_stroke
+            self.pump_stats['queries'] += 1
+        except AttributeError:
+            pass
+        self.L.logger.info('Pump state: {}'.format(self.pump_state))
+        return dict(self.pump_state)
+
+    def pumpReport(self, log=True):
+        """
+        Report the number of pump queries and the queries and commands that
+        are skipped because the state of the pump was known.
+        Input:
+        `log`(bool): If True, writes the report to the log. Default = True
+        Returns:
+        `report`(dict): queries, skipped_queries and skipped_commands.
+        """
+        report = dict(self.pump_stats)
+        if log == True:
+            self.L.logger.info('Pump: {} queries, {} skipped queries, {} skipped commands.'.format(
+                               report['queries'], report['skipped_queries'], report['skipped_commands']))
+        return report
+
     def connectPort(self, target):
         """
         Function to connects the reservoir to the target buffer.
+        Valves that are already at the right port are not moved.
         Input:
         `target`(str): Either the port number (P1-P20) or
             the buffer name as in the 'Ports' dictionary.
         """
-        #Get the number of the port
-        port = self.getPort(target, port_number=True)
-
-        #Change port
-        if  port > 10:
-            #Check if valve 2 is connected
-            if 'Valve2' not in self.Ports.values():
-                raise(ValueError('Connection to "Valve2" is not defined. Add "Valve2" to the Ports table.'))
-            #Connect valve 1 with valve 2
-            port_valve2 = self.getPort('Valve2', port_number=True)
-            self.MXValve1.change_port(port_valve2)
-            #Connect to the right port on valve 2
-            self.MXValve2.change_port(port - 10)
-        else:
-            #Connect to the right port on valve 1
-            self.MXValve1.change_port(port)
+        self.connected_port = None
+        for valve, valve_port in self.valveRoute(target):
+            self.changeValve(valve, valve_port)
+        self.connected_port = self.getPort(target)
     
     def extractBuffer(self, buffer, volume, bubble = False, bubble_volume = 30):
         """
@@ -864,7 +1771,7 @@ class FISH2():
             self.airBubble(bubble_volume = bubble_volume)
 
         self.connectPort(buffer) #Change to port of buffer
-        self.pump.extract(volume_ul = volume, from_port = 'output', execute=True)        
+        self.pumpExtract(volume, 'output')
         
     def dispenseBuffer(self, target, volume):
         """
@@ -876,7 +1783,7 @@ class FISH2():
         `volume`(int): volume in ul to dispense.
         """
         self.connectPort(target)
-        self.pump.dispense(volume_ul = volume, to_port= 'output', execute=True)       
+        self.pumpDispense(volume, 'output')
 
     def padding(self, target):
         """
@@ -889,7 +1796,7 @@ class FISH2():
         """
         target = self.getPort(target)
         volume = self.Padding[self.getPort(target)]
-        self.pump.extract(volume_ul = volume, from_port = 'input', execute=True)
+        self.pumpExtract(volume, 'input')
         return volume    
 
     def airBubble(self, bubble_volume = 30): #Not advised to use air bubble
@@ -908,10 +1815,11 @@ class FISH2():
 
         #When working with air, a backlash is not desired as it might pump some buffer
         #into the air filter, because the backlash is bigger than the air volume.
-        original_backlash = self.pump.getBacklashSteps()
-        self.pump.setBacklashSteps(0, execute=True)
-        self.pump.extract(volume_ul = bubble_volume, from_port = 'output', execute=True)
-        self.pump.setBacklashSteps(original_backlash, execute=True)  
+        original_backlash = self.getPumpBacklash()
+        with self.chainPump():
+            self.setPumpBacklash(0)
+            self.pumpExtract(bubble_volume, 'output')
+            self.setPumpBacklash(original_backlash)
 
     def resetReservoir(self, replace_volume = 200, update_buffer = False):
         """
@@ -925,15 +1833,116 @@ class FISH2():
         if not 0 <= replace_volume <= (max_volume + 1):
                 raise(ValueError('`replace_volume` must be between 0 and {}'.format(max_volume)))
         self.connectPort('Waste') #Change to waste port
-        self.pump.changePort('output', execute=True) #change to output
-        self.pump.movePlungerAbs(0, execute=True) #return pump to 0
-        if replace_volume > 0: 
-            self.pump.extract(volume_ul = replace_volume, from_port = 'input', execute=True)
-            self.pump.dispense(volume_ul= replace_volume, to_port = 'output', execute=True)
+        #Send as one command to the pump
+        with self.chainPump():
+            self.pumpChangePort('output') #change to output
+            self.pumpMovePlungerAbs(0) #return pump to 0
+            if replace_volume > 0: 
+                self.pumpExtract(replace_volume, 'input')
+                self.pumpDispense(replace_volume, 'output')
+        if replace_volume > 0:
+            self.reservoir_content = self.Ports.get('RunningBuffer')
         if update_buffer == True:
             self.updateBuffer('RunningBuffer', replace_volume, check=False)  
             self.updateBuffer('Waste', replace_volume, check=False)
 
+    def reservoirCompatible(self, next_buffer):
+        """
+        Check if a buffer can be drawn into the reservoir without flushing it
+        first. That is the case if the reservoir is clean (the last flush has
+        not been followed by another buffer), if it contains the same buffer,
+        or if the flush_rules allow the buffer after the reservoir content.
+        Input:
+        `next_buffer`(str): Buffer name or port. Like: 'WB' or 'P2'.
+        Returns:
+        True if the flush can be skipped.
+        """
+        next_buffer = self.Ports.get(next_buffer, next_buffer)
+        content = self.reservoir_content
+        if content == None:
+            return False
+        if content == self.Ports.get('RunningBuffer') or content == next_buffer:
+            return True
+        return next_buffer in self.flush_rules.get(content, [])
+
+    def flushReservoir(self, replace_volume=50, next_buffer=None):
+        """
+        Flush the reservoir with RunningBuffer before a buffer is drawn into
+        it, to prevent contamination and air bubbles. The flush is skipped if
+        it does not add anything, see reservoirCompatible(). The syringe is 
+        always emptied.
+        Input:
+        `replace_volume`(int): Volume of the flush. Default = 50
+        `next_buffer`(str): Buffer name or port that will be drawn into the
+            reservoir. If None, always flushes. Default = None
+        Returns:
+        `flushed`(int): Volume of RunningBuffer used, 0 if skipped.
+        """
+        if next_buffer != None and self.reservoirCompatible(next_buffer):
+            if self.pump_state['plunger'] != 0:
+                self.resetReservoir(replace_volume=0)
+            self.flush_stats['skipped'] += 1
+            self.flush_stats['volume_saved'] += replace_volume
+            return 0
+
+        tic = self.clock.time()
+        self.resetReservoir(replace_volume=replace_volume)
+        self.flush_stats['flush_time'] += self.clock.time() - tic
+        self.flush_stats['flushes'] += 1
+        return replace_volume
+
+    def flushReport(self, log=True):
+        """
+        Report the number of reservoir flushes that are skipped because they 
+        would not add anything. The time saved is estimated with the average 
+        time of a flush.
+        Input:
+        `log`(bool): If True, writes the report to the log. Default = True
+        Returns:
+        `report`(dict): flushes, skipped, flush_time, volume_saved in ul of 
+            RunningBuffer and time_saved in seconds.
+        """
+        report = dict(self.flush_stats)
+        if report['flushes'] > 0:
+            report['time_saved'] = report['skipped'] * (report['flush_time'] / report['flushes'])
+        else:
+            report['time_saved'] = 0.0
+        if log == True:
+            self.L.logger.info('Reservoir: {} flushes, {} skipped flushes, saved {}ul RunningBuffer and {}s.'.format(
+                               report['flushes'], report['skipped'], report['volume_saved'], round(report['time_saved'], 1)))
+        return report
+
+    def planStrokes(self, volume, padding=0):
+        """
+        Split a transfer that does not fit in the syringe into the fewest pump
+        strokes. All strokes are full except the last one, which also takes 
+        the padding volume. Only the last stroke needs padding, the buffer of 
+        the other strokes stays in the tubes and is pushed to the target by 
+        the next stroke. If only the padding does not fit, the last stroke 
+        is only the padding.
+        Input:
+        `volume`(int): Volume to transfer in ul.
+        `padding`(int): Padding volume in ul. Default = 0
+        Returns:
+        `strokes`(list): List with a (volume, padding) tuple per stroke.
+        """
+        max_volume = self.pump.syringe_ul
+        if not 0 <= padding <= (max_volume + 1) or volume < 0:
+            raise(ValueError('''Invalid transfer, the volume can not be negative and 
+                the padding volume can not be more than: {}ul.\n
+                Volume to pipette: {}ul and padding volume: {}ul.'''.format(max_volume, volume, padding)))
+        strokes = []
+        while volume + padding > (max_volume + 1):
+            stroke = min(max_volume, volume)
+            strokes.append((stroke, 0))
+            volume -= stroke
+        strokes.append((volume, padding))
+        if any(v < 0 for v, p in strokes):
+            raise ValueError('Invalid stroke plan, negative stroke volume: {}'.format(strokes))
+        if len(strokes) > 1:
+            self.L.logger.info('    Transfer of {}ul split in {} strokes.'.format(sum(v + p for v, p in strokes), len(strokes)))
+        return strokes
+
 #=============================================================================
 # Function decorator
 #=============================================================================
@@ -964,33 +1973,47 @@ class FISH2():
         @wraps(function)
         def wrapped(self, *args, **kwargs):
             #Check if user paused the experiment
-            count = 0
+            pause_start = time.time()
+            next_reminder = 600
+            announced = False
             while True:
-                pause = perif.returnDictDB(self.db_path, 'Flags')[0]['Pause_flag']
+                pause = self.getFlags()['Pause_flag']
                 if pause == 1:
-                    if count == 0:
+                    paused = time.time() - pause_start
+                    if announced == False:
                         print('Experiment paused. Continue the experiment in the user program.')
-                    time.sleep(1)
-                    count += 1
+                        announced = True
                     #Check for errors on the system and send a pause reminder after 10min, every 10min.
-                    if count >= 600 and (count%600) == 0: 
+                    if paused >= next_reminder:
+                        next_reminder += 600
+                        self.applyDeviceEvents()
                         self.check_error(35, 5, 10)
-                        self.L.logger.info('Experiment paused by user. Already {} minutes.'.format(round(count/6)))
+                        self.L.logger.info('Experiment paused by user. Already {} minutes.'.format(round(paused/60)))
                         self.push(short_message= 'Experiment paused', 
-                                  long_message='Experiment is still paused by user. Already {} minutes.'.format(round(count/6)))
+                                  long_message='Experiment is still paused by user. Already {} minutes.'.format(round(paused/60)))
+                    #Wake up as soon as the user program changes the database
+                    perif.waitChangeDB(self.db_path, self.db_version, timeout=(next_reminder - paused))
                 else:
                     break
+            #The user could have moved the valves during the pause
+            if announced == True:
+                self.resetValvePosition()
+                self.reservoir_content = None
+            #Re-attach the devices that were plugged in again
+            self.applyDeviceEvents()
 
             #Update
             self.updateExperimentalParameters(self.db_path, ignore_flags=False)
             
             #Prime buffers if the prime flag has been set for the specific buffer
-            current_flags = perif.returnDictDB(self.db_path, 'Flags')[0]
-            for p in self.Ports:
-                if current_flags[p] == 1:
-                    self.prime(p)
-                    perif.removeFlagDB(self.db_path, p)
-                    self.L.logger.info('Primed port {} connected to {} buffer after replacement.'.format(p, self.Ports[p]))
+            current_flags = self.getFlags()
+            flagged = [p for p in self.Ports if current_flags[p] == 1]
+            if len(flagged) > 1:
+                flagged = self.orderPorts(flagged)
+            for p in flagged:
+                self.prime(p)
+                perif.removeFlagDB(self.db_path, p)
+                self.L.logger.info('Primed port {} connected to {} buffer after replacement.'.format(p, self.Ports[p]))
 
             #Input handling
             if 'd' in kwargs:
@@ -1017,9 +2040,11 @@ class FISH2():
             total_sleep = sleep_d + sleep_h + sleep_m + sleep_s
                 
             #Execute wrapped function
-            tic = time.time()
+            if self.simulate == True:
+                self.clock.log('FISH2', '{}{}'.format(function.__name__, args))
+            tic = self.clock.time()
             r = function(self, *args, **kwargs)     
-            toc = time.time()
+            toc = self.clock.time()
             execution_time = toc - tic
             #A function can only take 10% of the incubation time it is given.
             #If it extends that it will be set to 10% of the incubation time.
@@ -1050,34 +2075,30 @@ class FISH2():
         `volume`(int): volume to extract and dispense.
         `target`(str): target port as in the 'ports' dictionary.
         `padding`(bool): True if padding needs to be used to reach target.
+        Volumes that do not fit in the syringe are split in multiple strokes,
+        see planStrokes().
         """
-        #Check if the max volume of the syringe is not exceeded.
-        max_volume = self.pump.syringe_ul
+        #Split in strokes if the max volume of the syringe is exceeded.
         if padding == True:
-            volume_to_aspirate = volume + self.Padding[self.getPort(target)]
-            padding_error = 'and padding volume: {}ul.'.format(self.Padding[self.getPort(target)])
+            pad = self.Padding[self.getPort(target)]
         else:
-            volume_to_aspirate = volume
-            padding_error = ''
-        if not 0 <= volume_to_aspirate <= (max_volume + 1):
-            raise(ValueError('''Pump syringe volume exceeded.\n
-                The target volume and padding can not be more than: {}ul.\n
-                Volume to pipette: {}ul {}'''.format(max_volume, volume, padding_error)))
+            pad = 0
+        strokes = self.planStrokes(volume, pad)
                 
         #Discard 50ul of Running buffer to make sure it is clean and without air bubbles.
-        self.resetReservoir(replace_volume = 50)
-        #Extract
-        self.pump.extract(volume_ul=volume, from_port='input', execute=True)
-        if padding == True:
-            pad = self.padding(target)
-        else:
-            pad = 0
-        #Dispense
+        flushed = self.flushReservoir(replace_volume = 50, next_buffer='RunningBuffer')
+        for stroke_volume, stroke_pad in strokes:
+            #Extract
+            if stroke_volume > 0:
+                self.pumpExtract(stroke_volume, 'input')
+            if stroke_pad > 0:
+                self.padding(target)
+            #Dispense
+            self.dispenseBuffer(target, stroke_volume + stroke_pad)
         total_vol = volume + pad
-        self.dispenseBuffer(target, total_vol)
         #Data handling
-        self.updateBuffer('Waste', (total_vol+50), check=False)
-        self.updateBuffer('RunningBuffer', (total_vol+50), check=True)
+        self.updateBuffer('Waste', (total_vol+flushed), check=False)
+        self.updateBuffer('RunningBuffer', (total_vol+flushed), check=True)
         self.L.logger.info('    Dispensed {}ul of {} to {}, with speed {}, padding={}.'.format(volume, self.Ports['RunningBuffer'], target, self.pump.speed, pad))   
  
     @functionWrap
@@ -1103,68 +2124,248 @@ class FISH2():
             wash of a series to completely exchange the previous buffer.
         `speed`(int): dispense speed. Unit depends on the specific pump used
             refer the pump specific speeds.
+        Volumes that do not fit in the syringe are split in multiple strokes,
+        see planStrokes().
         """
-        #Check if the max volume of the syringe is not exceeded.
-        max_volume = self.pump.syringe_ul
-        volume_to_aspirate = (volume + (volume * int(double_volume)))+ (self.Padding[self.getPort(target)] * (int(padding)))
-        if not 0 <= volume_to_aspirate <= (max_volume + 1):
-            raise(ValueError('''Pump syringe volume exceeded.\n
-                The volume and padding can not be more than: {}ul.\n
-                Volume to pipette: {}ul and padding volume: {}ul.'''.format(max_volume, volume, self.Padding[self.getPort(target)])))
-
-        #Flush 50ul buffer to prevent any contamination.
-        self.resetReservoir(replace_volume=50)
-        #Extract buffer
+        #Split in strokes if the max volume of the syringe is exceeded.
         if double_volume == True:
             volume = volume * 2
-        self.extractBuffer(buffer, volume, bubble=False)
-
-        #Creates a padding volume in syringe to bridge the tubes between reservoir and target
         if padding == False:
             pad = 0
         else:
-            if same_buffer_padding == True: #Same buffer as padding (for next washing cycle)
-                pad = self.Padding[self.getPort(target)]
-                self.extractBuffer(buffer, pad, bubble=False)
-            else: #RunningBuffer as padding
-                pad = self.padding(target)
+            pad = self.Padding[self.getPort(target)]
+        strokes = self.planStrokes(volume, pad)
 
         if speed != None: 
             if not self.pump.min_speed <= speed <= self.pump.max_speed:
                 print('speed: {}, self.pump.speed: {}'.format(speed, self.pump.speed))
                 raise ValueError('Invalid speed: "{}", Speed should be between {} and {}'.format(speed, self.pump.min_speed, self.pump.max_speed))
-
-            #Change speed
-            if 'CavroXCalibur' in self.devices:
-                cached_speed = self.pump.getSpeed()
-                print('caching pump speed, check if this is OK: {}'.format(cached_speed))
-            if 'CavroXE1000' in self.devices:
-                cached_speed = self.pump.getSpeed()
-                print('caching pump speed, check if this is OK: {}'.format(cached_speed))
-            self.pump.setSpeed(speed, execute=True)
-            #Dispense buffer
-            total_volume = volume + pad 
-            self.dispenseBuffer(target, total_volume)
-            self.pump.setSpeed(cached_speed, execute=True)
+            cached_speed = self.getPumpSpeed()
         else:
+            speed = self.getPumpSpeed()
+            cached_speed = speed
+
+        #Flush 50ul buffer to prevent any contamination.
+        flushed = self.flushReservoir(replace_volume=50, next_buffer=buffer)
+        for stroke_volume, stroke_pad in strokes:
+            #Extract buffer
+            if stroke_volume > 0:
+                self.extractBuffer(buffer, stroke_volume, bubble=False)
+
+            #Creates a padding volume in syringe to bridge the tubes between reservoir and target
+            if stroke_pad > 0:
+                if same_buffer_padding == True: #Same buffer as padding (for next washing cycle)
+                    self.extractBuffer(buffer, stroke_pad, bubble=False)
+                else: #RunningBuffer as padding
+                    self.padding(target)
+
             #Dispense buffer
-            speed = self.pump.speed
-            total_volume = volume + pad 
-            self.dispenseBuffer(target, total_volume)
+            self.setPumpSpeed(speed)
+            self.dispenseBuffer(target, stroke_volume + stroke_pad)
+            self.setPumpSpeed(cached_speed)
             
         if padding == False:
-            self.updateBuffer(buffer, (volume+50), check=False)
-            self.updateBuffer('Waste', (volume+50), check = True)
+            self.updateBuffer(buffer, (volume+flushed), check=False)
+            self.updateBuffer('Waste', (volume+flushed), check = True)
         else:
             if same_buffer_padding == True:
-                self.updateBuffer(buffer, (volume+50+pad), check=False)
-                self.updateBuffer('Waste', (volume+50+pad), check = True)
+                self.updateBuffer(buffer, (volume+flushed+pad), check=False)
+                self.updateBuffer('Waste', (volume+flushed+pad), check = True)
             else:
-                self.updateBuffer(buffer, (volume+50), check=False)
+                self.updateBuffer(buffer, (volume+flushed), check=False)
                 self.updateBuffer('RunningBuffer', pad, check=False)
-                self.updateBuffer('Waste', (volume+50+pad), check = True)
+                self.updateBuffer('Waste', (volume+flushed+pad), check = True)
         self.L.logger.info('    Dispensed {}ul of {} to {} with speed {}, padding={}, same_buffer_padding={}, double_volume={}'.format(volume, buffer, target, speed, padding, same_buffer_padding, double_volume))
 
+    @functionWrap
+    def washBuffer(self, buffer, volume, target, cycles, incubation_time=0, speed=None, preload=True):
+        """
+        Wash the target a number of times with the same buffer. Does the same
+        as a loop of: 
+        extractDispenseBuffer(buffer, volume, target, padding=False, m=incubation_time)
+        But the pause and flag checks and the buffer bookkeeping are done once
+        for the whole series. The incubation of every cycle is timed like 
+        functionWrap() does for a single function.
+        Input:
+        `buffer`(str): buffer/port as in the 'ports' dictionary. Like: 'WB'
+        `volume`(int): volume to dispense per cycle.
+        `target`(str): target port as in the 'ports' dictionary. Like: 'Chamber1'
+        `cycles`(int): Number of washes.
+        `incubation_time`(int/float): Minutes of incubation per cycle. 
+            Default = 0
+        `speed`(int): dispense speed. Unit depends on the specific pump used
+            refer the pump specific speeds. Default = None
+        `preload`(bool): If True, the buffer for as many cycles as fit in the
+            syringe is aspirated at once, so that the valve stays on the 
+            target between these cycles. Use False for buffers that should not
+            wait in the reservoir. Not used with an incubation time in 
+            runCooperative(), the other protocols can not use the pump while
+            buffer waits in the syringe. Default = True
+        """
+        if speed != None:
+            if not self.pump.min_speed <= speed <= self.pump.max_speed:
+                raise ValueError('Invalid speed: "{}", Speed should be between {} and {}'.format(speed, self.pump.min_speed, self.pump.max_speed))
+            cached_speed = self.getPumpSpeed()
+        else:
+            speed = self.getPumpSpeed()
+            cached_speed = speed
+        incubation = incubation_time * 60
+
+        #Number of cycles per aspiration
+        if preload == True and (self.coop == None or incubation == 0):
+            per_load = max(1, int((self.pump.syringe_ul + 1) // volume))
+        else:
+            per_load = 1
+        loaded = 0
+        used = 0
+        try:
+            for c in range(cycles):
+                tic = self.clock.time()
+                if loaded == 0:
+                    loaded = min(per_load, cycles - c)
+                    used += self.flushReservoir(replace_volume=50, next_buffer=buffer)
+                    preloaded = loaded > 1
+                    if preloaded == True:
+                        self.extractBuffer(buffer, loaded * volume, bubble=False)
+
+                #Dispense buffer, in one or more strokes if not preloaded
+                if preloaded == True:
+                    strokes = [(volume, 0)]
+                else:
+                    strokes = self.planStrokes(volume)
+                for stroke_volume, stroke_pad in strokes:
+                    if preloaded == False:
+                        self.extractBuffer(buffer, stroke_volume, bubble=False)
+                    self.setPumpSpeed(speed)
+                    self.dispenseBuffer(target, stroke_volume)
+                    self.setPumpSpeed(cached_speed)
+                loaded -= 1
+                used += volume
+                self.L.logger.info('    Wash {}/{}: dispensed {}ul of {} to {} with speed {}'.format(c + 1, cycles, volume, buffer, target, speed))
+
+                #Incubate, the fluid handling can take up to 10% of the incubation time
+                execution_time = min(self.clock.time() - tic, 0.1 * incubation)
+                if incubation - execution_time > 0:
+                    self.secure_sleep(incubation - execution_time, period=120, alarm_room_temperature=35, temperature_range=5, number_of_messages=10)
+        finally:
+            #Data handling, also for the finished cycles if a cycle fails
+            if used > 0:
+                self.updateBuffer(buffer, used, check=False)
+                self.updateBuffer('Waste', used, check=True)
+
+    @functionWrap
+    def extractDispenseSplit(self, buffer, volume, targets, padding=True, same_buffer_padding=False, speed=None):
+        """
+        Dispense the same buffer to multiple targets from one aspiration. Does
+        the same as extractDispenseBuffer() or extractDispenseRunningBuffer()
+        for every target, but the buffer for all targets that fit in the 
+        syringe is aspirated at once and then dispensed to the targets in 
+        sequence. Saves pump strokes and reservoir flushes, for example when
+        both chambers get the same buffer.
+        Input:
+        `buffer`(str): buffer/port as in the 'ports' dictionary, or 
+            'RunningBuffer'. Like: 'SSC'
+        `volume`(int/list): volume to dispense to every target, or a list with
+            the volume per target.
+        `targets`(list): target ports as in the 'ports' dictionary. 
+            Like: ['Chamber1', 'Chamber2']
+        `padding`(bool): Whether or not to use a padding volume.
+        `same_buffer_padding`(bool): If True, uses the same buffer for the
+            padding volume, otherwise it uses RunningBuffer.
+        `speed`(int): dispense speed. Unit depends on the specific pump used
+            refer the pump specific speeds. Default = None
+        RunningBuffer can only be aspirated behind the buffer, so only the last
+        target of an aspiration gets RunningBuffer as padding. The tubes to the
+        other targets are padded with the buffer itself, like with 
+        same_buffer_padding. The targets still get the same volume of buffer.
+        A target that does not fit in the syringe on its own is done in 
+        multiple strokes, see planStrokes().
+        """
+        if isinstance(volume, list):
+            if len(volume) != len(targets):
+                raise ValueError('Give one volume per target. Volumes: {}, targets: {}'.format(volume, targets))
+            volumes = volume
+        else:
+            volumes = [volume] * len(targets)
+        if speed != None:
+            if not self.pump.min_speed <= speed <= self.pump.max_speed:
+                raise ValueError('Invalid speed: "{}", Speed should be between {} and {}'.format(speed, self.pump.min_speed, self.pump.max_speed))
+            cached_speed = self.getPumpSpeed()
+        else:
+            speed = self.getPumpSpeed()
+            cached_speed = speed
+        running_buffer = buffer == 'RunningBuffer'
+
+        #Group the targets that fit in one aspiration
+        max_volume = self.pump.syringe_ul + 1
+        loads = []
+        current = []
+        filled = 0
+        for t, v in zip(targets, volumes):
+            pad = self.Padding[self.getPort(t)] if padding == True else 0
+            if current != [] and filled + v + pad > max_volume:
+                loads.append(current)
+                current = []
+                filled = 0
+            current.append((t, v, pad))
+            filled += v + pad
+        if current != []:
+            loads.append(current)
+
+        def load(buffer_volume, target, pad):
+            #Aspirate buffer, and RunningBuffer padding for the last target
+            #Returns the volume of buffer and of RunningBuffer that is used
+            if running_buffer == True or same_buffer_padding == True:
+                buffer_volume += pad
+                pad = 0
+            if buffer_volume > 0:
+                if running_buffer == True:
+                    self.pumpExtract(buffer_volume, 'input')
+                else:
+                    self.extractBuffer(buffer, buffer_volume, bubble=False)
+            if pad > 0:
+                self.padding(target)
+            return buffer_volume, pad
+
+        buffer_used = 0
+        padding_used = 0
+        flushed = self.flushReservoir(replace_volume=50, next_buffer=buffer)
+        try:
+            for group in loads:
+                if len(group) == 1:
+                    #One target, in multiple strokes if it does not fit in the syringe
+                    t, v, pad = group[0]
+                    for stroke_volume, stroke_pad in self.planStrokes(v, pad):
+                        b, r = load(stroke_volume, t, stroke_pad)
+                        buffer_used += b
+                        padding_used += r
+                        self.setPumpSpeed(speed)
+                        self.dispenseBuffer(t, stroke_volume + stroke_pad)
+                        self.setPumpSpeed(cached_speed)
+                else:
+                    #The tubes to all but the last target are padded with the buffer
+                    b, r = load(sum(v + pad for t, v, pad in group[:-1]) + group[-1][1], group[-1][0], group[-1][2])
+                    buffer_used += b
+                    padding_used += r
+                    self.setPumpSpeed(speed)
+                    for t, v, pad in group:
+                        self.dispenseBuffer(t, v + pad)
+                    self.setPumpSpeed(cached_speed)
+                for t, v, pad in group:
+                    self.L.logger.info('    Dispensed {}ul of {} to {} with speed {}, padding={}, same_buffer_padding={}'.format(v, buffer, t, speed, pad, same_buffer_padding))
+        finally:
+            #Data handling
+            if buffer_used + padding_used + flushed > 0:
+                if running_buffer == True:
+                    self.updateBuffer('RunningBuffer', buffer_used + flushed, check=False)
+                else:
+                    self.updateBuffer(buffer, buffer_used + flushed, check=False)
+                    if padding_used > 0:
+                        self.updateBuffer('RunningBuffer', padding_used, check=False)
+                self.updateBuffer('Waste', buffer_used + padding_used + flushed, check=True)
+        if len(loads) < len(targets):
+            self.L.logger.info('    Split dispense to {} targets in {} aspirations.'.format(len(targets), len(loads)))
+
     @functionWrap    
     def extractDispenseHybmix(self, target, cycle, indirect=None, steps = 10, slow_speed = None, 
                               prehyb=True, wash_hybmix_tubes=False, wash_cycles=5,
@@ -1217,80 +2418,84 @@ class FISH2():
             than {0}ul for the hybridization, remove some steps. Default: 10 steps. 
             Function: extractDispenseHybmix() in FISH2 class""".format(slow_degass_vol, self.Padding['Degass']))
 
-        #Check if the max volume of the syringe is not exceeded.
-        max_volume = self.pump.syringe_ul
-        volume_to_aspirate = Hybmix_vol + self.Padding[self.getPort(target)]
-        if not 0 <= volume_to_aspirate <= (max_volume + 1):
-            raise(ValueError('''Pump syringe volume exceeded.\n
-                The volume and padding can not be more than: {}ul.\n
-                Volume to pipet: {}ul and padding volume: {}ul.'''.format(max_volume, Hybmix_vol, self.Padding[self.getPort(target)])))
+        #Split in strokes if the max volume of the syringe is exceeded.
+        strokes = self.planStrokes(Hybmix_vol, self.Padding[self.getPort(target)])
 
         #Check if the speed is valid
         if slow_speed == None or not self.pump.min_speed <= slow_speed <= self.pump.max_speed:
             raise Exception('Slow_speed: {}, is invalid. Choose a speed between {} and {}. Refer to pump manual for speed codes.'.format(slow_speed, self.pump.min_speed, self.pump.max_speed))
 
         #Change speed for viscous Hybmix
-        if 'CavroXCalibur' in self.devices:
-            cached_speed = self.pump.getSpeed()
-        if 'CavroXE1000' in self.devices:
-            cached_speed = self.pump.getSpeed()
-            print('caching pump speed, check if this is OK: {}'.format(cached_speed))
-        self.pump.setSpeed(slow_speed, execute=True)
+        cached_speed = self.getPumpSpeed()
+        self.setPumpSpeed(slow_speed)
 
         if prehyb==True:
             #Suck HYB_no_probes in reservoir before Hybmix_probes
                 #Discard 20ul to eliminate potential bubbles
             self.extractBuffer('HYB', 20)    
 
-            time.sleep(2) # HYB is viscous, time to equilibrate.
+            self.clock.sleep(2) # HYB is viscous, time to equilibrate.
             self.resetReservoir(replace_volume=0)
-                #Suck HYB_no_probes, volume is same as for Hybmix_probes
-            self.extractBuffer('HYB', Hybmix_vol) 
-            time.sleep(2) # Hybmix is viscous, time to equilibrate
+            for stroke_volume, stroke_pad in self.planStrokes(Hybmix_vol):
+                    #Suck HYB_no_probes, volume is same as for Hybmix_probes
+                self.extractBuffer('HYB', stroke_volume) 
+                self.clock.sleep(2) # Hybmix is viscous, time to equilibrate
 
-            #Dispense HYB_no_probes
-            self.dispenseBuffer(target, Hybmix_vol)
+                #Dispense HYB_no_probes
+                self.dispenseBuffer(target, stroke_volume)
             self.updateBuffer('HYB', (Hybmix_vol + 20), check=False)
 
         #Suck Hybmix_probes to valve 1
         Hybmix_to_valve = self.Padding[self.getPort(Hybmix_port)]
         self.extractBuffer(Hybmix_port, Hybmix_to_valve) 
-        time.sleep(2) # Hybmix is viscous, time to equilibrate.
+        self.clock.sleep(2) # Hybmix is viscous, time to equilibrate.
 
         #Push out air from Hybmix tubes that is now in the reservoir
-        self.pump.setSpeed(cached_speed, execute=True)
+        self.setPumpSpeed(cached_speed)
         self.dispenseBuffer('Waste', Hybmix_to_valve)
         self.resetReservoir(replace_volume=500)
-        self.pump.setSpeed(slow_speed, execute=True)
-
-        #Suck up Hybmix_probes into reservoir
-        self.extractBuffer(Hybmix_port, Hybmix_vol)
+        self.setPumpSpeed(slow_speed)
 
-        #Creates a padding volume in syringe to bridge the tubes between reservoir and target
-        self.pump.setSpeed(cached_speed, execute=True)
-        pad = self.padding(target)
-        self.pump.setSpeed(slow_speed, execute=True)
-
-        #Dispense:
+        #Dispense schedule as (volume, seconds to wait after):
             #Hybmix_probes
             #Intermittently push Hybmix_probes through degasser to remove bubbles
             #(degasser is too slow for the flow speed)
-        self.dispenseBuffer(target, self.Padding['Degass']) #First to degasser
-        time.sleep(30)
-
-        for s in range(steps):
-            self.dispenseBuffer(target, 25)
-            time.sleep(60)
-
-        self.dispenseBuffer(target, (Hybmix_vol - (self.Padding['Degass'] + (25*steps)))) #Dispense remaining
+        pad = self.Padding[self.getPort(target)]
+        schedule = [(self.Padding['Degass'], 30)] #First to degasser
+        schedule += [(25, 60)] * steps
+        schedule += [((Hybmix_vol - (self.Padding['Degass'] + (25*steps))), 0)] #Dispense remaining
             #Padding
             #Stop in degasser, In case there is a bubble between Hybmix_probes and
             #Runninguffer in the reservoir.
-        self.dispenseBuffer(target, self.Padding['Degass']) 
-        time.sleep(60) 
-        self.dispenseBuffer(target,(pad - self.Padding['Degass'])) #Dispense remaining
+        schedule += [(self.Padding['Degass'], 60), ((pad - self.Padding['Degass']), 0)] #Dispense remaining
+
+        for stroke_volume, stroke_pad in strokes:
+            #Suck up Hybmix_probes into reservoir
+            if stroke_volume > 0:
+                self.extractBuffer(Hybmix_port, stroke_volume)
+
+            #Creates a padding volume in syringe to bridge the tubes between reservoir and target
+            if stroke_pad > 0:
+                self.setPumpSpeed(cached_speed)
+                self.padding(target)
+                self.setPumpSpeed(slow_speed)
+
+            #Dispense the content of the syringe following the schedule, a
+            #step that is split over two strokes waits after the second part.
+            remaining = stroke_volume + stroke_pad
+            while remaining > 0 and schedule != []:
+                step_volume, wait = schedule[0]
+                part = min(step_volume, remaining)
+                self.dispenseBuffer(target, part)
+                remaining -= part
+                if part == step_volume:
+                    schedule.pop(0)
+                    if wait > 0:
+                        self.clock.sleep(wait)
+                else:
+                    schedule[0] = (step_volume - part, wait)
 
-        self.pump.setSpeed(cached_speed, execute=True)
+        self.setPumpSpeed(cached_speed)
         self.updateBuffer('RunningBuffer', pad + 200 + 500, check=False)
         self.updateBuffer('Waste', (Hybmix_vol+pad + 200 + 500), check = True)
         self.L.logger.info('    Dispensed {} to {}, start hybridization. indirect={}, steps={}, slow_speed={}, prehyb={}, wash={}'.format(Hybmix_code, target, indirect, steps, slow_speed, prehyb, wash_hybmix_tubes))
@@ -1313,7 +2518,7 @@ class FISH2():
         hyb_time_code = 'Hyb_time_{}{}'.format(target[-1], indirect)
         hyb_time = self.Parameters[hyb_time_code]        
         current_time = time.strftime("%d-%m-%Y %H:%M:%S")
-        finish_time = (datetime.now() + timedelta(hours = hyb_time)).strftime("%d-%m-%Y %H:%M:%S")
+        finish_time = (datetime.fromtimestamp(self.clock.time()) + timedelta(hours = hyb_time)).strftime("%d-%m-%Y %H:%M:%S")
         print('Hybridization start time: {}, Done at: {}'.format(current_time, finish_time))
 
         if wash_hybmix_tubes == True:
@@ -1339,7 +2544,7 @@ class FISH2():
         else:
             if self.Padding[port] != 'None':
                 self.extractBuffer(port, self.Padding[port])
-                time.sleep(2) #In case of viscous buffers
+                self.clock.sleep(2) #In case of viscous buffers
                 self.resetReservoir(200, update_buffer=True)
                 if update==True:
                     self.updateBuffer(port, self.Padding[port], check=False)  
@@ -1384,11 +2589,11 @@ class FISH2():
             self.updateBuffer('RunningBuffer', (2*self.pump.syringe_ul), check=False)
             self.updateBuffer('Waste', (2*self.pump.syringe_ul), check=False)  
             
-        #Prime the buffers selected in the dialog
-        for k, v in response.items():
-            if v == 1:
-                self.prime(k)
-                self.L.logger.info('    Primed port {} connected to buffer {}'.format(k, self.Ports[k]))
+        #Prime the buffers selected in the dialog, in the order with the least valve rotation
+        selected = self.orderPorts([k for k, v in response.items() if v == 1])
+        for k in selected:
+            self.prime(k)
+            self.L.logger.info('    Primed port {} connected to buffer {}'.format(k, self.Ports[k]))
 
         print('''\nPurge the hybridization chambers\n
         Close the shutoff valve and use the purge valve and a RunningBuffer filled syringe
@@ -1407,22 +2612,22 @@ class FISH2():
         target = self.getPort(port)
         #Remove hybmix remainder from tubes
         self.connectPort(target)
-        self.pump.extract(volume_ul = self.Padding[target], from_port = 'output', execute=True)
+        self.pumpExtract(self.Padding[target], 'output')
         self.resetReservoir(replace_volume=300)
 
         vol = self.Padding[target] + wash_volume #Fills Eppendorf tube with extra running buffer.
         for c in range(cycles):
-            self.pump.extract(volume_ul = vol, from_port = 'input', execute=True)
+            self.pumpExtract(vol, 'input')
             self.connectPort(target)
-            self.pump.dispense(volume_ul = vol, to_port = 'output', execute=True)
-            self.pump.extract(volume_ul = (vol+500), from_port = 'output', execute=True)
+            self.pumpDispense(vol, 'output')
+            self.pumpExtract((vol+500), 'output')
             self.resetReservoir(replace_volume=500)
 
         used_vol = 300 + ((vol + 500) * cycles)
         self.updateBuffer('RunningBuffer', used_vol, check=False)
         self.updateBuffer('Waste', used_vol, check=True)
         #Remove hybmix code from info file
-        perif.removeHybmix(self.db_path, port)
+        perif.removeHybmix(self.db_path, port, datafile=(self.simulate == False))
         self.L.logger.info('    Washed port {} {} times with RunningBuffer: {}.'.format(target, cycles, self.Ports['RunningBuffer'])) 
 
     def cleanSystem(self, wash=True, hybmix_cycles=5, hybmix_wash_volume=200):
@@ -1466,38 +2671,37 @@ class FISH2():
         mainloop()
         response = {k: buttons[k].get() for k in buttons.keys()}
 
+        #Clean the ports in the order with the least valve rotation
+        def selected(mode, home):
+            ports = [k.split('_')[1] for k, v in response.items() if k.startswith(mode) and v == 1]
+            return self.orderPorts(ports, home=home)
+
         #Clean the ports that need aspiration
         aspirate_vol = 0
-        for k, v in response.items():
-            if k.startswith('Aspirate') and v == 1:
-                port = k.split('_')[1]
-                self.L.logger.info('    Cleaning port: {} connected to buffer: {}'.format(port, self.Ports[port]))
-                self.prime(port, update=False) #Empties the tube if the needle is not in the liquid.
-                self.prime(port, update=False) #twice to clean completely
-                if wash == True:
-                    self.extractDispenseRunningBuffer(self.Padding[port], port, padding=False)
-                    self.prime(port, update=False)
-                    self.extractDispenseRunningBuffer(self.Padding[port], port, padding=False)
-                    self.prime(port, update=False)
-                    aspirate_vol += self.Padding[port] * 2
-                    self.L.logger.info('    Washed tube and needle twice of port {} with buffer: {}'.format(port, self.Ports[port]))
+        for port in selected('Aspirate', 'Waste'):
+            self.L.logger.info('    Cleaning port: {} connected to buffer: {}'.format(port, self.Ports[port]))
+            self.prime(port, update=False) #Empties the tube if the needle is not in the liquid.
+            self.prime(port, update=False) #twice to clean completely
+            if wash == True:
+                self.extractDispenseRunningBuffer(self.Padding[port], port, padding=False)
+                self.prime(port, update=False)
+                self.extractDispenseRunningBuffer(self.Padding[port], port, padding=False)
+                self.prime(port, update=False)
+                aspirate_vol += self.Padding[port] * 2
+                self.L.logger.info('    Washed tube and needle twice of port {} with buffer: {}'.format(port, self.Ports[port]))
 
         #Clean ports that need dispensing
         dispence_vol = 0
-        for k, v in response.items():
-            if k.startswith('Dispence') and v == 1:
-                port = k.split('_')[1]
-                self.extractDispenseRunningBuffer(1000, port, padding=False)
-                self.extractDispenseRunningBuffer(1000, port, padding=False)
-                self.extractDispenseRunningBuffer(1000, port, padding=False)
-                dispence_vol += 3000
-                self.L.logger.info('    Flushing port {} connected to {} with 3000ul of {}'.format(port, self.Ports[port], self.Ports['RunningBuffer']))
+        for port in selected('Dispence', None):
+            self.extractDispenseRunningBuffer(1000, port, padding=False)
+            self.extractDispenseRunningBuffer(1000, port, padding=False)
+            self.extractDispenseRunningBuffer(1000, port, padding=False)
+            dispence_vol += 3000
+            self.L.logger.info('    Flushing port {} connected to {} with 3000ul of {}'.format(port, self.Ports[port], self.Ports['RunningBuffer']))
 
         #Clean the Hybmix ports:
-        for k, v in response.items():
-            if k.startswith('HYBMIX') and v == 1:
-                port = k.split('_')[1]
-                self.cleanHybmixTube(port, cycles=hybmix_cycles, wash_volume=hybmix_wash_volume)
+        for port in selected('HYBMIX', 'Waste'):
+            self.cleanHybmixTube(port, cycles=hybmix_cycles, wash_volume=hybmix_wash_volume)
 
         #Clean the reservoir
         self.resetReservoir(replace_volume=self.pump.syringe_ul, update_buffer=True)
@@ -1556,7 +2760,7 @@ class FISH2():
                 cur_temp = self.temp.get_temp()[2]
                 for t in np.arange(cur_temp, temperature, step if cur_temp<temperature else -step):
                     self.TC_1.set_temp(round(t, 2))
-                    time.sleep(step_time)
+                    self.clock.sleep(step_time)
                 self.TC_1.set_temp(temperature)
                 self.target_temperature[0] = temperature
             
@@ -1564,7 +2768,7 @@ class FISH2():
                 cur_temp = self.temp.get_temp()[3]
                 for t in np.arange(cur_temp, temperature, step if cur_temp<temperature else -step):
                     self.TC_2.set_temp(round(t, 2))
-                    time.sleep(step_time)
+                    self.clock.sleep(step_time)
                 self.TC_2.set_temp(temperature)
                 self.target_temperature[1] = temperature
             else:
@@ -1575,7 +2779,7 @@ class FISH2():
             cur_temp = self.TC720.get_temp()
             for t in np.arange(cur_temp, temperature, step if cur_temp<temperature else -step):
                 self.TC720.set_temp(round(t, 2))
-                time.sleep(step_time)
+                self.clock.sleep(step_time)
             self.TC720.set_temp(temperature)
             self.target_temperature[0] = temperature
         else:
@@ -1610,7 +2814,7 @@ class FISH2():
             raise Exception('Invalid input for chamber: "{}". Choose "Chamber1" or "Chamber2".'.format(chamber))
 
         while True:
-            tic = time.time()
+            tic = self.clock.time()
 
             if 'YoctoThermistor' in self.devices:
                 cur_temp = self.temp.get_temp()[sensor]
@@ -1669,12 +2873,13 @@ class FISH2():
                                long_message= timeout_message)
 
             counter +=1        
-            toc = time.time()
+            toc = self.clock.time()
             execute_time = toc - tic
             if execute_time > 1:
                 execute_time = 0.001
             # Check every second
-            time.sleep(1-execute_time)
+            if self.cooperativeWait(1-execute_time) == False:
+                self.clock.sleep(1-execute_time)
         self.L.logger.info('    {} within range of target temperature {}C, allowed error {}C. Reached in {} seconds after starting the waitTemp() function.'.format(chamber, target_temp, error, counter))
 
 #=============================================================================
@@ -1691,6 +2896,9 @@ class FISH2():
             Chamber1 ready for imaging, 2: Chamber2 ready for imaging.
         
         """
+        #A simulation only uses its own start imaging file, see __init__()
+        if self.simulate == True:
+            start_imaging_file_path = self.start_imaging_file_path
         count = 0
         while True:
             try:
@@ -1716,6 +2924,9 @@ class FISH2():
             Chamber1 ready for imaging, 2: Chamber2 ready for imaging.
         
         """
+        #A simulation only uses its own start imaging file, see __init__()
+        if self.simulate == True:
+            start_imaging_file_path = self.start_imaging_file_path
         if chamber.lower() != 'chamber1' and chamber.lower() != 'chamber2':
             raise ValueError('Invalid input, choose "Chamber1" or "Chamber2".')
         if chamber.lower() == 'chamber1':
@@ -1734,12 +2945,149 @@ class FISH2():
                     start_imaging_file.write(str(start_val))
                 break
             except Exception as e:
-                time.sleep(0.551)
+                self.clock.sleep(0.551)
                 print ("Error, Unable to open Start_Imaging_File with path: {}, Make sure the file is present at this location or correct the path. Error message: {}".format(start_imaging_file_path, e))
                 tried +=1
                 if tried >200:
                     raise Exception('Could not write to: {} and start the imaging. Please check if path and file are correct.'.format(start_imaging_file_path))
 
+#=============================================================================
+# Cooperative multitasking
+#=============================================================================
+
+    def pumpFree(self):
+        """
+        Return True if the pump and valves can be used by another protocol:
+        the syringe is empty and no pump commands are queued. 
+        """
+        return self.pump_chain_depth == 0 and self.pump_state['plunger'] == 0
+
+    def cooperativeWait(self, sec):
+        """
+        Hand a wait of a protocol to runCooperative(), so that another 
+        protocol can use the pump in the meantime. Only if the protocol runs
+        in runCooperative() and the syringe is empty, see pumpFree().
+        Input:
+        `sec`(int/float): Seconds to wait.
+        Returns:
+        True if the wait is done, False if the caller needs to wait itself.
+        """
+        coop = self.coop
+        if coop == None or sec <= 0 or self.pumpFree() == False:
+            return False
+        name = coop['tasks'].get(threading.current_thread())
+        if name == None:
+            return False
+
+        state = coop['state'][name]
+        with coop['condition']:
+            state['due'] = self.clock.time() + sec
+            state['go'] = False
+            coop['condition'].notify_all()
+            coop['condition'].wait_for(lambda: state['go'] == True or coop['stop'] == True)
+        if coop['stop'] == True:
+            raise InterruptedError('Protocol {} stopped, another protocol failed.'.format(name))
+        return True
+
+    def runCooperative(self, tasks):
+        """
+        Run protocols side by side, like the protocols of two chambers. The
+        protocols take turns on the pump and valves. A protocol runs until it
+        waits in secure_sleep() or waitTemp() with an empty syringe, then the
+        protocol that is due first continues. 
+        Only one protocol runs at a time and only at these waits the protocol
+        can change, so the protocols do not need to be changed. Waits with 
+        buffer in the syringe, like the degassing steps of 
+        extractDispenseHybmix() or a preloaded washBuffer(), are not shared.
+        A protocol that is due while the other protocol uses the pump, starts
+        when the pump is free. See coopReport() for these delays.
+        If a protocol fails, the other protocols are stopped at their next
+        wait and the error is raised.
+        Input:
+        `tasks`(dict): Name and function without arguments of every protocol.
+            Like: {'Chamber1': lambda: protocol('Chamber1')}. The first 
+            protocol starts first.
+        Returns:
+        `results`(dict): Return value of every protocol.
+        """
+        if self.coop != None:
+            raise Exception('runCooperative() is already running.')
+        condition = threading.Condition()
+        start = self.clock.time()
+        state = {n: {'due': start, 'go': False, 'done': False, 'result': None, 'error': None} for n in tasks}
+        coop = {'condition': condition, 'state': state, 'tasks': {}, 'stop': False}
+
+        def run(name, function):
+            with condition:
+                condition.wait_for(lambda: state[name]['go'] == True or coop['stop'] == True)
+            try:
+                if coop['stop'] == False:
+                    state[name]['result'] = function()
+            except BaseException as e:
+                state[name]['error'] = e
+            finally:
+                with condition:
+                    state[name]['done'] = True
+                    state[name]['go'] = False
+                    condition.notify_all()
+
+        threads = []
+        for name, function in tasks.items():
+            thread = threading.Thread(target=run, args=(name, function), name=name, daemon=True)
+            coop['tasks'][thread] = name
+            threads.append(thread)
+        self.coop = coop
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                waiting = [n for n in tasks if state[n]['done'] == False]
+                if waiting == []:
+                    break
+                #The pump goes to the protocol that is due first
+                name = min(waiting, key=lambda n: state[n]['due'])
+                idle = state[name]['due'] - self.clock.time()
+                if idle > 0:
+                    #All protocols wait, check the system while sleeping
+                    self.secure_sleep(idle, period=120, alarm_room_temperature=35, temperature_range=5, number_of_messages=10)
+                elif state[name]['due'] != start:
+                    self.coop_stats['late_time'] += -idle
+                    self.coop_stats['max_late'] = max(self.coop_stats['max_late'], -idle)
+
+                with condition:
+                    state[name]['go'] = True
+                    condition.notify_all()
+                    condition.wait_for(lambda: state[name]['go'] == False)
+                self.coop_stats['switches'] += 1
+                if state[name]['error'] != None:
+                    raise state[name]['error']
+        finally:
+            #Stop the other protocols if one failed or on a keyboard interrupt
+            with condition:
+                coop['stop'] = True
+                condition.notify_all()
+            for thread in threads:
+                thread.join()
+            self.coop = None
+
+        return {n: state[n]['result'] for n in tasks}
+
+    def coopReport(self, log=True):
+        """
+        Report the number of turns of runCooperative() and the time the 
+        protocols started late, because the other protocol used the pump.
+        Input:
+        `log`(bool): If True, writes the report to the log. Default = True
+        Returns:
+        `report`(dict): switches, late_time and max_late in seconds.
+        """
+        report = dict(self.coop_stats)
+        if log == True:
+            self.L.logger.info('Cooperative run: {} turns, protocols started {}s late in total, at most {}s.'.format(
+                               report['switches'], round(report['late_time'], 1), round(report['max_late'], 1)))
+        return report
+
 #=============================================================================
 # Error checking
 #=============================================================================
@@ -1851,7 +3199,7 @@ class FISH2():
         """
         Check disk usage to warn user if it is too high.
         """
-        drive = self.imaging_output_folder[:2] #Only on windows??
+        drive = os.path.splitdrive(os.path.abspath(self.imaging_output_folder))[0] or os.sep
         total, used, free = shutil.disk_usage(drive)
         if (used / total) > self.Alert_volume['Disk']:
             return [False, f'Disk usage high: {used // (2**30)}GB used, {free // (2**30)}GB free, of total {total // (2**30)}GB']
@@ -1951,6 +3299,10 @@ class FISH2():
         are False and an error needs to be reported to the user.
         
         """ 
+        #Let another protocol use the pump during the wait, see runCooperative()
+        if self.cooperativeWait(sec) == True:
+            return
+
         current_temp = ''
         
         #Loop through the wait time.
@@ -1962,25 +3314,27 @@ class FISH2():
                 if verbose:
                     print('    Less than 30 seconds to sleep, will return after {} seconds'.format(sec))
                 if sec > 0:
-                    time.sleep(sec)
+                    self.clock.sleep(sec)
                     return
                 else:
                     return
 
             #Secure sleep if sleep time is long
             else:
-                tic = time.time()
+                tic = self.clock.time()
                 
+                #Re-attach the devices that were plugged in again
+                self.applyDeviceEvents()
                 #Perform error checks on system modules
                 self.check_error(alarm_room_temperature, temperature_range, number_of_messages)
 
                 #Sleep the rest of the ime
-                toc = time.time()
+                toc = self.clock.time()
                 execute_time = toc - tic
                 remain_sleep = period - execute_time
                 
                 if remain_sleep>0:
-                    time.sleep(remain_sleep)
+                    self.clock.sleep(remain_sleep)
                 else:
                     sec += remain_sleep
 
@@ -1992,7 +3346,7 @@ class FISH2():
 
     def scheduler(self, function1, function2, remove_experiment=True, log_info_file=True,
                   current_1=None, current_2=None, start_with=None, single_experiment=True,
-                 wash_hybmix_tubes=True, wash_cycles=5, wash_volume=200):
+                 wash_hybmix_tubes=True, wash_cycles=5, wash_volume=200, cooperative=False):
         """
         Scheduler that schedules and performs the experiments on the ROBOFISH
         system depending on the info provided in the info file. The experiment
@@ -2042,6 +3396,11 @@ class FISH2():
             scheduler will stay on and wait for the next experiment to be filled
             in by the user in the info file. If you run two flow cells this 
             needs to be set to False.
+        `cooperative`(bool): If True, the chambers are stained side by side 
+            with runCooperative(). While one chamber incubates, the pump 
+            serves the other chamber. The imaging still takes turns. Runs the
+            experiments in the database to the end and then returns, without
+            the messages to prepare the imaging. Default False.
         Cleaning options:
         `wash_hybmix_tubes`(bool): Wash the hybmix tubes. Warning: If the hybmix 
             tubes are washed in this function they should not also be wased in 
@@ -2258,6 +3617,73 @@ class FISH2():
         cur_stain = cur_exp['Current_staining']
         other = -cur_stain + 3  #Reverse 1-->2   2-->1
 
+        #Stain both chambers side by side, they take turns on the pump.
+        if cooperative == True:
+            def imagingDone(stain):
+                #The imaging of the chamber is done when the start imaging file
+                #has another value, the other chamber can already be imaging.
+                while True:
+                    with open(self.start_imaging_file_path, 'r') as start_imaging_file:
+                        value = start_imaging_file.read().strip()
+                    if value != str(stain):
+                        return
+                    self.secure_sleep(120, period=60, alarm_room_temperature=35, temperature_range=5, number_of_messages=10)
+
+            def chamberProtocol(stain):
+                other = -stain + 3  #Reverse 1-->2   2-->1
+                chamber = 'Chamber{}'.format(stain)
+                while True:
+                    updateCurExp()
+                    #First part of experiment
+                    if cur_exp['Current_cycle_{}'.format(stain)] == 'None':
+                        cur_exp['Current_cycle_{}'.format(stain)] = 1
+                        self.L.logger.info('_____')
+                        self.L.logger.info('STARTING {}, CYCLE: {}'.format(cur_exp['EXP_name_{}'.format(stain)], cur_exp['Current_cycle_{}'.format(stain)]))
+                        create_config_file(stain, other)
+                        function1(chamber, cur_exp['Current_cycle_{}'.format(stain)])
+                    #Repeat part of experiment
+                    else:
+                        cur_exp['Current_cycle_{}'.format(stain)] += 1
+                        self.L.logger.info('_____')
+                        self.L.logger.info('STARTING {}, CYCLE: {}'.format(cur_exp['EXP_name_{}'.format(stain)], cur_exp['Current_cycle_{}'.format(stain)]))
+                        function2(chamber, cur_exp['Current_cycle_{}'.format(stain)])
+                        self.updateExperimentalParameters(self.db_path, ignore_flags=False)
+                    create_info_dict(cur_exp, stain, log=log_info_file)
+
+                    #Start imaging, waits until the imaging of the other chamber has finished.
+                    self.L.logger.info('Start Imaging of Experiment: {} Cycle: {}'.format(cur_exp['EXP_name_{}'.format(stain)], cur_exp['Current_cycle_{}'.format(stain)]))
+                    self.startImaging(chamber, self.start_imaging_file_path)
+                    #Wash the hybmix tubes during the imaging
+                    if wash_hybmix_tubes == True:
+                        Hybmix_code = self.getHybmixCode(chamber, cur_exp['Current_cycle_{}'.format(stain)], indirect=None)
+                        self.cleanHybmixTube(self.getHybmixPort(Hybmix_code), cycles=wash_cycles, wash_volume=wash_volume)
+                    imagingDone(stain)
+                    self.L.logger.info('Imaging Experiment: {} Cycle: {} done.'.format(cur_exp['EXP_name_{}'.format(stain)], cur_exp['Current_cycle_{}'.format(stain)]))
+                    if cur_exp['Current_cycle_{}'.format(stain)] >= cur_exp['Target_cycles_{}'.format(stain)]:
+                        break
+
+                self.L.logger.info('FINISHED {}'.format(cur_exp['EXP_name_{}'.format(stain)]))
+                if remove_experiment == True:
+                    short_message = '{} Finished'.format(cur_exp['EXP_name_{}'.format(stain)])
+                    long_message = '''Full experiment completed. 
+                    All experimental info will be removed from database and FISH_Sytem_datafile.yaml'''
+                    self.push(short_message, long_message)
+                    print(short_message + '\n' + long_message + '\n')
+                    perif.removeExperiment(self.db_path, cur_exp['EXP_name_{}'.format(stain)], datafile=(self.simulate == False))
+
+            chambers = [c for c in [1, 2] if cur_exp['EXP_name_{}'.format(c)] != 'None']
+            if start_with in chambers:
+                chambers.sort(key=lambda c: c != start_with)
+            self.L.logger.info('Cooperative scheduling of chamber(s): {}'.format(chambers))
+            self.runCooperative({'Chamber{}'.format(c): (lambda c=c: chamberProtocol(c)) for c in chambers})
+            self.L.logger.info('All experiments finished.')
+            self.coopReport()
+            self.valveReport()
+            self.pumpReport()
+            self.flushReport()
+            self.close()
+            return
+
         # Infinite cycle to perform all experiments. Can be left on for multiple experiments.
         while True:
 
@@ -2275,6 +3701,8 @@ class FISH2():
         
                 if resume.lower() == 'resume':
                     input('\nPress Enter when ready to resume staining and imaging...')
+                    self.resetValvePosition()
+                    self.reservoir_content = None
                     updateCurExp()
                     #check exp number to see if there are one or two experiments to run.
                     if cur_exp['EXP_name_1'] != 'None' and cur_exp['EXP_name_2'] != 'None':
@@ -2290,6 +3718,10 @@ class FISH2():
             
                 elif resume.lower() == 'stop':
                     self.L.logger.info('FISH2 program stopped by user')
+                    self.valveReport()
+                    self.pumpReport()
+                    self.flushReport()
+                    self.close()
                     break
     
         #Does Current_stain exist:
@@ -2319,7 +3751,7 @@ class FISH2():
                     #Make config file
                     create_config_file(cur_stain, other)
                     #Record start time
-                    timing['tic_{}'.format(cur_stain)] = datetime.now()
+                    timing['tic_{}'.format(cur_stain)] = datetime.fromtimestamp(self.clock.time())
                     print('')
                     #################################################################
                     #Perform First Part of experiment
@@ -2336,13 +3768,13 @@ class FISH2():
                     self.L.logger.info('STARTING {}, CYCLE: {}'.format(cur_exp['EXP_name_{}'.format(cur_stain)], cur_exp['Current_cycle_{}'.format(cur_stain)]))
                     #Calculate total experiment time
                     if timing['tic_{}'.format(cur_stain)] != None:
-                        round_time = datetime.now() - timing['tic_{}'.format(cur_stain)]
+                        round_time = datetime.fromtimestamp(self.clock.time()) - timing['tic_{}'.format(cur_stain)]
                         #Rounds left including current round. 
                         rounds_left = cur_exp['Target_cycles_{}'.format(cur_stain)] - (cur_exp['Current_cycle_{}'.format(cur_stain)] -1)
-                        finish_time = datetime.now() + (rounds_left * timedelta(days=round_time.days, seconds=round_time.seconds))
-                        print('Expected finish time of cycle {} in Chamber{}: {}'.format(cur_exp['Current_cycle_{}'.format(cur_stain)], cur_stain, datetime.now()+round_time))
+                        finish_time = datetime.fromtimestamp(self.clock.time()) + (rounds_left * timedelta(days=round_time.days, seconds=round_time.seconds))
+                        print('Expected finish time of cycle {} in Chamber{}: {}'.format(cur_exp['Current_cycle_{}'.format(cur_stain)], cur_stain, datetime.fromtimestamp(self.clock.time())+round_time))
                         print('Expected finish time for full experiment in Chamber{}: {}'.format(cur_stain, finish_time))
-                    timing['tic_{}'.format(cur_stain)] = datetime.now()
+                    timing['tic_{}'.format(cur_stain)] = datetime.fromtimestamp(self.clock.time())
                     print('')
                     #################################################################
                     #Perform Repeat Part of experiment
@@ -2388,7 +3820,7 @@ class FISH2():
                         self.push(short_message, long_message)
                         print(short_message + '\n' + long_message + '\n')
                         #Remove experiment from database and FISH_System_datafile
-                        perif.removeExperiment(self.db_path, cur_exp['EXP_name_{}'.format(cur_stain)])
+                        perif.removeExperiment(self.db_path, cur_exp['EXP_name_{}'.format(cur_stain)], datafile=(self.simulate == False))
                         cur_exp['Current_cycle_{}'.format(cur_stain)] = 0
                         cur_exp['Current_part_{}'.format(cur_stain)] = 'None' 
                     else:
@@ -2406,7 +3838,7 @@ class FISH2():
 
                 #Check new experiment flag, For new experiment Other
                 #Give user oportunity to prepare imaging Other.
-                if perif.returnDictDB(self.db_path, 'Flags')[0]['New_EXP_flag_{}'.format(other)] == 1:
+                if self.getFlags()['New_EXP_flag_{}'.format(other)] == 1:
                     short_messgage = 'Prepare imaging of {}'.format(cur_exp['EXP_name_{}'.format(other)])
                     long_message = '''Reply with "Pause" if you want to prepare the imaging now (set ROI, focusing etc.).\n
                     There will be another oportunity after the imaging of {}\n
@@ -2416,7 +3848,7 @@ class FISH2():
                     print('\nYou can now prepare the imaging of {}'.format(cur_exp['EXP_name_{}'.format(other)]))
 
                     #10 minutes reply time
-                    time.sleep(60 * 10) 
+                    self.clock.sleep(60 * 10) 
 
                     if perif.get_push(self.Parameters['Operator']).lower() == 'pause':
                         short_message = 'Experiment paused'
@@ -2434,7 +3866,7 @@ class FISH2():
                         updateCurExp()
 
                 #Before imaging Current_stain check if imaging has been set for Current_stain
-                if perif.returnDictDB(self.db_path, 'Flags')[0]['New_EXP_flag_{}'.format(cur_stain)] == 1:
+                if self.getFlags()['New_EXP_flag_{}'.format(cur_stain)] == 1:
                     while True:
                         short_messgage = 'Prepare imaging of {}'.format(cur_exp['EXP_name_{}'.format(cur_stain)])
                         long_message = '''Prepare imaging of {} (set ROI, focusing etc.).\n
@@ -2443,9 +3875,9 @@ class FISH2():
                         print(short_message + '\n' + long_message + '\n')
                         print('If you can not sent push messages: Remove "New_EXP_flag_{}" from the user program'.format(cur_stain))
                         #10 minutes reply time
-                        time.sleep(60 * 10)
+                        self.clock.sleep(60 * 10)
 
-                        if perif.get_push(self.Parameters['Operator']).lower() == 'continue' or perif.returnDictDB(self.db_path, 'Flags')[0]['New_EXP_flag_{}'.format(cur_stain)] == 0:
+                        if perif.get_push(self.Parameters['Operator']).lower() == 'continue' or self.getFlags()['New_EXP_flag_{}'.format(cur_stain)] == 0:
                             updateCurExp()
                             break
              
@@ -0,0 +1,23 @@
+#Script to migrate an existing FISH2 database to the normalised schema (v2).
+#Stop the user program and the FISH2 program before migrating.
+#A backup of the original database is made next to it: <db_name>_v1_backup.sqlite
+#Usage: python FISH2_migrate_db.py FISH_database/FISH_System2_db.sqlite
+import sys
+import os
+
+import FISH2_peripherals as perif
+
+#Get the input arguments
+#The format is [script, db_path]
+i = sys.argv
+if len(i) != 2:
+    print('Usage: python FISH2_migrate_db.py <path to database>')
+    sys.exit(1)
+
+db_path = os.path.abspath(i[1])
+if not os.path.isfile(db_path):
+    print('Database not found: {}'.format(db_path))
+    sys.exit(1)
+
+perif.migrateDB(db_path, backup=True)
+perif.closeDB(db_path)
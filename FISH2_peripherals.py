@@ -11,6 +11,10 @@
     # Sending messages using Pushbullet
     # Managing .yaml files
     # Managing sqlite3 database
+    # Database connection management
+    # Normalised database schema (v2)
+    # Buffer volume ledger
+    # Serial device cache
     # Transport data from .yaml datafile to database
     # User add new data to .yaml datafile and transport to database
     # Remove experiment from .yaml datafile and database
@@ -27,12 +31,26 @@ import os
 from pushbullet import Pushbullet
 #handle .yaml files
 import yaml
+#Use the C implementation of libyaml when available
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 #Use ruamel.yaml to dynamically update files (https://yaml.readthedocs.io)
 import ruamel.yaml
 from ruamel.yaml.util import load_yaml_guess_indent
 import collections
+import copy
+import itertools
+import re
+import shutil
+import tempfile
+import queue
+import atexit
 #Database
 import sqlite3
+import threading
+from contextlib import contextmanager
 #User update
 from tkinter import *
 
@@ -171,17 +189,19 @@ def yamlMake(filepath, new={}):
     `new`(dict): New dictionary to dump to the file
     """
     with open(filepath, 'w') as new_yaml_file:
-        ruamel.yaml.dump(new, new_yaml_file, default_flow_style=False)
+        yaml.dump(new, new_yaml_file, Dumper=YamlDumper, default_flow_style=False)
+    clearYamlCache(filepath)
 
 def yamlLoader(filepath):
     """
     Loads .yaml datafile into python dictionaries. (without comments)
+    Uses the libyaml C loader if it is installed.
     Input:
     `filepaht`(str): Path to .yaml datafile
     """
     try:
         with open(filepath, 'r') as file_descriptor:
-            data = yaml.load(file_descriptor, Loader=yaml.FullLoader)
+            data = yaml.load(file_descriptor, Loader=YamlLoader)
         return data
     except Exception as e:
         print('\nCould not correctly open the .yaml file')
@@ -189,6 +209,114 @@ def yamlLoader(filepath):
         be a space between key and value:  key:_value''')
         print('Error code:\n', e)
 
+#Parsed .yaml files. Key: full path, value: ((modification time, size), data)
+_yaml_cache = {}
+
+def yamlFileVersion(filepath):
+    """
+    Version of a file, changes when the file is saved.
+    Input:
+    `filepath`(str): Path to .yaml datafile
+    Returns:
+    Tuple with modification time in ns and size. None if the file does not exist.
+    
+    """
+    try:
+        file_stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+def yamlLoaderCached(filepath):
+    """
+    Loads .yaml datafile into python dictionaries, like yamlLoader(). The 
+    parsed file is kept in memory and is only parsed again if the 
+    modification time or size of the file changed.
+    Input:
+    `filepath`(str): Path to .yaml datafile
+    Returns:
+    Parsed datafile. Shared between calls, do not modify.
+    
+    """
+    path = os.path.abspath(filepath)
+    version = yamlFileVersion(path)
+
+    cached = _yaml_cache.get(path)
+    if cached != None and cached[0] == version:
+        return cached[1]
+
+    data = yamlLoader(path)
+    if data != None:
+        _yaml_cache[path] = (version, data)
+    return data
+
+def clearYamlCache(filepath=None):
+    """
+    Remove a file from the cache of yamlLoaderCached(). Use after writing 
+    the file.
+    Input:
+    `filepath`(str): Path to .yaml datafile. If None, clears the whole cache.
+    
+    """
+    if filepath == None:
+        _yaml_cache.clear()
+    else:
+        _yaml_cache.pop(os.path.abspath(filepath), None)
+
+def yamlRoundTripLoad(filepath):
+    """
+    Loads .yaml datafile including comments and layout. Slow, only use this 
+    if the file is written back and the comments should be kept.
+    Input:
+    `filepath`(str): Path to .yaml datafile
+    Returns:
+    `config`(ruamel CommentedMap): Datafile content.
+    `ind`(int): Indentation of the file.
+    `bsi`(int): Block sequence indentation of the file.
+    
+    """
+    with open(filepath, "r") as yaml_file:
+        config, ind, bsi = load_yaml_guess_indent(yaml_file)
+    return config, ind, bsi
+
+def yamlRoundTripDump(filepath, config, ind, bsi, version=None):
+    """
+    Write a datafile loaded with yamlRoundTripLoad(), keeping the comments.
+    The file is written to a temporary file first and then replaces the 
+    datafile, so that a half written datafile is never visible.
+    Input:
+    `filepath`(str): Path to .yaml datafile
+    `config`(ruamel CommentedMap): Datafile content.
+    `ind`(int): Indentation of the file.
+    `bsi`(int): Block sequence indentation of the file.
+    `version`(tuple): Optional, yamlFileVersion() of the file when it was 
+        loaded. If the file changed since, it is not replaced.
+    Returns:
+    True if the file is written, False if the file changed since it was loaded.
+    
+    """
+    folder = os.path.dirname(os.path.abspath(filepath))
+    #Temporary file in the same folder, os.replace() can not move between drives
+    fd, temp_path = tempfile.mkstemp(suffix='.yaml', prefix='.tmp_', dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as new_yaml_file:
+            ruamel.yaml.round_trip_dump(config ,new_yaml_file, 
+                                        indent=ind, block_seq_indent=bsi)
+            new_yaml_file.flush()
+            os.fsync(new_yaml_file.fileno())
+        #Do not overwrite changes saved by someone else, like the operator
+        if version != None and yamlFileVersion(filepath) != version:
+            return False
+        if os.path.isfile(filepath):
+            shutil.copymode(filepath, temp_path)
+        os.replace(temp_path, filepath)
+        return True
+    finally:
+        #Only exists if the write failed
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        clearYamlCache(filepath)
+
 def updateDict(dictionary, new):
     """
     Update function for nested dictionaries.
@@ -207,35 +335,95 @@ def updateDict(dictionary, new):
             dictionary[key] = new[key]
     return dictionary
 
-def yamlUpdate(filepath, new, file_extension=None):
+def yamlUpdate(filepath, new, file_extension=None, attempts=5):
     """
     Update function for .yaml files with nested dictionaries.
+    If the file is saved by someone else during the update, the update is 
+    applied again to the saved file, so that no changes are lost.
     Input:
     `filepath`(str): Name of .yaml datafile.
     `new`(dict): value to update, including all layers of nested dict. Like:
     {'Level1':{'Level2':{'Level3':{'key1':'new_value'}}}}
     `file_extension`(str):Optional file extension for new file.
+    `attempts`(int): Number of times to try if the file keeps changing.
+    Returns:
+    True if the file is updated.
     
     """
-    with open(filepath, "r") as yaml_file:
-        config, ind, bsi = load_yaml_guess_indent(yaml_file)
-    
-    #use 'updateDict' function that can update one value in a nested dict.
-    updateDict(config, new)
-
     if file_extension != None:
         new_name = (filepath.split('.')[0] + file_extension +
                     '.' + filepath.split('.')[1])
     else:
         new_name = filepath
+
+    for attempt in range(attempts):
+        version = yamlFileVersion(filepath)
+        config, ind, bsi = yamlRoundTripLoad(filepath)
         
-    with open(new_name, 'w') as updated_yaml_file:
-        ruamel.yaml.round_trip_dump(config ,updated_yaml_file, 
-                                    indent=ind, block_seq_indent=bsi)
+        #use 'updateDict' function that can update one value in a nested dict.
+        updateDict(config, new)
+        
+        #Only check for conflicts when the file itself is updated
+        if yamlRoundTripDump(new_name, config, ind, bsi, 
+                             version=version if new_name == filepath else None):
+            return True
+    
+    print('Could not update {}, the file keeps changing.'.format(filepath))
+    return False
+
+#Queue of updates for the .yaml datafile that are written in the background
+_yaml_queue = queue.Queue()
+_yaml_worker = None
+_yaml_worker_lock = threading.Lock()
+
+def _yamlUpdateWorker():
+    """
+    Write the queued updates of yamlUpdateBackground() one by one, in order.
+    
+    """
+    while True:
+        filepath, new = _yaml_queue.get()
+        try:
+            yamlUpdate(filepath, new)
+        except Exception as e:
+            print('Error, could not update {} in the background'.format(filepath))
+            print('Error message: ', e)
+        finally:
+            _yaml_queue.task_done()
+
+def yamlUpdateBackground(filepath, new):
+    """
+    Update a .yaml file like yamlUpdate() but return immediately. The update 
+    is written in a background thread. Use when the database is already 
+    updated and the .yaml file only needs to follow.
+    Input:
+    `filepath`(str): Name of .yaml datafile.
+    `new`(dict): value to update, including all layers of nested dict. Like:
+    {'Level1':{'Level2':{'Level3':{'key1':'new_value'}}}}
+    
+    """
+    global _yaml_worker
+    _yaml_queue.put((filepath, copy.deepcopy(new)))
+    with _yaml_worker_lock:
+        if _yaml_worker == None or not _yaml_worker.is_alive():
+            _yaml_worker = threading.Thread(target=_yamlUpdateWorker, name='yamlUpdateWorker', 
+                                            daemon=True)
+            _yaml_worker.start()
+
+def waitYamlUpdates():
+    """
+    Wait until all updates of yamlUpdateBackground() are written.
+    
+    """
+    _yaml_queue.join()
+
+#Do not lose queued updates when the program exits
+atexit.register(waitYamlUpdates)
 
 def getFISHSystemMetadata(filename, table=None):
     """
-    Get metadata from .yaml datafile.
+    Get metadata from .yaml datafile. The file is only parsed again if it
+    changed since the last call.
     Input:
     `filename`(str): Filename of .yamle datafile.
     `table`(str) Optional: Specific table to return as dictionary.
@@ -248,7 +436,12 @@ def getFISHSystemMetadata(filename, table=None):
     
     """
     try:
-        metadata = yamlLoader(filename)
+        metadata = yamlLoaderCached(filename)
+        #Copy only the requested table, the cached file is shared between calls
+        if table in metadata['FISHSystem']:
+            metadata = {'FISHSystem': {table: copy.deepcopy(metadata['FISHSystem'][table])}}
+        else:
+            metadata = copy.deepcopy(metadata)
     except Exception as e:
         print('Unable to load metadata file: {}'.format(filename))
         
@@ -288,11 +481,248 @@ def getFISHSystemMetadata(filename, table=None):
                 metadata['FISHSystem']['Alert_volume'])
 
 
+#=============================================================================
+# Database connection management
+#=============================================================================
+
+#Every thread keeps one open connection per database. Opening a new connection
+#for every read or write is slow and the helper functions are called very often.
+_db_local = threading.local()
+#Every connection made by connectDB() gets a new number
+_db_connection_count = itertools.count(1)
+
+#Number of compiled SQL statements sqlite3 keeps per connection (least 
+#recently used are removed). The helpers bind all values as parameters, so 
+#that every table/column combination is one statement that is reused.
+db_cached_statements = 256
+
+#Seconds a connection waits for a lock of the other process before it raises
+#"database is locked". Change with configureDB().
+db_busy_timeout = 5.0
+
+#"synchronous" setting used when the database is in WAL mode. "NORMAL" is
+#safe in WAL mode and does not wait for the disk on every commit.
+db_wal_synchronous = 'NORMAL'
+
+def connectDB(db_path):
+    """
+    Return the connection of the current thread to the database. Makes a new
+    connection the first time a database is used by a thread and reuses it 
+    afterwards. The connection also caches the compiled SQL statements.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `conn`(sqlite3.Connection): Connection to the database.
+    
+    """
+    connections = getattr(_db_local, 'connections', None)
+    if connections == None:
+        connections = _db_local.connections = {}
+    
+    conn = connections.get(db_path)
+    if conn == None:
+        conn = sqlite3.connect(db_path, timeout=db_busy_timeout, 
+                               cached_statements=db_cached_statements)
+        #The journal mode is stored in the database, the other settings are
+        #per connection.
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+            conn.execute("PRAGMA synchronous = {}".format(db_wal_synchronous))
+        connections[db_path] = conn
+        #Number the connection, see dataVersionDB()
+        numbers = getattr(_db_local, 'numbers', None)
+        if numbers == None:
+            numbers = _db_local.numbers = {}
+        numbers[db_path] = next(_db_connection_count)
+    return conn
+
+def configureDB(busy_timeout=None, wal_synchronous=None):
+    """
+    Change the connection settings. Applies to the open connections of the 
+    current thread and to all new connections.
+    Input:
+    `busy_timeout`(int/float): Seconds to wait for a lock held by the other
+        process before raising "database is locked". Default (None) keeps the
+        current value.
+    `wal_synchronous`(str): PRAGMA synchronous setting in WAL mode: 'OFF', 
+        'NORMAL' or 'FULL'. Default (None) keeps the current value.
+    
+    """
+    global db_busy_timeout, db_wal_synchronous
+    if wal_synchronous != None:
+        if wal_synchronous.upper() not in ['OFF', 'NORMAL', 'FULL']:
+            raise ValueError('Invalid wal_synchronous: {}, choose "OFF", "NORMAL" or "FULL"'.format(wal_synchronous))
+        db_wal_synchronous = wal_synchronous.upper()
+    if busy_timeout != None:
+        db_busy_timeout = busy_timeout
+
+    for conn in getattr(_db_local, 'connections', {}).values():
+        conn.execute("PRAGMA busy_timeout = {}".format(int(db_busy_timeout * 1000)))
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+            conn.execute("PRAGMA synchronous = {}".format(db_wal_synchronous))
+
+def setWalModeDB(db_path, wal=True):
+    """
+    Switch the journal mode of the database. In WAL (Write-Ahead Logging) 
+    mode, reading and writing do not block each other, so the FISH2 program
+    can read the Flags while the user program writes the datafile to the 
+    database. The mode is stored in the database file and is used by all
+    processes that open it.
+    Input:
+    `db_path`(str): Full path to database.
+    `wal`(bool): True for WAL mode, False for the default rollback journal.
+    Returns:
+    `journal_mode`(str): The new journal mode.
+    
+    """
+    conn = connectDB(db_path)
+    mode = 'WAL' if wal == True else 'DELETE'
+    journal_mode = conn.execute("PRAGMA journal_mode = {}".format(mode)).fetchone()[0]
+    if journal_mode == 'wal':
+        conn.execute("PRAGMA synchronous = {}".format(db_wal_synchronous))
+    else:
+        conn.execute("PRAGMA synchronous = FULL")
+    return journal_mode
+
+def copyDB(db_path, copy_path):
+    """
+    Make a copy of a database, also while it is in use. The sqlite backup
+    API copies a consistent state, including the changes in the WAL file.
+    Input:
+    `db_path`(str): Full path to database.
+    `copy_path`(str): Full path of the copy, is overwritten if it exists.
+    Returns:
+    `copy_path`(str): Full path of the copy.
+    
+    """
+    if not os.path.isfile(db_path):
+        raise Exception('No database found to copy: {}'.format(db_path))
+    copy_conn = sqlite3.connect(copy_path)
+    try:
+        connectDB(db_path).backup(copy_conn)
+    finally:
+        copy_conn.close()
+    return copy_path
+
+def closeDB(db_path=None):
+    """
+    Close the connection(s) of the current thread.
+    Input:
+    `db_path`(str): Full path to database. If None, closes all connections of
+        the current thread. Default = None
+    
+    """
+    connections = getattr(_db_local, 'connections', {})
+    if db_path == None:
+        to_close = list(connections.keys())
+    else:
+        to_close = [db_path] if db_path in connections else []
+    
+    for path in to_close:
+        connections.pop(path).close()
+
+@contextmanager
+def transactionDB(db_path):
+    """
+    Context manager to group reads and writes into one transaction.
+    All changes are committed together when the outermost block exits, or 
+    rolled back if an error occurs. Nested blocks (also the ones used by the
+    helper functions) join the outer transaction, so that the other process
+    never sees a half-written table.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `conn`(sqlite3.Connection): Connection to the database.
+    Example:
+    with transactionDB(db_path):
+        updateValueDB(db_path, 'Volumes', 'P1', new_value=1000)
+        setFlagDB(db_path, 'Volumes_flag')
+    
+    """
+    conn = connectDB(db_path)
+    depths = getattr(_db_local, 'depths', None)
+    if depths == None:
+        depths = _db_local.depths = {}
+    
+    depths[db_path] = depths.get(db_path, 0) + 1
+    try:
+        yield conn
+    except BaseException:
+        depths[db_path] -= 1
+        if depths[db_path] == 0:
+            conn.rollback()
+        raise
+    else:
+        depths[db_path] -= 1
+        if depths[db_path] == 0:
+            conn.commit()
+
+#Column names per table, key: (db_path, table). Value: (list of names, set of 
+#names, set of names in lower case). Filled by columnsDB()
+_db_columns = {}
+
+def _columnInfoDB(db_path, table):
+    """
+    Return the cached column names of a table, see columnsDB().
+    
+    """
+    info = _db_columns.get((db_path, table))
+    if info == None:
+        conn = connectDB(db_path)
+        #Table names can not be parameters, quote the name.
+        rows = conn.execute('PRAGMA table_info("{}")'.format('{}'.format(table).replace('"', '""'))).fetchall()
+        if rows == []:
+            raise sqlite3.OperationalError('no such table: {}'.format(table))
+        names = [r[1] for r in rows]
+        info = _db_columns[(db_path, table)] = (names, set(names), set(n.lower() for n in names))
+    return info
+
+def columnsDB(db_path, table):
+    """
+    Return the column names of a table (or view) of the database. 
+    The names are cached, use clearColumnsDB() after changing the schema.
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table.
+    Returns:
+    List of column names.
+    Raises sqlite3.OperationalError if the table does not exist.
+    
+    """
+    return list(_columnInfoDB(db_path, table)[0])
+
+def checkColumnsDB(db_path, table, columns=[]):
+    """
+    Check that the table and columns exist, before they are used in SQL.
+    Table and column names can not be passed as parameters.
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table.
+    `columns`(list): Column names. None is ignored.
+    Raises sqlite3.OperationalError if the table or a column does not exist.
+    
+    """
+    names, names_set, lower_set = _columnInfoDB(db_path, table)
+    for c in columns:
+        #Names are case insensitive in sqlite
+        if c != None and c not in names_set and '{}'.format(c).lower() not in lower_set:
+            raise sqlite3.OperationalError('no such column: {}'.format(c))
+
+def clearColumnsDB(db_path=None):
+    """
+    Clear the cache of columnsDB(). 
+    Input:
+    `db_path`(str): Full path to database. If None, clears all databases.
+    
+    """
+    for key in list(_db_columns.keys()):
+        if db_path == None or key[0] == db_path:
+            _db_columns.pop(key, None)
+
 #=============================================================================
 # Make a sqlite3 database for FISH2 System
 #=============================================================================
 
-def newFISHdb(db_name):
+def newFISHdb(db_name, wal=False, busy_timeout=None, schema=1):
     """
     Make a new database for the FISH2 system.
     Creates tables for: Flags, Parameters, Volumes, Targets, Ports, Hybmix and
@@ -300,13 +730,25 @@ def newFISHdb(db_name):
     deletes all values.
     Input:
     `db_name`(str): Name of the database.
+    `wal`(bool): If True, puts the database in WAL mode so that the user 
+        program and the FISH2 program do not block each other. If False, 
+        uses the default rollback journal. Default = False
+    `busy_timeout`(int/float): Seconds to wait for a lock held by the other 
+        process. If None, uses the current setting (5 seconds by default). 
+    `schema`(int): 1 for the original single row tables, 2 for the 
+        normalised schema, see migrateDB(). An existing database with schema
+        1 is migrated if schema is 2. An existing database with schema 2 
+        keeps schema 2. Default = 1
     Returns:
     `FISH_db_path`(str): Path to the (newly created) database.
     
     """
+    if busy_timeout != None:
+        configureDB(busy_timeout=busy_timeout)
+
     #Check if db folder exists, otherwise create
     cwd = os.getcwd() #Current working directory
-    FISH_db_folder = cwd + '\FISH_database' #Backslash for Windows
+    FISH_db_folder = os.path.join(cwd, 'FISH_database')
     if not os.path.exists(FISH_db_folder):    
         os.makedirs(FISH_db_folder)
 
@@ -315,12 +757,12 @@ def newFISHdb(db_name):
         db_name = db_name + '.sqlite'
 
     #Check if FISH_exp_db exists, otherwise create 
-    FISH_db_path = FISH_db_folder + '\\' +  db_name
+    FISH_db_path = os.path.join(FISH_db_folder, db_name)
         
     if not os.path.isfile(FISH_db_path):
         print('No existing database found in location {}. New will be made...'.format(FISH_db_path))
         
-        conn = sqlite3.connect(FISH_db_path)
+        conn = connectDB(FISH_db_path)
         with conn:
             cursor = conn.cursor()
             
@@ -666,10 +1108,14 @@ def newFISHdb(db_name):
             cursor.execute("INSERT INTO Alert_volume DEFAULT VALUES")
             print('New database created.')
         
+    elif schemaVersionDB(FISH_db_path) == 2:
+        print('FISH DB already exists, all content will be deleted')
+        resetDB_v2(FISH_db_path)
+
     else:
         print('FISH DB already exists, all content will be deleted')
         
-        conn = sqlite3.connect(FISH_db_path)
+        conn = connectDB(FISH_db_path)
         with conn:
             cursor = conn.cursor()
             
@@ -698,6 +1144,18 @@ def newFISHdb(db_name):
             cursor.execute("DELETE FROM Alert_volume")
             cursor.execute("INSERT INTO Alert_volume DEFAULT VALUES")
 
+    clearColumnsDB(FISH_db_path)
+    makeVolumeLedgerDB(FISH_db_path, reset=True)
+    makeDeviceCacheDB(FISH_db_path)
+
+    #Normalised schema is opt-in
+    if schema == 2 and schemaVersionDB(FISH_db_path) == 1:
+        migrateDB(FISH_db_path, backup=False)
+
+    #Journal mode, WAL is opt-in
+    if wal == True:
+        journal_mode = setWalModeDB(FISH_db_path, wal=True)
+        print('Database journal mode: {}'.format(journal_mode))
 
     return FISH_db_path
 
@@ -708,11 +1166,10 @@ def newRowDB(db_path, table, new_row):
     `db_path`(str): Full path to database.
     `table`(str): Name of table to insert into.
     `new_row`(tuple): Tuple of items to insert. Like: ('text1', 'text2', 3, 4)
-    WARNING: The function does not check if the input is valid and executed.
     
     """
-    conn = sqlite3.connect(db_path)
-    with conn:
+    checkColumnsDB(db_path, table)
+    with transactionDB(db_path) as conn:
         cursor = conn.cursor()
         
         q_marks = ('?,'* len(new_row))[:-1]
@@ -731,17 +1188,18 @@ def returnRowDB(db_path, table, criteria_column=None, criteria=None):
     Tuple of the retrieved row form selected table and selected row.
     
     """
-    conn = sqlite3.connect(db_path)
-    with conn:
+    checkColumnsDB(db_path, table, [criteria_column])
+    with transactionDB(db_path) as conn:
         cursor = conn.cursor()
 
         if criteria_column is not None:
-            cursor.execute("SELECT * FROM {} WHERE {}='{}'".format(table,
-                                                                   criteria_column,
-                                                                   criteria))
+            cursor.execute("SELECT * FROM {} WHERE {} = ?".format(table, criteria_column),
+                           ('{}'.format(criteria),))
         else:
             cursor.execute("SELECT * FROM {}".format(table))
         row = cursor.fetchone()
+        #Release the statement, the connection stays open.
+        cursor.close()
         return row
 
 def returnValueDB(db_path, table, column, criteria_column, criteria):
@@ -755,22 +1213,22 @@ def returnValueDB(db_path, table, column, criteria_column, criteria):
     `cirteria`: criteria value in the specified column. Example: '2' (where ID=2)
     Returns:
     Retrieved value from selected table, column and row.
-    WARNING: The function does not check if the input is valid.
     
     """
-    conn = sqlite3.connect(db_path)
-    with conn:
+    checkColumnsDB(db_path, table, [column, criteria_column])
+    with transactionDB(db_path) as conn:
         cursor = conn.cursor()
     
-        cursor.execute("SELECT {} FROM {} WHERE {}='{}'".format(column,table,
-                                                                criteria_column,
-                                                                criteria))
+        cursor.execute("SELECT {} FROM {} WHERE {} = ?".format(column, table, criteria_column),
+                       ('{}'.format(criteria),))
         try:
             row = cursor.fetchone()[0]
             return row
         except Exception as e:
             print('Error, could not select a valid value from sqlite3 db')
             print('Error message: ', e)
+        finally:
+            cursor.close()
 
 def updateValueDB(db_path, table, column, new_value=None, criteria_column=None, 
                   criteria=None, operation=None, value=None):
@@ -785,35 +1243,140 @@ def updateValueDB(db_path, table, column, new_value=None, criteria_column=None,
     `criteria`: criteria value in the specified column. Example: '2' (where ID=2)
     `operation`(str): '+' or '-', add or substract from a value. (atomic)
     `value`(int/flt): value to add or substract.
-    WARNING: The function does not check if the input is valid and executed.
     
     """
-    if returnRowDB(db_path, table) == None:
+    checkColumnsDB(db_path, table, [column, criteria_column])
+    if operation not in [None, '+', '-']:
+        raise ValueError('Invalid operation: {}, use "+" or "-"'.format(operation))
+    key_value = isKeyValueDB(db_path, table)
+    if key_value == False and returnRowDB(db_path, table) == None:
         newRowDB(db_path, table, (None, None))
     
-    conn = sqlite3.connect(db_path)
-    with conn:
+    with transactionDB(db_path) as conn:
         cursor = conn.cursor()
         
-
-        if operation == None and criteria == None:
-            cursor.execute("UPDATE {} SET {} = '{}'".format(table, 
-                                                            column,
-                                                            new_value))
+        #Schema v2, change the single row directly without the view.
+        if key_value == True and criteria == None:
+            if operation == None:
+                cursor.execute("UPDATE {}_kv SET Value = ? WHERE Key = ?".format(table),
+                               ('{}'.format(new_value), column))
+            else:
+                cursor.execute("UPDATE {}_kv SET Value = Value {} ? WHERE Key = ?".format(table, operation),
+                               (value, column))
+            if cursor.rowcount == 0:
+                raise sqlite3.OperationalError('no such column: {}'.format(column))
+
+        elif operation == None and criteria == None:
+            cursor.execute("UPDATE {} SET {} = ?".format(table, column), 
+                           ('{}'.format(new_value),))
                                                                   
         elif operation == None:
-            cursor.execute("UPDATE {} SET {} = '{}' WHERE {} = '{}'".format(
-                                                                    table, 
-                                                                    column, 
-                                                                    new_value,
-                                                                    criteria_column,
-                                                                    criteria))  
+            cursor.execute("UPDATE {} SET {} = ? WHERE {} = ?".format(table, column, criteria_column),
+                           ('{}'.format(new_value), '{}'.format(criteria)))
         elif operation != None:
-            cursor.execute("UPDATE {} SET {} = {} {} {}".format(table, 
-                                                                column,
-                                                                column,
-                                                                operation,
-                                                                value))
+            cursor.execute("UPDATE {0} SET {1} = {1} {2} ?".format(table, column, operation),
+                           (value,))
+
+def updateRowDB(db_path, table, new_values, criteria_column=None, criteria=None):
+    """
+    Update multiple values of a row in a single statement.
+    Values are stored in the same way as with updateValueDB().
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table to update.
+    `new_values`(dict): Dictionary with column names and new values.
+    `criteria_column`(str): Name of column to select row by. Example: 'Code'
+    `criteria`: criteria value in the specified column. Example: 'C1H01'
+    
+    """
+    if new_values == {}:
+        return
+    columns = list(new_values.keys())
+    checkColumnsDB(db_path, table, columns + [criteria_column])
+    #updateValueDB() writes all values as text, keep the same representation.
+    values = ['{}'.format(new_values[c]) for c in columns]
+    assignments = ', '.join('{} = ?'.format(c) for c in columns)
+    
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        
+        if criteria_column == None:
+            #The views of schema v2 always have one row
+            if isKeyValueDB(db_path, table) == False and returnRowDB(db_path, table) == None:
+                cursor.execute("INSERT INTO {} DEFAULT VALUES".format(table))
+            cursor.execute("UPDATE {} SET {}".format(table, assignments), values)
+        else:
+            cursor.execute("UPDATE {} SET {} WHERE {} = ?".format(table, 
+                                                                 assignments,
+                                                                 criteria_column),
+                           values + ['{}'.format(criteria)])
+
+def diffRowDB(db_path, table, new_values, criteria_column=None, criteria=None,
+              null_is_none=False):
+    """
+    Compare new values with the values of a row in the database.
+    Values are compared the way updateRowDB() would store them, including the
+    type conversion of the column. Like: 100 and '100.0' are equal in a REAL
+    column.
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table to compare with.
+    `new_values`(dict): Dictionary with column names and new values.
+    `criteria_column`(str): Name of column to select row by. Example: 'Code'
+    `criteria`: criteria value in the specified column. Example: 'C1H01'
+    `null_is_none`(bool): If True, None is also equal to NULL. For rows made
+        with newRowDB(), that stores None as NULL. Default = False
+    Returns:
+    Dictionary with the columns and new values that differ from the database.
+    All new values if the row does not exist.
+    
+    """
+    if new_values == {}:
+        return {}
+    columns = list(new_values.keys())
+    checkColumnsDB(db_path, table, columns + [criteria_column])
+    values = ['{}'.format(new_values[c]) for c in columns]
+    #Let sqlite compare, so that the column affinity is applied to the new values
+    comparisons = ', '.join('({0} IS ? OR {0} IS NULL)'.format(c) if null_is_none and new_values[c] == None 
+                            else '{} IS ?'.format(c) for c in columns)
+    
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        if criteria_column == None:
+            cursor.execute("SELECT {} FROM {}".format(comparisons, table), values)
+        else:
+            cursor.execute("SELECT {} FROM {} WHERE {} = ?".format(comparisons,
+                                                                  table,
+                                                                  criteria_column),
+                           values + ['{}'.format(criteria)])
+        equal = cursor.fetchone()
+        cursor.close()
+    
+    if equal == None:
+        return dict(new_values)
+    return {c: new_values[c] for c, e in zip(columns, equal) if e == 0}
+
+def syncRowDB(db_path, table, new_values, criteria_column=None, criteria=None,
+              null_is_none=False):
+    """
+    Update only the values of a row that differ from the new values.
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table to update.
+    `new_values`(dict): Dictionary with column names and new values.
+    `criteria_column`(str): Name of column to select row by. Example: 'Code'
+    `criteria`: criteria value in the specified column. Example: 'C1H01'
+    `null_is_none`(bool): If True, None is also equal to NULL. See diffRowDB()
+    Returns:
+    Dictionary with the changed columns and their new values.
+    
+    """
+    with transactionDB(db_path):
+        changed = diffRowDB(db_path, table, new_values, criteria_column=criteria_column, 
+                            criteria=criteria, null_is_none=null_is_none)
+        updateRowDB(db_path, table, changed, criteria_column=criteria_column, 
+                    criteria=criteria)
+    return changed
 
 def deleteRowDB(db_path, table, criteria_column, criteria, startswith=False):
     """
@@ -827,21 +1390,18 @@ def deleteRowDB(db_path, table, criteria_column, criteria, startswith=False):
     `startswith`(bool): If False uses full criteria. If True selects rows that
         start with the criteria. Default = False
         Example: 'Left_12' will be selected if criteria is 'Left'
-    WARNING: The function does not check if the input is valid and executed.
     
     """
-    conn = sqlite3.connect(db_path)
-    with conn:
+    checkColumnsDB(db_path, table, [criteria_column])
+    with transactionDB(db_path) as conn:
         cursor = conn.cursor()
         if startswith==False:
-            cursor.execute("DELETE FROM {}  WHERE {} = '{}'".format(table, 
-                                                                    criteria_column,
-                                                                    criteria ))
+            cursor.execute("DELETE FROM {} WHERE {} = ?".format(table, criteria_column),
+                           ('{}'.format(criteria),))
         elif startswith==True:
             start = criteria + '%'
-            cursor.execute("DELETE FROM {}  WHERE {} like '{}'".format(table, 
-                                                                    criteria_column,
-                                                                    start ))
+            cursor.execute("DELETE FROM {} WHERE {} LIKE ?".format(table, criteria_column),
+                           (start,))
 
 def setFlagDB(db_path, flag):
     """
@@ -857,6 +1417,509 @@ def removeFlagDB(db_path, flag):
     """
     updateValueDB(db_path, 'Flags', flag, new_value=0)
 
+def dataVersionDB(db_path):
+    """
+    Return a version of the database that changes every time a change is 
+    committed, by this or by another process (like the user program). 
+    Comparing versions is much cheaper than reading a table.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `version`(tuple): (connection, data_version, total_changes). 
+        "data_version" changes when another connection commits, 
+        "total_changes" when this connection makes a change. Both only have
+        a meaning for one connection, and every thread has its own 
+        connection. So "connection", the number of the connection, makes sure
+        that versions of different threads are never equal.
+    
+    """
+    conn = connectDB(db_path)
+    cursor = conn.execute("PRAGMA data_version")
+    data_version = cursor.fetchone()[0]
+    cursor.close()
+    return (_db_local.numbers[db_path], data_version, conn.total_changes)
+
+def waitChangeDB(db_path, version, timeout=None, interval=0.05):
+    """
+    Wait until the database changes or the timeout is reached. Returns as 
+    soon as the user program commits a change, for instance when it removes 
+    the Pause_flag.
+    Input:
+    `db_path`(str): Full path to database.
+    `version`(tuple): Version to compare to, from dataVersionDB().
+    `timeout`(int/float): Maximum time to wait in seconds. If None, waits 
+        until there is a change. Default = None
+    `interval`(float): Seconds between version checks. Default = 0.05
+    Returns:
+    `version`(tuple): Current version of the database.
+    
+    """
+    if timeout != None:
+        stop = time.time() + timeout
+    while True:
+        current = dataVersionDB(db_path)
+        if current != version:
+            return current
+        if timeout != None:
+            remaining = stop - time.time()
+            if remaining <= 0:
+                return current
+            time.sleep(min(interval, remaining))
+        else:
+            time.sleep(interval)
+
+#=============================================================================
+# Normalised database schema (v2)
+#=============================================================================
+
+#Schema v2 stores the single row tables as one row per key. The Parameters are
+#split in general parameters and one row per chamber. Views with the original
+#table names and columns keep all functions working with both schemas.
+
+#Single row tables that are stored as key/value rows
+db_kv_tables = ['Flags', 'Volumes', 'Ports', 'Hybmix', 'Machines', 
+                'Machine_identification', 'Fixed_USB_port', 'Operator_address', 
+                'Padding', 'Alert_volume']
+
+#Schema version per database, key: db_path. Filled by schemaVersionDB()
+_db_schema = {}
+
+def schemaVersionDB(db_path):
+    """
+    Return the schema version of the database.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    1 for the original single row tables, 2 for the normalised schema.
+    
+    """
+    version = _db_schema.get(db_path)
+    if version == None:
+        user_version = connectDB(db_path).execute("PRAGMA user_version").fetchone()[0]
+        version = _db_schema[db_path] = 2 if user_version >= 2 else 1
+    return version
+
+def isKeyValueDB(db_path, table):
+    """
+    Return True if the table is stored as key/value rows (schema v2).
+    Input:
+    `db_path`(str): Full path to database.
+    `table`(str): Name of table.
+    
+    """
+    return table in db_kv_tables and schemaVersionDB(db_path) == 2
+
+def chamberColumn(column):
+    """
+    Split a column of the Parameters table in the name without chamber 
+    number and the chamber number.
+    Input:
+    `column`(str): Column name. Like: 'Hyb_time_1_A'
+    Returns:
+    Name and chamber number. Like: ('Hyb_time_A', 1)
+    Chamber is None for general parameters. Like: ('Operator', None)
+    
+    """
+    match = re.match(r'^(.+)_([12])(_[A-Z])?$', column)
+    if match == None:
+        return column, None
+    return match.group(1) + (match.group(3) or ''), int(match.group(2))
+
+def _migrateKeyValueTable(cursor, table):
+    """
+    Replace a single row table by a key/value table and a view. 
+    Used by migrateDB().
+    
+    """
+    columns = cursor.execute("PRAGMA table_info({})".format(table)).fetchall()
+    names = [c[1] for c in columns]
+    types = set(c[2] for c in columns)
+    if len(types) != 1:
+        raise Exception('Can not migrate {}, columns have different types: {}'.format(table, types))
+    value_type = types.pop()
+    
+    row = cursor.execute("SELECT * FROM {}".format(table)).fetchone()
+    if row == None:
+        row = [None] * len(names)
+    
+    cursor.execute("DROP TABLE {}".format(table))
+    cursor.execute("CREATE TABLE {}_kv (Key TEXT PRIMARY KEY, Value {}) WITHOUT ROWID".format(table, value_type))
+    cursor.executemany("INSERT INTO {}_kv VALUES (?, ?)".format(table), zip(names, row))
+    
+    #View with the original columns, the subqueries keep the column type.
+    select = ', '.join("(SELECT Value FROM {0}_kv WHERE Key = '{1}') AS {1}".format(table, n) for n in names)
+    cursor.execute("CREATE VIEW {} AS SELECT {}".format(table, select))
+    #Only the updated columns are written
+    for n in names:
+        cursor.execute("""CREATE TRIGGER {0}_update_{1} INSTEAD OF UPDATE OF {1} ON {0} 
+                        BEGIN UPDATE {0}_kv SET Value = NEW.{1} WHERE Key = '{1}'; END""".format(table, n))
+
+def _migrateParameters(cursor):
+    """
+    Replace the Parameters table by a table with the general parameters, a 
+    table with one row per chamber and a view. Used by migrateDB().
+    
+    """
+    columns = cursor.execute("PRAGMA table_info(Parameters)").fetchall()
+    row = cursor.execute("SELECT * FROM Parameters").fetchone()
+    if row == None:
+        row = [None] * len(columns)
+    
+    general = collections.OrderedDict()
+    chambers = {1: collections.OrderedDict(), 2: collections.OrderedDict()}
+    chamber_types = collections.OrderedDict()
+    view = []
+    for c, value in zip(columns, row):
+        name, column_type = c[1], c[2]
+        base, chamber = chamberColumn(name)
+        if chamber == None:
+            general[name] = value
+            view.append(('g.{}'.format(name), name, 'UPDATE Parameters_general SET {0} = NEW.{0};'.format(name)))
+        else:
+            chambers[chamber][base] = value
+            chamber_types[base] = column_type
+            view.append(('c{}.{}'.format(chamber, base), name, 
+                         'UPDATE Parameters_chamber SET {} = NEW.{} WHERE Chamber = {};'.format(base, name, chamber)))
+    if list(chambers[1].keys()) != list(chambers[2].keys()):
+        raise Exception('Can not migrate Parameters, parameters of chamber 1 and 2 are not the same.')
+    general_types = {c[1]: c[2] for c in columns}
+    
+    cursor.execute("DROP TABLE Parameters")
+    cursor.execute("CREATE TABLE Parameters_general ({})".format(
+                   ', '.join('{} {}'.format(k, general_types[k]) for k in general)))
+    cursor.execute("INSERT INTO Parameters_general VALUES ({})".format(('?,' * len(general))[:-1]), 
+                   list(general.values()))
+    cursor.execute("CREATE TABLE Parameters_chamber (Chamber INTEGER PRIMARY KEY, {})".format(
+                   ', '.join('{} {}'.format(k, t) for k, t in chamber_types.items())))
+    for chamber, values in chambers.items():
+        cursor.execute("INSERT INTO Parameters_chamber VALUES ({})".format(('?,' * (len(values) + 1))[:-1]), 
+                       [chamber] + list(values.values()))
+    
+    cursor.execute("""CREATE VIEW Parameters AS SELECT {} 
+                    FROM Parameters_general AS g, Parameters_chamber AS c1, Parameters_chamber AS c2 
+                    WHERE c1.Chamber = 1 AND c2.Chamber = 2""".format(
+                    ', '.join('{} AS {}'.format(source, name) for source, name, update in view)))
+    for source, name, update in view:
+        cursor.execute("""CREATE TRIGGER Parameters_update_{0} INSTEAD OF UPDATE OF {0} ON Parameters 
+                        BEGIN {1} END""".format(name, update))
+
+def migrateDB(db_path, backup=True):
+    """
+    Migrate a database with the original single row tables (v1) to the
+    normalised schema (v2). The data is kept, the functions of this module
+    return the same values and dictionaries for both schemas.
+    Stop the user program and the FISH2 program before migrating.
+    Input:
+    `db_path`(str): Full path to database.
+    `backup`(bool): If True, makes a copy of the database first, named:
+        "<db_name>_v1_backup.sqlite". Default = True
+    
+    """
+    if schemaVersionDB(db_path) == 2:
+        print('Database already uses schema v2: {}'.format(db_path))
+        return
+
+    if backup == True:
+        backup_path = copyDB(db_path, os.path.splitext(db_path)[0] + '_v1_backup.sqlite')
+        print('Backup of database made: {}'.format(backup_path))
+
+    with transactionDB(db_path) as conn:
+        #Also the table changes need to be in the transaction
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        cursor = conn.cursor()
+        for table in db_kv_tables:
+            _migrateKeyValueTable(cursor, table)
+        _migrateParameters(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS Targets_Code ON Targets (Code)")
+        cursor.execute("PRAGMA user_version = 2")
+    _db_schema[db_path] = 2
+    clearColumnsDB(db_path)
+    print('Database migrated to schema v2: {}'.format(db_path))
+
+def resetDB_v2(db_path):
+    """
+    Delete all values of a database with schema v2. Used by newFISHdb().
+    Input:
+    `db_path`(str): Full path to database.
+    
+    """
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        for table in db_kv_tables:
+            cursor.execute("UPDATE {}_kv SET Value = NULL".format(table))
+        cursor.execute("DELETE FROM Parameters_general")
+        cursor.execute("INSERT INTO Parameters_general DEFAULT VALUES")
+        cursor.execute("DELETE FROM Parameters_chamber")
+        cursor.execute("INSERT INTO Parameters_chamber (Chamber) VALUES (1), (2)")
+        cursor.execute("DELETE FROM Targets")
+        cursor.execute("INSERT INTO Targets DEFAULT VALUES")
+
+#=============================================================================
+# Buffer volume ledger
+#=============================================================================
+
+#The FISH2 program does not update the Volumes table for every pump stroke.
+#Every change is added as a new row to the Volume_ledger table and the
+#ledger is regularly folded into the Volumes table by compactVolumeLedgerDB().
+#The ledger is never changed, only the ID of the last folded row is stored in
+#Volume_ledger_state. The current volumes are the Volumes table plus the rows
+#that are not folded yet, see returnVolumesDB().
+
+def makeVolumeLedgerDB(db_path, reset=False):
+    """
+    Make the volume ledger tables if they do not exist. Used by newFISHdb().
+    Input:
+    `db_path`(str): Full path to database.
+    `reset`(bool): If True, deletes the ledger of the previous run.
+        Default = False
+
+    """
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Volume_ledger (
+                        ID INTEGER PRIMARY KEY,
+                        Time REAL,
+                        Port TEXT,
+                        Delta REAL,
+                        Operation TEXT)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Volume_ledger_state (
+                        Compacted_ID INTEGER)""")
+        if reset == True:
+            cursor.execute("DELETE FROM Volume_ledger")
+            cursor.execute("DELETE FROM Volume_ledger_state")
+        if cursor.execute("SELECT COUNT(*) FROM Volume_ledger_state").fetchone()[0] == 0:
+            cursor.execute("INSERT INTO Volume_ledger_state (Compacted_ID) VALUES (0)")
+
+def appendVolumeLedgerDB(db_path, port, operation, value):
+    """
+    Add a volume change of a buffer to the ledger. Replaces:
+    updateValueDB(db_path, 'Volumes', port, operation=operation, value=value)
+    Input:
+    `db_path`(str): Full path to database.
+    `port`(str): Port of the buffer, like: 'P1'.
+    `operation`(str): '+' or '-', add or substract from the volume.
+    `value`(int/flt): Volume to add or substract.
+
+    """
+    checkColumnsDB(db_path, 'Volumes', [port])
+    if operation not in ['+', '-']:
+        raise ValueError('Invalid operation: {}, use "+" or "-"'.format(operation))
+    delta = value if operation == '+' else -value
+    with transactionDB(db_path) as conn:
+        conn.execute("INSERT INTO Volume_ledger (Time, Port, Delta, Operation) VALUES (?, ?, ?, ?)",
+                     (time.time(), port, delta, operation))
+
+def _pendingVolumesDB(cursor):
+    """
+    Return the ID of the last folded row and the summed changes per port of
+    the ledger rows that are not folded into the Volumes table yet.
+
+    """
+    compacted_id = cursor.execute("SELECT Compacted_ID FROM Volume_ledger_state").fetchone()[0]
+    cursor.execute("""SELECT Port, SUM(Delta), MAX(ID) FROM Volume_ledger
+                   WHERE ID > ? GROUP BY Port ORDER BY MIN(ID)""", (compacted_id,))
+    return compacted_id, cursor.fetchall()
+
+def returnVolumesDB(db_path):
+    """
+    Return the current buffer volumes: the Volumes table plus the changes in
+    the ledger that are not folded yet. Use instead of returnDictDB() for the
+    Volumes table. Also gives the exact volumes after a crash.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `volumes`(dict): Volume per port, like: returnDictDB(db_path, 'Volumes')[0]
+
+    """
+    with transactionDB(db_path) as conn:
+        #Read both tables from the same snapshot
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        volumes = returnDictDB(db_path, 'Volumes')[0]
+        compacted_id, pending = _pendingVolumesDB(conn.cursor())
+
+    for port, delta, last_id in pending:
+        #Like sqlite, text like 'None' counts as 0
+        current = volumes.get(port)
+        volumes[port] = (current if isinstance(current, (int, float)) else 0) + delta
+    return volumes
+
+def compactVolumeLedgerDB(db_path):
+    """
+    Fold the new rows of the volume ledger into the Volumes table. The ledger
+    itself is kept as history of the run.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `folded`(int): Number of ports that are updated.
+
+    """
+    with transactionDB(db_path) as conn:
+        #Lock before reading, so that the user program and the FISH2 program
+        #can not fold the same rows.
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.cursor()
+        compacted_id, pending = _pendingVolumesDB(cursor)
+        if pending == []:
+            return 0
+        for port, delta, last_id in pending:
+            updateValueDB(db_path, 'Volumes', port, operation='+', value=delta)
+        cursor.execute("UPDATE Volume_ledger_state SET Compacted_ID = ?",
+                       (max(p[2] for p in pending),))
+    return len(pending)
+
+def returnVolumeLedgerDB(db_path, port=None):
+    """
+    Return the history of the buffer volumes of the current run.
+    Input:
+    `db_path`(str): Full path to database.
+    `port`(str): Only return the changes of this port. If None, returns all.
+        Default = None
+    Returns:
+    List of dictionaries with: ID, Time, Port, Delta and Operation.
+
+    """
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        if port == None:
+            cursor.execute("SELECT * FROM Volume_ledger ORDER BY ID")
+        else:
+            cursor.execute("SELECT * FROM Volume_ledger WHERE Port = ? ORDER BY ID", (port,))
+        return cursor.fetchall()
+
+#Running compaction threads per database, see startVolumeLedgerCompaction()
+_compaction_threads = {}
+_compaction_lock = threading.Lock()
+
+def startVolumeLedgerCompaction(db_path, interval=60):
+    """
+    Fold the volume ledger into the Volumes table in a background thread.
+    A compaction thread that is already running on the same database is 
+    stopped first.
+    Input:
+    `db_path`(str): Full path to database.
+    `interval`(int/float): Seconds between compactions. Default = 60
+    Returns:
+    `stop`(threading.Event): Set to stop the thread, it compacts one last time.
+        Or use stopVolumeLedgerCompaction() to also wait for it.
+
+    """
+    makeVolumeLedgerDB(db_path)
+    stopVolumeLedgerCompaction(db_path)
+    stop = threading.Event()
+
+    def compaction():
+        while True:
+            stopped = stop.wait(interval)
+            try:
+                compactVolumeLedgerDB(db_path)
+            except Exception as e:
+                #Not a problem, the rows are folded the next time
+                print('Error, could not compact the volume ledger')
+                print('Error message: ', e)
+            if stopped:
+                closeDB(db_path)
+                return
+
+    thread = threading.Thread(target=compaction, name='volumeLedgerCompaction', daemon=True)
+    with _compaction_lock:
+        _compaction_threads[db_path] = (stop, thread)
+    thread.start()
+    return stop
+
+def stopVolumeLedgerCompaction(db_path, timeout=None):
+    """
+    Stop the compaction thread of a database and wait until it compacted the
+    ledger one last time. Does nothing if no thread is running.
+    Input:
+    `db_path`(str): Full path to database.
+    `timeout`(int/float): Seconds to wait for the thread. None waits until 
+        it is done. Default = None
+
+    """
+    with _compaction_lock:
+        running = _compaction_threads.pop(db_path, None)
+    if running != None:
+        stop, thread = running
+        stop.set()
+        thread.join(timeout)
+
+#=============================================================================
+# Serial device cache
+#=============================================================================
+
+#The FISH2 program stores the address of the devices it found in the 
+#Device_cache table, together with the serial number of the USB to serial
+#converter. At the next start the cached address is checked first, only if
+#that fails all serial ports are searched. See deviceAddress() in 
+#FISH2_functions.py. The cache is kept between runs.
+
+def makeDeviceCacheDB(db_path):
+    """
+    Make the Device_cache table if it does not exist. Used by newFISHdb().
+    Input:
+    `db_path`(str): Full path to database.
+
+    """
+    with transactionDB(db_path) as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS Device_cache (
+                        Machine TEXT PRIMARY KEY,
+                        Serial_number TEXT,
+                        Address TEXT,
+                        Time REAL)""")
+
+def returnDeviceCacheDB(db_path):
+    """
+    Return the cached device addresses.
+    Input:
+    `db_path`(str): Full path to database.
+    Returns:
+    `cache`(dict): Dictionary with the machine name as key and a dictionary
+        with: Serial_number, Address and Time (of the last update) as value.
+
+    """
+    makeDeviceCacheDB(db_path)
+    with transactionDB(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        cursor.execute("SELECT * FROM Device_cache")
+        return {row.pop('Machine'): row for row in cursor.fetchall()}
+
+def updateDeviceCacheDB(db_path, machine, address, serial_number=None):
+    """
+    Add or replace the cached address of a device.
+    Input:
+    `db_path`(str): Full path to database.
+    `machine`(str): Name of the machine as in the Machines table.
+    `address`(str): Address of the device, like: 'COM3' or '/dev/ttyUSB0'.
+    `serial_number`(str): Serial number of the USB to serial converter, 
+        None if unknown. Default = None
+
+    """
+    makeDeviceCacheDB(db_path)
+    with transactionDB(db_path) as conn:
+        conn.execute("INSERT OR REPLACE INTO Device_cache (Machine, Serial_number, Address, Time) VALUES (?, ?, ?, ?)",
+                     (machine, serial_number, address, time.time()))
+
+def removeDeviceCacheDB(db_path, machine=None):
+    """
+    Remove the cached address of a device, for instance after moving USB
+    cables when a static address is used.
+    Input:
+    `db_path`(str): Full path to database.
+    `machine`(str): Name of the machine. If None, removes all. Default = None
+
+    """
+    makeDeviceCacheDB(db_path)
+    with transactionDB(db_path) as conn:
+        if machine == None:
+            conn.execute("DELETE FROM Device_cache")
+        else:
+            conn.execute("DELETE FROM Device_cache WHERE Machine = ?", (machine,))
+
 #=============================================================================
 # Move data from .yaml file to database
 #=============================================================================
@@ -873,24 +1936,30 @@ def yamlToDB_Parameters(db_path, to_update='All'):
         'optProg' - Operator and Program
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Para_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Parameters')
 
     if to_update == 'All':
-        for k in Para_dict:
-                updateValueDB(db_path, 'Parameters', k, new_value=Para_dict[k])
+        new_values = Para_dict
     elif to_update == 1:
-        for k in Para_dict:
-            if k.endswith('1'):
-                updateValueDB(db_path, 'Parameters', k, new_value=Para_dict[k])
+        new_values = {k: v for k, v in Para_dict.items() if k.endswith('1')}
     elif to_update == 2:
-        for k in Para_dict:
-            if k.endswith('2'):
-                updateValueDB(db_path, 'Parameters', k, new_value=Para_dict[k])
+        new_values = {k: v for k, v in Para_dict.items() if k.endswith('2')}
     elif to_update == 'opProg':
-        updateValueDB(db_path, 'Parameters', 'Operator', new_value=Para_dict['Operator'])
-    setFlagDB(db_path, 'Parameters_flag')
+        new_values = {'Operator': Para_dict['Operator']}
+    else:
+        new_values = {}
+    
+    #Write the changed values and the flag in one transaction
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Parameters', new_values)
+        if changed != {}:
+            setFlagDB(db_path, 'Parameters_flag')
+    return changed
 
 def yamlToDB_Volumes(db_path):
     """
@@ -899,13 +1968,20 @@ def yamlToDB_Volumes(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Buf_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Volumes')
 
-    for k in Buf_dict:
-        updateValueDB(db_path, 'Volumes', k, new_value=Buf_dict[k]) 
-    setFlagDB(db_path, 'Volumes_flag')
+    with transactionDB(db_path):
+        #Fold the ledger first, the volumes of the datafile replace it.
+        compactVolumeLedgerDB(db_path)
+        changed = syncRowDB(db_path, 'Volumes', Buf_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Volumes_flag')
+    return changed
 
 def yamlToDB_Targets(db_path):
     """
@@ -915,41 +1991,52 @@ def yamlToDB_Targets(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values per Code. Like: {'C1H01': {'Cy3': 'Gad1'}}
     
     """
     Tar_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Targets')
+    changed = {}
     
-    # Iterate through levels: chamber, Hybridization & items
-    for chamber in Tar_dict:
-        for hybridization in Tar_dict[chamber]:
-            # Code to identify chamber and hybridization round
-            code = 'C{}H{}'.format(chamber[-1], hybridization[-2:])
-            
-            # Check if row already exisits 
-            if returnRowDB(db_path, 'Targets', criteria_column='Code', criteria=code) is not None:
+    with transactionDB(db_path):
+        # Iterate through levels: chamber, Hybridization & items
+        for chamber in Tar_dict:
+            for hybridization in Tar_dict[chamber]:
+                # Code to identify chamber and hybridization round
+                code = 'C{}H{}'.format(chamber[-1], hybridization[-2:])
                 
-                # Update existing row
-                for item in Tar_dict[chamber][hybridization]:
-                    updateValueDB(db_path, 'Targets', item, new_value=Tar_dict[chamber][hybridization][item], criteria_column='Code', criteria=code)
-            
-            # New row
-            else:
-                new_row = [code,
-                           int(chamber[-1]), 
-                           hybridization,
-                           Tar_dict[chamber][hybridization]['DAPI'],
-                           Tar_dict[chamber][hybridization]['Atto425'],
-                           Tar_dict[chamber][hybridization]['FITC'],
-                           Tar_dict[chamber][hybridization]['Cy3'], 
-                           Tar_dict[chamber][hybridization]['TxRed'],
-                           Tar_dict[chamber][hybridization]['Cy5'],
-                           Tar_dict[chamber][hybridization]['Cy7'], 
-                           Tar_dict[chamber][hybridization]['QDot'],
-                           Tar_dict[chamber][hybridization]['BrightField'],
-                           Tar_dict[chamber][hybridization]['Europium']]
-                newRowDB(db_path, 'Targets', new_row)
+                # Check if row already exisits 
+                if returnRowDB(db_path, 'Targets', criteria_column='Code', criteria=code) is not None:
+                    
+                    # Update changed values of existing row
+                    #New rows have NULL for empty values
+                    changed_row = syncRowDB(db_path, 'Targets', Tar_dict[chamber][hybridization], criteria_column='Code', 
+                                            criteria=code, null_is_none=True)
+                    if changed_row != {}:
+                        changed[code] = changed_row
                 
-    setFlagDB(db_path, 'Targets_flag')
+                # New row
+                else:
+                    changed[code] = dict(Tar_dict[chamber][hybridization])
+                    new_row = [code,
+                               int(chamber[-1]), 
+                               hybridization,
+                               Tar_dict[chamber][hybridization]['DAPI'],
+                               Tar_dict[chamber][hybridization]['Atto425'],
+                               Tar_dict[chamber][hybridization]['FITC'],
+                               Tar_dict[chamber][hybridization]['Cy3'], 
+                               Tar_dict[chamber][hybridization]['TxRed'],
+                               Tar_dict[chamber][hybridization]['Cy5'],
+                               Tar_dict[chamber][hybridization]['Cy7'], 
+                               Tar_dict[chamber][hybridization]['QDot'],
+                               Tar_dict[chamber][hybridization]['BrightField'],
+                               Tar_dict[chamber][hybridization]['Europium']]
+                    newRowDB(db_path, 'Targets', new_row)
+                    
+        if changed != {}:
+            setFlagDB(db_path, 'Targets_flag')
+    return changed
 
 def yamlToDB_Ports(db_path):
     """
@@ -958,13 +2045,18 @@ def yamlToDB_Ports(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Por_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Ports')
     
-    for k in Por_dict:
-        updateValueDB(db_path, 'Ports', k, new_value=Por_dict[k]) 
-    setFlagDB(db_path, 'Ports_flag')
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Ports', Por_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Ports_flag')
+    return changed
 
 def yamlToDB_Hybmix(db_path):
     """
@@ -973,12 +2065,17 @@ def yamlToDB_Hybmix(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Hyb_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Hybmix')
-    for k in Hyb_dict:
-        updateValueDB(db_path, 'Hybmix', k, new_value=Hyb_dict[k]) 
-    setFlagDB(db_path, 'Hybmix_flag')
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Hybmix', Hyb_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Hybmix_flag')
+    return changed
 
 def yamlToDB_Machines(db_path):
     """
@@ -987,12 +2084,17 @@ def yamlToDB_Machines(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     """
     Machines_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Machines')
 
-    for k in Machines_dict:
-        updateValueDB(db_path, 'Machines', k, new_value=Machines_dict[k]) 
-    setFlagDB(db_path, 'Machines_flag')   
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Machines', Machines_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Machines_flag')
+    return changed
 
 def yamlToDB_Machine_identification(db_path):
     """
@@ -1001,12 +2103,17 @@ def yamlToDB_Machine_identification(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     """
     Machine_identification_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Machine_identification')
 
-    for k in Machine_identification_dict:
-        updateValueDB(db_path, 'Machine_identification', k, new_value=Machine_identification_dict[k]) 
-    setFlagDB(db_path, 'Machine_identification_flag')   
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Machine_identification', Machine_identification_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Machine_identification_flag')
+    return changed
 
 def yamlToDB_Fixed_USB_port(db_path):
     """
@@ -1015,12 +2122,17 @@ def yamlToDB_Fixed_USB_port(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     """
     Fixed_USB_port_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Fixed_USB_port')
 
-    for k in Fixed_USB_port_dict:
-        updateValueDB(db_path, 'Fixed_USB_port', k, new_value=Fixed_USB_port_dict[k]) 
-    setFlagDB(db_path, 'Fixed_USB_port_flag')   
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Fixed_USB_port', Fixed_USB_port_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Fixed_USB_port_flag')
+    return changed
 
 def yamlToDB_Operator_address(db_path):
     """
@@ -1029,12 +2141,17 @@ def yamlToDB_Operator_address(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     """
     Operator_address_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Operator_address')
 
-    for k in Operator_address_dict:
-        updateValueDB(db_path, 'Operator_address', k, new_value=Operator_address_dict[k]) 
-    setFlagDB(db_path, 'Operator_address_flag')   
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Operator_address', Operator_address_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Operator_address_flag')
+    return changed
 
 def yamlToDB_Padding(db_path):
     """
@@ -1043,13 +2160,18 @@ def yamlToDB_Padding(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Pad_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Padding')
     
-    for k in Pad_dict:
-        updateValueDB(db_path, 'Padding', k, new_value=Pad_dict[k]) 
-    setFlagDB(db_path, 'Padding_flag')
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Padding', Pad_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Padding_flag')
+    return changed
 
 def yamlToDB_Alert_volume(db_path):
     """
@@ -1058,13 +2180,18 @@ def yamlToDB_Alert_volume(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    Only changed values are written, the flag is only set if there are changes.
+    Returns:
+    Dictionary with the changed values.
     
     """
     Pad_dict = getFISHSystemMetadata('FISH_System_datafile.yaml', table='Alert_volume')
     
-    for k in Pad_dict:
-        updateValueDB(db_path, 'Alert_volume', k, new_value=Pad_dict[k]) 
-    setFlagDB(db_path, 'Alert_volume_flag')
+    with transactionDB(db_path):
+        changed = syncRowDB(db_path, 'Alert_volume', Pad_dict)
+        if changed != {}:
+            setFlagDB(db_path, 'Alert_volume_flag')
+    return changed
 
 def yamlToDB_All(db_path):
     """
@@ -1074,20 +2201,27 @@ def yamlToDB_All(db_path):
     `db_path`(str): Full path to database.
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
+    All tables are committed in one transaction. Only changed values are 
+    written.
+    Returns:
+    Dictionary with the changed values of the changed tables.
     
     """    
     # Update all tables (Excluding flags)
-    yamlToDB_Parameters(db_path, to_update='All')
-    yamlToDB_Volumes(db_path)
-    yamlToDB_Targets(db_path)
-    yamlToDB_Ports(db_path)
-    yamlToDB_Hybmix(db_path)
-    yamlToDB_Machines(db_path)
-    yamlToDB_Machine_identification(db_path)
-    yamlToDB_Fixed_USB_port(db_path)
-    yamlToDB_Operator_address(db_path)
-    yamlToDB_Padding(db_path)
-    yamlToDB_Alert_volume(db_path)
+    changed = {}
+    with transactionDB(db_path):
+        changed['Parameters'] = yamlToDB_Parameters(db_path, to_update='All')
+        changed['Volumes'] = yamlToDB_Volumes(db_path)
+        changed['Targets'] = yamlToDB_Targets(db_path)
+        changed['Ports'] = yamlToDB_Ports(db_path)
+        changed['Hybmix'] = yamlToDB_Hybmix(db_path)
+        changed['Machines'] = yamlToDB_Machines(db_path)
+        changed['Machine_identification'] = yamlToDB_Machine_identification(db_path)
+        changed['Fixed_USB_port'] = yamlToDB_Fixed_USB_port(db_path)
+        changed['Operator_address'] = yamlToDB_Operator_address(db_path)
+        changed['Padding'] = yamlToDB_Padding(db_path)
+        changed['Alert_volume'] = yamlToDB_Alert_volume(db_path)
+    return {k: v for k, v in changed.items() if v != {}}
     
 
 #=============================================================================
@@ -1110,30 +2244,43 @@ def returnDictDB(db_path, table):
     `table`(str): Name of table to return as dictionary.
     
     """
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = dict_factory
-    with conn:
+    checkColumnsDB(db_path, table)
+    with transactionDB(db_path) as conn:
+        #Set the factory on the cursor, the connection is shared.
         cursor = conn.cursor()
+        cursor.row_factory = dict_factory
         cursor.execute("SELECT * FROM {}".format(table))
         return cursor.fetchall()
 
-def DBToYaml(db_path):
+def DBToYaml(db_path, tables=['Volumes', 'Machines']):
     """
     Function to copy all buffer volumes and active machines from the database to 
     the .yaml datafile.
+    All tables are written in one update of the datafile. The datafile is not
+    written if it already has the values of the database.
     Input:
     `db_path`(str): Full path to database.
+    `tables`(list): Tables to copy. Default = ['Volumes', 'Machines']
     Fixed input:
     Working data file: 'FISH_System_datafile.yaml'
     
     """
-    #Update current buffer volumes
-    current_Volumes = returnDictDB(db_path, 'Volumes')[0]
-    yamlUpdate('FISH_System_datafile.yaml', {'FISHSystem':{'Volumes': current_Volumes}})
-
-    #Update active machines
-    active_machines = returnDictDB(db_path, 'Machines')[0]
-    yamlUpdate('FISH_System_datafile.yaml', {'FISHSystem':{'Machines': active_machines}})
+    current = yamlLoaderCached('FISH_System_datafile.yaml')['FISHSystem']
+    
+    new = {}
+    for table in tables:
+        if table == 'Volumes':
+            db_values = returnVolumesDB(db_path)
+        else:
+            db_values = returnDictDB(db_path, table)[0]
+        #The database stores values as text, like: 'None' or 'True'
+        for k, v in db_values.items():
+            if v != current[table].get(k) and '{}'.format(v) != '{}'.format(current[table].get(k)):
+                new[table] = db_values
+                break
+    
+    if new != {}:
+        yamlUpdate('FISH_System_datafile.yaml', {'FISHSystem': new})
 
 
 #=============================================================================
@@ -1159,8 +2306,7 @@ def userPrime(db_path):
     buttons = {}
     master = Tk()
     Label(master, text="Prime:").grid(row=0, sticky=W)
-    for i, p in enumerate(['RunningBuffer', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9', 'P10', 
-                           'P11', 'P12', 'P13', 'P14', 'P15', 'P16', 'P17', 'P18', 'P19', 'P20']):
+    for i, p in enumerate(Por_dict.keys()):
         buttons[p] = IntVar()
         Checkbutton(master, text='Port: {:15} Buffer:   {}'.format(p, Por_dict[p]), variable=buttons[p]).grid(row=i+1, sticky=W)
     mainloop()
@@ -1191,13 +2337,9 @@ def datafileUserUpdateAll(db_path):
     if not os.path.isfile('FISH_System_datafile.yaml'):
         print('No "FISH_System_datafile.yaml" found, creating new from template.')
         print(os.path.realpath('FISH_System_datafile.yaml')) #incase user needs to relocate file
-        #Open template file including comments
-        with open('FISH_System_datafile_template.yaml', "r") as yaml_file:
-            config, ind, bsi = load_yaml_guess_indent(yaml_file)
-        #Copy Template and use as working file
-        with open('FISH_System_datafile.yaml', 'w') as new_yaml_file:
-            ruamel.yaml.round_trip_dump(config ,new_yaml_file, 
-                                        indent=ind, block_seq_indent=bsi) 
+        #Copy Template, including comments, and use as working file
+        shutil.copyfile('FISH_System_datafile_template.yaml', 'FISH_System_datafile.yaml')
+        clearYamlCache('FISH_System_datafile.yaml')
 
     #Open file for user to edit
     print('\nIn the Notepad edit the experimental info, save.')
@@ -1205,8 +2347,12 @@ def datafileUserUpdateAll(db_path):
     input('Press Enter if all experiment metadata is correct and saved...')
     print('Updating database')
     
-    yamlToDB_All(db_path)
-    print('\nAll data copied from FISH_System_datafile.yaml to {}.\n'.format(db_path))
+    changed = yamlToDB_All(db_path)
+    print('\nAll data copied from FISH_System_datafile.yaml to {}.'.format(db_path))
+    if changed == {}:
+        print('No changes found.\n')
+    else:
+        print('Changed tables: {}\n'.format(', '.join(changed.keys())))
     
     userPrime(db_path)
 
@@ -1358,40 +2504,28 @@ def countdown(seconds):
         time.sleep(1)
 
 
-def removeExperiment(db_path, exp_number):
+def removeExperiment(db_path, exp_number, datafile=True):
     """
-    Removes all data related to "exp_number" from the datafile and loads the
-    remaining info to the DB
-    To prevent reading/writing to the same file Notepad++.exe will be closed.
+    Removes all data related to "exp_number" from the database and the 
+    datafile. The database is updated directly, the datafile is updated in
+    the background, so the datafile can stay open in an editor.
     Input:
     `db_path`(str): Full path to database.
-    `exp_number`(str): Experiment number
+    `exp_number`(str): Experiment name, like: "LBEXP20181220_1"
+    `datafile`(bool): If False, only the database is updated. Used for the 
+        copy of the database of a simulation. Default = True
     
     """
+    print('Done with {}. All data will be erased from database and .yaml datafile.'.format(exp_number))
 
-    print('''!!WARNING!!
-    Done with {}. All data will be erased from .yaml datafile and database.
-    To prevent reading/writing to the same file, Notepad++.exe will be closed in:'''.format(exp_number))
-    countdown(30)
-    try:
-        os.system('Taskkill /IM Notepad++.exe')
-        print('Closed down Notepad++.exe')
-    except Exception as e:
-        print('Not possible to close Notepad++.exe')
-        print('Error message: ', e)
-    
-    print('You will be notified when Notepad++.exe can be used again')
-
-
-    with open('FISH_System_datafile.yaml', "r") as yaml_file:
-        config, ind, bsi = load_yaml_guess_indent(yaml_file)
+    Para_dict = returnDictDB(db_path, 'Parameters')[0]
     
-    #Use EXP number to get location and whether it is 1 or 2
-    if exp_number == config['FISHSystem']['Parameters']['EXP_number_1']:
+    #Use EXP name to get location and whether it is 1 or 2
+    if '{}'.format(exp_number) == Para_dict['EXP_name_1']:
         one_two = 1
         chamber = 'Chamber1'
         HYB_code = 'C' + chamber[-1]
-    elif exp_number == config['FISHSystem']['Parameters']['EXP_number_2']:
+    elif '{}'.format(exp_number) == Para_dict['EXP_name_2']:
         one_two = 2
         chamber = 'Chamber2'
         HYB_code = 'C' + chamber[-1]
@@ -1400,69 +2534,58 @@ def removeExperiment(db_path, exp_number):
     print('Will remove "{}" with number: {} located: {}.'.format(exp_number, one_two, chamber))
         
     #Remove all "Parameters" info of experiement 1 or 2
-    for k,v in config['FISHSystem']['Parameters'].items():
-        if k.endswith(str(one_two)):
-            config['FISHSystem']['Parameters'][k] = None
+    new_Parameters = {k: None for k in Para_dict if k.endswith(str(one_two))}
     
     #Remove all "Hybmix" info of experiment Left or Right
-    for k,v in config['FISHSystem']['Hybmix'].items():
+    new_Hybmix = {}
+    for k,v in returnDictDB(db_path, 'Hybmix')[0].items():
         try:
             if v.lower().startswith(HYB_code.lower()): #catch upper and lower case
                 print(v)
-                config['FISHSystem']['Hybmix'][k] = None
+                new_Hybmix[k] = None
         except AttributeError:
             pass
     
     #Replace Targets by empty dictionary
-    with open('FISH_System_datafile_template.yaml', "r") as yaml_file:
-        Targets_template, ind2, bsi2 = load_yaml_guess_indent(yaml_file)
-        Targets_template = Targets_template['FISHSystem']['Targets']
-
-    config['FISHSystem']['Targets'][chamber] = Targets_template[chamber]
-    config['FISHSystem']['Targets']
+    Targets_template = copy.deepcopy(yamlLoaderCached('FISH_System_datafile_template.yaml')['FISHSystem']['Targets'][chamber])
+
+    #Update database
+    with transactionDB(db_path):
+        updateRowDB(db_path, 'Parameters', new_Parameters)
+        setFlagDB(db_path, 'Parameters_flag')
+        updateRowDB(db_path, 'Hybmix', new_Hybmix)
+        setFlagDB(db_path, 'Hybmix_flag')
+        for hybridization in Targets_template:
+            code = 'C{}H{}'.format(chamber[-1], hybridization[-2:])
+            updateRowDB(db_path, 'Targets', Targets_template[hybridization], criteria_column='Code', criteria=code)
+        setFlagDB(db_path, 'Targets_flag')
 
-    #Replace working datfile with the striped version
-    with open('FISH_System_datafile.yaml', 'w') as new_yaml_file:
-        ruamel.yaml.round_trip_dump(config ,new_yaml_file, 
-                                    indent=ind, block_seq_indent=bsi) 
-    #Upload striped datafile to DB
-    yamlToDB_All(db_path)
+    #Update datafile
+    if datafile == True:
+        yamlUpdateBackground('FISH_System_datafile.yaml', {'FISHSystem': {'Parameters': new_Parameters,
+                                                                          'Hybmix': new_Hybmix,
+                                                                          'Targets': {chamber: Targets_template}}})
 
-    print('''\nRemoved {} from .yaml datafile and database.\n
-    Ready for new experiment.\n
-    Notepad++.exe can be used again.'''.format(exp_number))
+    print('''\nRemoved {} from database, .yaml datafile will be updated.\n
+    Ready for new experiment.\n'''.format(exp_number))
 
-def removeHybmix(db_path, HYB_port):
+def removeHybmix(db_path, HYB_port, datafile=True):
     """
     Remove the Hybmix from the port after it has been used.
+    The database is updated directly, the datafile is updated in the 
+    background, so the datafile can stay open in an editor.
     Input:
     `db_path`(str): Full path to database.
     `HYB_port`(str): Port where the Hybmix was located. Like: "HYB01"
+    `datafile`(bool): If False, only the database is updated. Used for the 
+        copy of the database of a simulation. Default = True
     
     """
-    print('''!!WARNING!! To prevent reading/writing to the same file, Notepad++.exe will be closed in:''')
-    countdown(2)
-    try:
-        os.system('Taskkill /IM Notepad++.exe')
-        print('Closed down Notepad++.exe')
-    except Exception as e:
-        print('Not possible to close Notepad++.exe')
-        print('Error message: ', e)
+    with transactionDB(db_path):
+        updateRowDB(db_path, 'Hybmix', {HYB_port: None})
+        setFlagDB(db_path, 'Hybmix_flag')
     
-    print('You will be notified when Notepad++.exe can be used again')
-
-    with open('FISH_System_datafile.yaml', "r") as yaml_file:
-        config, ind, bsi = load_yaml_guess_indent(yaml_file)
-        
-    config['FISHSystem']['Hybmix'][HYB_port] = None
+    if datafile == True:
+        yamlUpdateBackground('FISH_System_datafile.yaml', {'FISHSystem': {'Hybmix': {HYB_port: None}}})
     
     print('Removed Hybmix code from {}'.format(HYB_port))
-    
-    #Replace working datfile with the striped version
-    with open('FISH_System_datafile.yaml', 'w') as new_yaml_file:
-        ruamel.yaml.round_trip_dump(config ,new_yaml_file, 
-                                    indent=ind, block_seq_indent=bsi) 
-    #Upload striped datafile to DB
-    yamlToDB_Hybmix(db_path)
-    
-    print('Notepad++.exe can be used again')
\ No newline at end of file
@@ -0,0 +1,417 @@
+#Python 3 package to simulate the hardware of FISH system 2.
+#Used by the FISH2 program when it is started with simulate=True, to test
+#protocols without hardware. All waiting is done on a virtual clock, so that
+#an experiment of multiple days runs in seconds. Every operation is recorded
+#in the timeline of the clock.
+#The durations are estimates, not exact timings of the hardware.
+
+## CONTENT ##
+    # Virtual clock
+    # Syringe pump
+    # MX valve
+    # Temperature controllers and thermistor
+    # Imaging
+
+import time
+import csv
+from datetime import datetime
+
+#=============================================================================
+# Virtual clock
+#=============================================================================
+
+class VirtualClock():
+    """
+    Clock with the same time() and sleep() functions as the "time" module.
+    sleep() returns immediately and moves the clock forward.
+    Every operation of the simulated devices is added to the timeline.
+    Input:
+    `start`(float): Start time in seconds since the epoch. If None, uses the
+        current time. Default = None
+
+    """
+    def __init__(self, start=None):
+        self.start = time.time() if start == None else start
+        self.current = self.start
+        #List of: (time, device, action, duration)
+        self.timeline = []
+        #Objects that act on their own at a moment in time, like the imaging.
+        #They need an update(now) function and a next_event attribute.
+        self.watchers = []
+
+    def time(self):
+        """Return the current virtual time in seconds since the epoch."""
+        return self.current
+
+    def sleep(self, sec):
+        """Move the clock `sec` seconds forward."""
+        if sec > 0:
+            self.log('Clock', 'Sleep {}s'.format(round(sec, 3)), sec)
+
+    def advance(self, sec):
+        """
+        Move the clock forward, the watchers act at the moment of their event.
+        Input:
+        `sec`(float): Seconds to move forward.
+
+        """
+        end = self.current + sec
+        for w in self.watchers:
+            w.update(self.current)
+        while True:
+            due = [w for w in self.watchers if w.next_event != None and w.next_event <= end]
+            if due == []:
+                break
+            w = min(due, key=lambda w: w.next_event)
+            self.current = max(self.current, w.next_event)
+            w.update(self.current)
+        self.current = end
+
+    def log(self, device, action, duration=0):
+        """
+        Add an operation to the timeline and move the clock forward with the
+        duration of the operation.
+        Input:
+        `device`(str): Name of device.
+        `action`(str): Description of the operation.
+        `duration`(float): Duration of the operation in seconds. Default = 0
+
+        """
+        self.timeline.append((self.current, device, action, duration))
+        if duration > 0:
+            self.advance(duration)
+
+    def elapsed(self):
+        """Return the virtual seconds since the start of the clock."""
+        return self.current - self.start
+
+    def printTimeline(self, device=None):
+        """
+        Print the timeline.
+        Input:
+        `device`(str): Only print the operations of this device. If None,
+            prints all. Default = None
+
+        """
+        for t, d, action, duration in self.timeline:
+            if device == None or d == device:
+                print('{} | {:12}| {} ({}s)'.format(datetime.fromtimestamp(t).strftime('%d-%m-%Y %H:%M:%S'),
+                                                    d, action, round(duration, 3)))
+
+    def saveTimeline(self, filepath):
+        """
+        Save the timeline as .csv file.
+        Input:
+        `filepath`(str): Name of the .csv file.
+
+        """
+        with open(filepath, 'w', newline='') as timeline_file:
+            writer = csv.writer(timeline_file)
+            writer.writerow(['Time', 'Elapsed', 'Device', 'Action', 'Duration'])
+            for t, d, action, duration in self.timeline:
+                writer.writerow([datetime.fromtimestamp(t).strftime('%d-%m-%Y %H:%M:%S.%f'),
+                                 round(t - self.start, 3), d, action, round(duration, 3)])
+
+#=============================================================================
+# Syringe pump
+#=============================================================================
+
+#Plunger speed in half steps per second for the speed codes 0-40 of the
+#Cavro XCalibur. A full stroke is 6000 half steps.
+xcalibur_speed_codes = [6000, 5600, 5000, 4400, 3800, 3200, 2600, 2200, 2000, 1800,
+                        1600, 1400, 1200, 1000, 800, 600, 400, 200, 190, 180,
+                        170, 160, 150, 140, 130, 120, 110, 100, 90, 80,
+                        70, 60, 50, 40, 30, 20, 18, 16, 14, 12, 10]
+
+class SimulatedPump():
+    """
+    Simulated Cavro syringe pump with the functions of the tecancavro package
+    that are used by the FISH2 program. Like the real pump, commands with
+    execute=False are added to a command chain that is executed by the next
+    command with execute=True or by executeChain().
+    Input:
+    `clock`(VirtualClock): Clock of the simulation.
+    `model`(str): 'XCalibur' or 'XE1000'.
+    `syringe_ul`(int): Volume of the syringe in ul.
+    `round_trip`(float): Seconds of serial communication per command string.
+        Default = 0.05
+    `name`(str): Name in the timeline. Default = model.
+
+    """
+    def __init__(self, clock, model='XCalibur', syringe_ul=2500, round_trip=0.05, name=None):
+        self.clock = clock
+        self.model = model
+        self.syringe_ul = syringe_ul
+        self.round_trip = round_trip
+        self.name = name if name != None else model
+        if model == 'XCalibur':
+            #Speed codes, 0 is the fastest
+            self.min_speed, self.max_speed = 0, 40
+            self.speed = 14
+        elif model == 'XE1000':
+            #Speed in half steps per second, 2000 half steps per stroke
+            self.min_speed, self.max_speed = 5, 5800
+            self.speed = 400
+        else:
+            raise ValueError('Invalid model: {}, choose "XCalibur" or "XE1000"'.format(model))
+        self.backlash = 0
+        self.plunger_ul = 0
+        self.port = 'input'
+        #List of (description, function) that is executed by executeChain()
+        self.cmd_chain = []
+
+    def strokeTime(self, volume_ul):
+        """
+        Return the seconds needed to move the plunger `volume_ul` ul at the
+        current speed.
+
+        """
+        if self.model == 'XCalibur':
+            seconds_per_stroke = 6000 / xcalibur_speed_codes[int(self.speed)]
+        else:
+            seconds_per_stroke = 2000 / self.speed
+        return seconds_per_stroke * abs(volume_ul) / self.syringe_ul
+
+    def _command(self, description, function, execute):
+        """Add a command to the chain and execute it if `execute` is True."""
+        self.cmd_chain.append((description, function))
+        if execute == True:
+            self.executeChain()
+
+    def executeChain(self):
+        """Execute all chained commands as one command string."""
+        chain = self.cmd_chain
+        self.cmd_chain = []
+        self.clock.log(self.name, 'Send {} command(s)'.format(len(chain)), self.round_trip)
+        for description, function in chain:
+            duration = function()
+            self.clock.log(self.name, description, duration)
+
+    def resetChain(self):
+        """Remove the chained commands without executing them."""
+        self.cmd_chain = []
+
+    def init(self, **kwargs):
+        """Initialize the pump, empties the syringe."""
+        def function():
+            duration = self.strokeTime(self.plunger_ul) + 2
+            self.plunger_ul = 0
+            self.port = 'output'
+            return duration
+        self._command('Initialize', function, True)
+
+    def setSpeed(self, speed, execute=False):
+        """Set the plunger speed."""
+        if not self.min_speed <= speed <= self.max_speed:
+            raise ValueError('Speed {} out of range, choose between {} and {}'.format(speed, self.min_speed, self.max_speed))
+        def function():
+            self.speed = speed
+            return 0
+        self._command('Set speed {}'.format(speed), function, execute)
+
+    def getSpeed(self):
+        """Return the plunger speed."""
+        self.clock.log(self.name, 'Get speed', self.round_trip)
+        return self.speed
+
+    def setBacklashSteps(self, steps, execute=False):
+        """Set the backlash steps."""
+        def function():
+            self.backlash = steps
+            return 0
+        self._command('Set backlash {}'.format(steps), function, execute)
+
+    def getBacklashSteps(self):
+        """Return the backlash steps."""
+        self.clock.log(self.name, 'Get backlash', self.round_trip)
+        return self.backlash
+
+    def getPlungerPos(self):
+        """Return the plunger position in half steps."""
+        self.clock.log(self.name, 'Get plunger position', self.round_trip)
+        return self._ulToSteps(self.plunger_ul)
+
+    def _ulToSteps(self, volume_ul):
+        """Convert a volume to half steps, 6000 per stroke."""
+        return int(round(volume_ul * 6000 / self.syringe_ul))
+
+    def changePort(self, to_port, execute=False):
+        """Switch the Y-valve of the pump to 'input' or 'output'."""
+        def function():
+            self.port = to_port
+            return 0.2
+        self._command('Change port to {}'.format(to_port), function, execute)
+
+    def movePlungerAbs(self, abs_position, execute=False):
+        """Move the plunger to an absolute position in half steps."""
+        def function():
+            volume = abs_position * self.syringe_ul / 6000
+            duration = self.strokeTime(volume - self.plunger_ul)
+            self.plunger_ul = volume
+            return duration
+        self._command('Move plunger to {}'.format(abs_position), function, execute)
+
+    def extract(self, volume_ul, from_port, execute=False):
+        """Aspirate `volume_ul` ul from 'input' or 'output'."""
+        def function():
+            if self.plunger_ul + volume_ul > self.syringe_ul + 1:
+                raise ValueError('Can not extract {}ul, syringe contains {}ul of {}ul'.format(volume_ul, self.plunger_ul, self.syringe_ul))
+            switch = 0.2 if self.port != from_port else 0
+            self.port = from_port
+            self.plunger_ul += volume_ul
+            return self.strokeTime(volume_ul) + switch
+        self._command('Extract {}ul from {}'.format(volume_ul, from_port), function, execute)
+
+    def dispense(self, volume_ul, to_port, execute=False):
+        """Dispense `volume_ul` ul to 'input' or 'output'."""
+        def function():
+            if volume_ul > self.plunger_ul + 1:
+                raise ValueError('Can not dispense {}ul, syringe contains {}ul'.format(volume_ul, self.plunger_ul))
+            self.port = to_port
+            self.plunger_ul = max(0, self.plunger_ul - volume_ul)
+            return self.strokeTime(volume_ul)
+        self._command('Dispense {}ul to {}'.format(volume_ul, to_port), function, execute)
+
+#=============================================================================
+# MX valve
+#=============================================================================
+
+class SimulatedValve():
+    """
+    Simulated MX II valve.
+    Input:
+    `clock`(VirtualClock): Clock of the simulation.
+    `name`(str): Name of the valve, like: 'MXValve1'.
+    `ports`(int): Number of ports. Default = 10
+    `move_time`(float): Seconds per move. Default = 0.25
+
+    """
+    def __init__(self, clock, name, ports=10, move_time=0.25):
+        self.clock = clock
+        self.name = name
+        self.ports = ports
+        self.move_time = move_time
+        self.port = 1
+
+    def change_port(self, port):
+        """Move the valve to a port."""
+        if not 1 <= port <= self.ports:
+            raise ValueError('Invalid port: {}, choose between 1 and {}'.format(port, self.ports))
+        self.clock.log(self.name, 'Port {} to {}'.format(self.port, port), self.move_time)
+        self.port = port
+
+#=============================================================================
+# Temperature controllers and thermistor
+#=============================================================================
+
+class SimulatedTemperatureController():
+    """
+    Simulated ThermoCube, Oasis or TC720. The temperature moves linearly to
+    the set temperature.
+    Input:
+    `clock`(VirtualClock): Clock of the simulation.
+    `name`(str): Name of the controller, like: 'ThermoCube_1'
+    `temperature`(float): Start temperature. Default = 20
+    `rate`(float): Degree Celsius per second. Default = 0.1
+    `room_temperature`(float): Room temperature. Default = 22
+
+    """
+    def __init__(self, clock, name, temperature=20, rate=0.1, room_temperature=22):
+        self.clock = clock
+        self.name = name
+        self.rate = rate
+        self.room_temperature = room_temperature
+        self.connected = True
+        self.target = temperature
+        self._start_temperature = temperature
+        self._start_time = clock.time()
+
+    def set_temp(self, temperature):
+        """Set the target temperature."""
+        self._start_temperature = self.get_temp()
+        self._start_time = self.clock.time()
+        self.target = temperature
+        self.clock.log(self.name, 'Set temperature {}C'.format(temperature))
+
+    def get_temp(self):
+        """Return the current temperature."""
+        change = self.rate * (self.clock.time() - self._start_time)
+        difference = self.target - self._start_temperature
+        if change >= abs(difference):
+            return self.target
+        return round(self._start_temperature + (change if difference > 0 else -change), 2)
+
+    def get_temp2(self):
+        """Return the second sensor of the TC720, the room temperature."""
+        return self.room_temperature
+
+    def check_error(self, **kwargs):
+        """Return [True, message], no errors are simulated."""
+        return [True, 'No errors on simulated {}'.format(self.name)]
+
+class SimulatedThermistor():
+    """
+    Simulated Yoctopuce thermistor that reads the room temperature and the
+    temperature of the chambers.
+    Input:
+    `clock`(VirtualClock): Clock of the simulation.
+    `controllers`(list): Simulated temperature controllers of Chamber1 and
+        Chamber2, None if not present.
+    `room_temperature`(float): Room temperature. Default = 22
+
+    """
+    def __init__(self, clock, controllers, room_temperature=22):
+        self.clock = clock
+        self.controllers = controllers
+        self.room_temperature = room_temperature
+        self.temp_log_filename = 'Simulated'
+
+    def deamon_start(self):
+        """Nothing to start in the simulation."""
+        pass
+
+    def get_temp(self):
+        """Return: [time, room, Chamber1, Chamber2, room, room, room]"""
+        now = datetime.fromtimestamp(self.clock.time()).strftime('%d-%m-%Y_%H:%M:%S')
+        chambers = [c.get_temp() if c != None else self.room_temperature for c in self.controllers]
+        return [now, self.room_temperature] + chambers + [self.room_temperature] * 3
+
+#=============================================================================
+# Imaging
+#=============================================================================
+
+class SimulatedImaging():
+    """
+    Simulated imaging software. Like the Nikon software it starts imaging
+    when the start imaging file is set to 1 or 2 and sets it back to 0 when
+    the imaging is done.
+    Input:
+    `clock`(VirtualClock): Clock of the simulation.
+    `start_imaging_file_path`(str): Path to the start imaging file.
+    `imaging_time`(float): Seconds per imaging round. Default = 3600
+
+    """
+    def __init__(self, clock, start_imaging_file_path, imaging_time=3600):
+        self.clock = clock
+        self.start_imaging_file_path = start_imaging_file_path
+        self.imaging_time = imaging_time
+        self.next_event = None
+        self.rounds = 0
+        clock.watchers.append(self)
+
+    def update(self, now):
+        """Start or finish the imaging."""
+        if self.next_event != None:
+            if now >= self.next_event:
+                with open(self.start_imaging_file_path, 'w') as start_imaging_file:
+                    start_imaging_file.write('0')
+                self.next_event = None
+                self.clock.timeline.append((now, 'Imaging', 'Finished', 0))
+            return
+
+        with open(self.start_imaging_file_path, 'r') as start_imaging_file:
+            value = start_imaging_file.read().strip()
+        if value not in ['', '0']:
+            self.rounds += 1
+            self.next_event = now + self.imaging_time
+            self.clock.timeline.append((now, 'Imaging', 'Start imaging Chamber{}'.format(value), self.imaging_time))
@@ -25,8 +25,19 @@ if color == True:
 
 
 
+#Database settings
+#Set to True to use WAL journaling, so that the FISH2 program can keep reading
+#the database while the user program writes to it.
+wal_mode = False
+#Seconds to wait for a lock held by the FISH2 program before giving up.
+busy_timeout = 5
+#Database layout. 1: original single row tables. 2: normalised tables with 
+#one row per value, existing databases are migrated (see FISH2_migrate_db.py).
+db_schema = 1
+
 #Make FISH system 2 database
-db_path = perif.newFISHdb('FISH_System2_db')
+db_path = perif.newFISHdb('FISH_System2_db', wal=wal_mode, busy_timeout=busy_timeout, 
+                          schema=db_schema)
 time.sleep(5)
 print('db_path: ', db_path)
 #Fill .yaml datafile and export to datbase